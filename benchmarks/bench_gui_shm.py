@@ -0,0 +1,282 @@
+"""Rendering throughput of X11 clients with and without MIT-SHM
+
+Puts full frames (WIDTHxHEIGHT, 32 bit) into a pixmap with XPutImage (the
+image is sent through the socket) and XShmPutImage (the X server reads the
+image from a shared memory segment). Uses libX11 and libXext via ctypes.
+
+By default a private Xvfb is started. --display uses a running X server.
+With --inside IMAGE the check runs in containers started by docker-inside
+with --gui and --gui-shm (the image needs python3, libX11 and libXext).
+
+Usage: python benchmarks/bench_gui_shm.py [--frames N] [--size WIDTHxHEIGHT]
+       python benchmarks/bench_gui_shm.py --display :0
+       python benchmarks/bench_gui_shm.py --inside IMAGE
+"""
+import os
+import sys
+import time
+import ctypes
+import ctypes.util
+import argparse
+import subprocess
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..', 'src'))
+
+ZPIXMAP = 2
+IPC_PRIVATE = 0
+IPC_CREAT = 0o1000
+IPC_RMID = 0
+
+
+class XImage(ctypes.Structure):
+    # leading members of XImage (Xlib.h)
+    _fields_ = [
+        ("width", ctypes.c_int),
+        ("height", ctypes.c_int),
+        ("xoffset", ctypes.c_int),
+        ("format", ctypes.c_int),
+        ("data", ctypes.c_void_p),
+        ("byte_order", ctypes.c_int),
+        ("bitmap_unit", ctypes.c_int),
+        ("bitmap_bit_order", ctypes.c_int),
+        ("bitmap_pad", ctypes.c_int),
+        ("depth", ctypes.c_int),
+        ("bytes_per_line", ctypes.c_int),
+        ("bits_per_pixel", ctypes.c_int),
+    ]
+
+
+class XShmSegmentInfo(ctypes.Structure):
+    _fields_ = [
+        ("shmseg", ctypes.c_ulong),
+        ("shmid", ctypes.c_int),
+        ("shmaddr", ctypes.c_void_p),
+        ("readOnly", ctypes.c_int),
+    ]
+
+
+class XErrorEvent(ctypes.Structure):
+    _fields_ = [
+        ("type", ctypes.c_int),
+        ("display", ctypes.c_void_p),
+        ("resourceid", ctypes.c_ulong),
+        ("serial", ctypes.c_ulong),
+        ("error_code", ctypes.c_ubyte),
+        ("request_code", ctypes.c_ubyte),
+        ("minor_code", ctypes.c_ubyte),
+    ]
+
+
+_ERROR_HANDLER = ctypes.CFUNCTYPE(ctypes.c_int, ctypes.c_void_p, ctypes.POINTER(XErrorEvent))
+
+
+def _load(name):
+    path = ctypes.util.find_library(name)
+    if path is None:
+        raise OSError("lib{0} not found".format(name))
+    return ctypes.CDLL(path)
+
+
+class Display(object):
+    """Minimal Xlib binding drawing images into a pixmap"""
+
+    def __init__(self, name, width, height):
+        self.x11 = _load("X11")
+        self.xext = _load("Xext")
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self._declare()
+        self.errors = list()
+        # the default handler exits the process (f.e. if MIT-SHM can't attach)
+        self._handler = _ERROR_HANDLER(self._on_error)
+        self.x11.XSetErrorHandler(self._handler)
+        self.dpy = self.x11.XOpenDisplay(name.encode())
+        if not self.dpy:
+            raise RuntimeError("Can't open display '{0}'".format(name))
+        screen = self.x11.XDefaultScreen(self.dpy)
+        self.visual = self.x11.XDefaultVisual(self.dpy, screen)
+        self.depth = self.x11.XDefaultDepth(self.dpy, screen)
+        root = self.x11.XRootWindow(self.dpy, screen)
+        self.width = width
+        self.height = height
+        self.pixmap = self.x11.XCreatePixmap(self.dpy, root, width, height, self.depth)
+        self.gc = self.x11.XCreateGC(self.dpy, self.pixmap, 0, None)
+
+    def _declare(self):
+        x11, xext, libc = self.x11, self.xext, self.libc
+        x11.XOpenDisplay.restype = ctypes.c_void_p
+        x11.XOpenDisplay.argtypes = [ctypes.c_char_p]
+        x11.XSetErrorHandler.argtypes = [_ERROR_HANDLER]
+        x11.XDefaultScreen.argtypes = [ctypes.c_void_p]
+        x11.XCloseDisplay.argtypes = [ctypes.c_void_p]
+        x11.XSync.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultVisual.restype = ctypes.c_void_p
+        x11.XDefaultVisual.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XRootWindow.restype = ctypes.c_ulong
+        x11.XRootWindow.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XDefaultDepth.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        x11.XCreatePixmap.restype = ctypes.c_ulong
+        x11.XCreatePixmap.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_uint, ctypes.c_uint,
+                                      ctypes.c_uint]
+        x11.XCreateGC.restype = ctypes.c_void_p
+        x11.XCreateGC.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_ulong, ctypes.c_void_p]
+        x11.XCreateImage.restype = ctypes.POINTER(XImage)
+        x11.XCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                     ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_uint,
+                                     ctypes.c_int, ctypes.c_int]
+        x11.XPutImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_void_p,
+                                  ctypes.POINTER(XImage)] + [ctypes.c_int] * 4 + [ctypes.c_uint] * 2
+        xext.XShmQueryExtension.argtypes = [ctypes.c_void_p]
+        xext.XShmCreateImage.restype = ctypes.POINTER(XImage)
+        xext.XShmCreateImage.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int,
+                                         ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo),
+                                         ctypes.c_uint, ctypes.c_uint]
+        xext.XShmAttach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmDetach.argtypes = [ctypes.c_void_p, ctypes.POINTER(XShmSegmentInfo)]
+        xext.XShmPutImage.argtypes = [ctypes.c_void_p, ctypes.c_ulong, ctypes.c_void_p,
+                                      ctypes.POINTER(XImage)] + [ctypes.c_int] * 4 + \
+                                     [ctypes.c_uint] * 2 + [ctypes.c_int]
+        libc.malloc.restype = ctypes.c_void_p
+        libc.malloc.argtypes = [ctypes.c_size_t]
+        libc.shmget.argtypes = [ctypes.c_int, ctypes.c_size_t, ctypes.c_int]
+        libc.shmat.restype = ctypes.c_void_p
+        libc.shmat.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int]
+        libc.shmdt.argtypes = [ctypes.c_void_p]
+        libc.shmctl.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_void_p]
+
+    def _on_error(self, dpy, event):
+        self.errors.append((event.contents.request_code, event.contents.error_code))
+        return 0
+
+    def _frames(self, put, frames):
+        self.x11.XSync(self.dpy, 0)
+        start = time.perf_counter()
+        for _ in range(frames):
+            put()
+            # wait until the server processed the frame
+            self.x11.XSync(self.dpy, 0)
+        return time.perf_counter() - start
+
+    def put_image(self, frames):
+        size = self.width * self.height * 4
+        data = self.libc.malloc(size)
+        ctypes.memset(data, 0x5a, size)
+        image = self.x11.XCreateImage(self.dpy, self.visual, self.depth, ZPIXMAP, 0, data,
+                                      self.width, self.height, 32, 0)
+        return self._frames(lambda: self.x11.XPutImage(self.dpy, self.pixmap, self.gc, image,
+                                                       0, 0, 0, 0, self.width, self.height), frames)
+
+    def shm_put_image(self, frames):
+        """Duration of the frames or None if MIT-SHM isn't usable"""
+        if not self.xext.XShmQueryExtension(self.dpy):
+            return None
+        info = XShmSegmentInfo()
+        image = self.xext.XShmCreateImage(self.dpy, self.visual, self.depth, ZPIXMAP, None,
+                                          ctypes.byref(info), self.width, self.height)
+        size = image.contents.bytes_per_line * image.contents.height
+        info.shmid = self.libc.shmget(IPC_PRIVATE, size, IPC_CREAT | 0o600)
+        if info.shmid < 0:
+            return None
+        try:
+            info.shmaddr = self.libc.shmat(info.shmid, None, 0)
+            image.contents.data = info.shmaddr
+            ctypes.memset(info.shmaddr, 0x5a, size)
+            self.xext.XShmAttach(self.dpy, ctypes.byref(info))
+            self.x11.XSync(self.dpy, 0)
+            if self.errors:
+                # different IPC namespace or remote X server
+                return None
+            try:
+                return self._frames(lambda: self.xext.XShmPutImage(
+                    self.dpy, self.pixmap, self.gc, image, 0, 0, 0, 0,
+                    self.width, self.height, 0), frames)
+            finally:
+                self.xext.XShmDetach(self.dpy, ctypes.byref(info))
+                self.x11.XSync(self.dpy, 0)
+                self.libc.shmdt(info.shmaddr)
+        finally:
+            self.libc.shmctl(info.shmid, IPC_RMID, None)
+
+    def close(self):
+        self.x11.XCloseDisplay(self.dpy)
+
+
+def report(title, duration, frames, width, height):
+    if duration is None:
+        sys.stdout.write("  {0:<24} unavailable\n".format(title))
+        return
+    size = frames * width * height * 4
+    sys.stdout.write("  {0:<24} {1:8.1f} frames/s {2:10.1f} MB/s\n".format(
+        title, frames / duration, size / duration / 1e6))
+
+
+def bench_display(name, frames, width, height):
+    display = Display(name, width, height)
+    try:
+        sys.stdout.write("display {0}, {1}x{2}, {3} frames\n".format(name, width, height, frames))
+        report("XPutImage (socket)", display.put_image(frames), frames, width, height)
+        report("XShmPutImage (MIT-SHM)", display.shm_put_image(frames), frames, width, height)
+    finally:
+        display.close()
+
+
+def start_xvfb(width, height):
+    for number in range(90, 120):
+        if not os.path.exists("/tmp/.X11-unix/X{0}".format(number)):
+            break
+    else:
+        raise RuntimeError("No free display number")
+    name = ":{0}".format(number)
+    # no access control: the display is private to this benchmark
+    try:
+        proc = subprocess.Popen(['Xvfb', name, '-screen', '0', "{0}x{1}x24".format(width, height),
+                                 '-nolisten', 'tcp', '-ac'],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except OSError as e:
+        raise RuntimeError("Couldn't start Xvfb ({0}), use --display".format(e))
+    deadline = time.monotonic() + 10.0
+    while not os.path.exists("/tmp/.X11-unix/X{0}".format(number)):
+        if proc.poll() is not None or time.monotonic() > deadline:
+            proc.kill()
+            raise RuntimeError("Xvfb didn't start")
+        time.sleep(0.05)
+    return name, proc
+
+
+def bench_inside(image, display, args):
+    env = dict(os.environ, DISPLAY=display)
+    env['PYTHONPATH'] = os.pathsep.join(i for i in (SRC_DIR, env.get('PYTHONPATH')) if i)
+    for mode in ('--gui', '--gui-shm'):
+        sys.stdout.write("docker-inside {0} {1}\n".format(mode, image))
+        sys.stdout.flush()
+        subprocess.call([sys.executable, '-m', 'dockerinside', '--quiet', mode,
+                         '-v', "{0}:/din-bench:ro".format(THIS_DIR), image, '--',
+                         'python3', '/din-bench/bench_gui_shm.py', '--display', display,
+                         '--frames', str(args.frames), '--size', args.size], env=env)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--size', default="1920x1080", help="Frame size WIDTHxHEIGHT")
+    parser.add_argument('--display', help="Use this X server instead of starting Xvfb")
+    parser.add_argument('--inside', metavar='IMAGE', help="Run the check in containers of IMAGE")
+    args = parser.parse_args()
+    width, height = (int(i) for i in args.size.split("x"))
+    xvfb = None
+    display = args.display
+    if display is None:
+        display, xvfb = start_xvfb(width, height)
+    try:
+        if args.inside:
+            bench_inside(args.inside, display, args)
+        else:
+            bench_display(display, args.frames, width, height)
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+"""Launch latency of docker-inside and docker-inside-setup
+
+By default the apps run against the fake engine (benchmarks/fake_engine.py)
+on a temporary unix socket, so only the client side overhead plus the
+configured endpoint latency is measured. With --real the time to first
+output of a command is measured against the local Docker daemon.
+
+Usage: python benchmarks/bench_launch.py [--number N] [--latency create=0.05,...]
+       python benchmarks/bench_launch.py --real [--number N] [IMAGE ...]
+"""
+import os
+import sys
+import math
+import json
+import time
+import tempfile
+import argparse
+import collections
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, THIS_DIR)
+sys.path.insert(0, os.path.realpath(os.path.join(THIS_DIR, '..', 'src')))
+
+import fake_engine  # noqa: E402
+
+# images of test_user_id_docker (unit_tests/test_inside.py)
+TEST_IMAGES = [
+    'ubuntu:14.04', 'ubuntu:16.04', 'ubuntu:latest',
+    'alpine:3.6', 'alpine:latest',
+    'busybox:latest',
+    'centos:latest',
+    'fedora:latest',
+]
+PERCENTILES = (50, 90, 99)
+
+
+def percentile(values, p):
+    """Nearest rank percentile of a non-empty list"""
+    ordered = sorted(values)
+    rank = max(1, int(math.ceil(p / 100.0 * len(ordered))))
+    return ordered[rank - 1]
+
+
+def report(title, samples, stream=sys.stdout):
+    """Print percentiles (in milliseconds) of every sampled metric"""
+    stream.write("{0}\n".format(title))
+    stream.write("  {0:<24} {1:>6}".format("metric", "n"))
+    for p in PERCENTILES:
+        stream.write(" {0:>9}".format("p{0} ms".format(p)))
+    stream.write(" {0:>9}\n".format("max ms"))
+    for name, values in samples.items():
+        stream.write("  {0:<24} {1:>6}".format(name, len(values)))
+        for p in PERCENTILES:
+            stream.write(" {0:>9.2f}".format(percentile(values, p) * 1e3))
+        stream.write(" {0:>9.2f}\n".format(max(values) * 1e3))
+    stream.flush()
+
+
+def _collect_spans(app, samples):
+    def _listener(span):
+        samples["span " + span["name"]].append(span["duration"])
+    app.timings.add_listener(_listener)
+
+
+def bench_inside(client, docker_env, number, samples):
+    import dockerinside
+    from dockerinside import dockerutils
+
+    class BenchInsideApp(dockerinside.DockerInsideApp):
+        marks = dict()
+
+        @staticmethod
+        def _isatty():
+            return False
+
+        def _inside(self):
+            self.marks["inside"] = time.perf_counter()
+            dockerinside.DockerInsideApp._inside(self)
+
+        def _start(self):
+            self.marks["start"] = time.perf_counter()
+            dockerinside.DockerInsideApp._start(self)
+
+        def _prepare_environment(self, image_info):
+            start = time.perf_counter()
+            try:
+                return dockerinside.DockerInsideApp._prepare_environment(self, image_info)
+            finally:
+                samples["prepare_environment"].append(time.perf_counter() - start)
+
+        def cleanup(self):
+            start = time.perf_counter()
+            try:
+                dockerinside.DockerInsideApp.cleanup(self)
+            finally:
+                samples["teardown"].append(time.perf_counter() - start)
+
+    argv = ['ubuntu:22.04', '--', 'id', '-u']
+    for _ in range(number):
+        app = BenchInsideApp(env=docker_env, client=client)
+        _collect_spans(app, samples)
+        start = time.perf_counter()
+        output = app.run(argv, capture_stdout=True)
+        samples["run (capture)"].append(time.perf_counter() - start)
+        assert output is not None, "docker-inside failed"
+        samples["inside -> start"].append(app.marks["start"] - app.marks["inside"])
+        app = BenchInsideApp(env=docker_env, client=client)
+        start = time.perf_counter()
+        app.run(argv)
+        samples["run (auto remove)"].append(time.perf_counter() - start)
+    session_argv = ['--session'] + argv
+    BenchInsideApp(env=docker_env, client=client).run(session_argv, capture_stdout=True)
+    for _ in range(number):
+        app = BenchInsideApp(env=docker_env, client=client)
+        start = time.perf_counter()
+        output = app.run(session_argv, capture_stdout=True)
+        samples["run (session)"].append(time.perf_counter() - start)
+        assert output is not None, "docker-inside --session failed"
+    from dockerinside import profiles
+    profile = profiles.profile_path("bench")
+    os.makedirs(os.path.dirname(profile), exist_ok=True)
+    with open(profile, 'w') as f:
+        json.dump({"args": argv[:1]}, f)
+    profile_argv = ['@bench', '--'] + argv[2:]
+    for _ in range(2):  # record the switch method, then compile the plan
+        BenchInsideApp(env=docker_env, client=client).run(profile_argv, capture_stdout=True)
+    for _ in range(number):
+        app = BenchInsideApp(env=docker_env, client=client)
+        start = time.perf_counter()
+        output = app.run(profile_argv, capture_stdout=True)
+        samples["run (profile)"].append(time.perf_counter() - start)
+        assert output is not None, "docker-inside @bench failed"
+        samples["inside -> start (profile)"].append(app.marks["start"] - app.marks["inside"])
+    pack_conf = dockerinside.DockerInsideApp(env=docker_env, client=client)._pack_config(None)
+    for _ in range(number):
+        start = time.perf_counter()
+        dockerutils._tar_pack(pack_conf, 'w', 0o640)
+        samples["tar_pack (cold)"].append(time.perf_counter() - start)
+
+
+def bench_setup(client, docker_env, number, samples, home):
+    from dockerinside import setup
+    for _ in range(number):
+        app = setup.SetupApp(env=docker_env, client=client)
+        _collect_spans(app, samples)
+        start = time.perf_counter()
+        ret = app.run(['--home', home, '--force'])
+        samples["setup (build)"].append(time.perf_counter() - start)
+        assert ret == 0, "docker-inside-setup failed"
+        app = setup.SetupApp(env=docker_env, client=client)
+        start = time.perf_counter()
+        app.run(['--home', home])
+        samples["setup (up to date)"].append(time.perf_counter() - start)
+
+
+def bench_fake(args):
+    import docker
+    with tempfile.TemporaryDirectory(prefix='din-bench') as tmp:
+        # keep the caches of docker-inside away from the real home directory
+        os.environ['HOME'] = tmp
+        latency = fake_engine.parse_latency(args.latency)
+        with fake_engine.FakeEngine(os.path.join(tmp, 'docker.sock'), latency,
+                                    args.default_latency) as engine:
+            docker_env = {'DOCKER_HOST': engine.base_url}
+            client = docker.DockerClient(base_url=engine.base_url)
+            samples = collections.defaultdict(list)
+            bench_inside(client, docker_env, args.number, samples)
+            report("docker-inside (fake engine, {0} runs)".format(args.number), samples)
+            samples = collections.defaultdict(list)
+            bench_setup(client, docker_env, args.number, samples, tmp)
+            report("docker-inside-setup (fake engine, {0} runs)".format(args.number), samples)
+            sys.stdout.write("requests: {0}\n".format(
+                ", ".join("{0}={1}".format(k, v) for k, v in sorted(engine.requests.items()))))
+
+
+def bench_real(args):
+    import dockerinside
+    images = args.images or TEST_IMAGES
+    samples = collections.defaultdict(list)
+    for image in images:
+        for _ in range(args.number):
+            app = dockerinside.DockerInsideApp()
+            start = time.perf_counter()
+            first = None
+            for _stream, _data in app.stream(['--auto-pull', image, '--', 'id', '-u']):
+                if first is None:
+                    first = time.perf_counter() - start
+            if first is not None:
+                samples["{0} first output".format(image)].append(first)
+            samples["{0} total".format(image)].append(time.perf_counter() - start)
+    report("docker-inside time to first output (local daemon, {0} runs)".format(args.number), samples)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=20,
+                        help="Number of launches per measurement")
+    parser.add_argument('--latency', action='append',
+                        help="Fake engine latency per endpoint in seconds (f.e. create=0.05,start=0.1)")
+    parser.add_argument('--default-latency', type=float, default=0.0,
+                        help="Fake engine latency of all other endpoints in seconds")
+    parser.add_argument('--real', action='store_true',
+                        help="Measure time to first output against the local Docker daemon")
+    parser.add_argument('images', nargs='*',
+                        help="Images for --real (default: images of test_user_id_docker)")
+    args = parser.parse_args()
+    if args.real:
+        bench_real(args)
+    else:
+        bench_fake(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""Throughput of the interactive terminal forwarding
+
+By default a fake container (one end of a socketpair) sends SIZE MiB to the
+pump, which forwards it to a pipe drained by another thread. The native pump
+(dockerinside.pump) is compared with the select loop of dockerpty (using its
+Stream/Pump classes, 4096 byte reads). With --real a file is printed with
+`cat` inside a container with tty using docker-inside.
+
+Usage: python benchmarks/bench_pty.py [--size MIB] [--number N]
+       python benchmarks/bench_pty.py --real [--size MIB] [--number N] [IMAGE]
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.realpath(os.path.join(THIS_DIR, '..', 'src')))
+
+CHUNK = 1 << 16
+
+
+def _produce(sock, size):
+    chunk = b"x" * CHUNK
+    left = size
+    while left > 0:
+        n = min(left, CHUNK)
+        sock.sendall(chunk[:n])
+        left -= n
+    sock.close()
+
+
+def _consume(fd, counter):
+    while True:
+        data = os.read(fd, 1 << 20)
+        if not data:
+            break
+        counter[0] += len(data)
+
+
+def native_engine(sock, stdin_fd, stdout_fd):
+    from dockerinside import pump
+    pump.pty_session(sock, stdin_fd, stdout_fd)
+
+
+def dockerpty_engine(sock, stdin_fd, stdout_fd):
+    from dockerpty import io
+    # dockerpty works on file objects (sys.stdin and sys.stdout)
+    stdin = os.fdopen(stdin_fd, 'rb', buffering=0, closefd=False)
+    stdout = os.fdopen(stdout_fd, 'wb', buffering=0, closefd=False)
+    pumps = [
+        io.Pump(io.Stream(stdin), io.Stream(sock), wait_for_output=False),
+        io.Pump(io.Stream(sock), io.Stream(stdout), propagate_close=False),
+    ]
+    flags = [p.set_blocking(False) for p in pumps]
+    try:
+        # main loop of dockerpty.pty.PseudoTerminal._hijack_tty()
+        while True:
+            read_pumps = [p for p in pumps if not p.eof]
+            write_streams = [p.to_stream for p in pumps if p.to_stream.needs_write()]
+            read_ready, write_ready = io.select(read_pumps, write_streams, timeout=60)
+            for write_stream in write_ready:
+                write_stream.do_write()
+            for p in read_ready:
+                p.flush()
+            if all([p.is_done() for p in pumps]):
+                break
+    finally:
+        for p, flag in zip(pumps, flags):
+            io.set_blocking(p, flag)
+
+
+def measure(engine, size):
+    """Forward size bytes through engine and return the elapsed seconds"""
+    container, host = socket.socketpair()
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    counter = [0]
+    producer = threading.Thread(target=_produce, args=(container, size))
+    consumer = threading.Thread(target=_consume, args=(stdout_r, counter))
+    consumer.start()
+    start = time.perf_counter()
+    producer.start()
+    try:
+        engine(host, stdin_r, stdout_w)
+    finally:
+        os.close(stdout_w)
+        host.close()
+    producer.join()
+    consumer.join()
+    elapsed = time.perf_counter() - start
+    for fd in (stdin_r, stdin_w, stdout_r):
+        os.close(fd)
+    assert counter[0] == size, "lost {0} bytes".format(size - counter[0])
+    return elapsed
+
+
+def bench_hermetic(args):
+    engines = [("native", native_engine)]
+    try:
+        import dockerpty  # noqa: F401
+        engines.append(("dockerpty", dockerpty_engine))
+    except ImportError:
+        sys.stderr.write("dockerpty not installed: only measuring the native pump\n")
+    size = args.size << 20
+    sys.stdout.write("{0:<12} {1:>10} {2:>10}\n".format("engine", "best MB/s", "mean MB/s"))
+    for name, engine in engines:
+        rates = [size / 1e6 / measure(engine, size) for _ in range(args.number)]
+        sys.stdout.write("{0:<12} {1:>10.1f} {2:>10.1f}\n".format(name, max(rates), sum(rates) / len(rates)))
+
+
+def bench_real(args):
+    # docker-inside only forwards the terminal if stdin is a tty: use script(1)
+    script = "head -c {0} /dev/zero | tr '\\0' x > /tmp/big && time -p cat /tmp/big".format(args.size << 20)
+    sys.stdout.write("{0:<12} {1:>10}\n".format("engine", "total s"))
+    for engine in ("native", "dockerpty"):
+        cmd = "din --pty-engine {0} {1} -- sh -c \"{2}\"".format(engine, args.image, script)
+        best = None
+        for _ in range(args.number):
+            start = time.perf_counter()
+            subprocess.check_call(['script', '-qec', cmd, '/dev/null'], stdout=subprocess.DEVNULL)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        sys.stdout.write("{0:<12} {1:>10.2f}\n".format(engine, best))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--size', type=int, default=256,
+                        help="MiB to forward per run")
+    parser.add_argument('--number', type=int, default=5,
+                        help="Number of runs per engine")
+    parser.add_argument('--real', action='store_true',
+                        help="Print a large file in a container with tty using the local daemon")
+    parser.add_argument('image', nargs='?', default='alpine:latest',
+                        help="Image for --real")
+    args = parser.parse_args()
+    if args.real:
+        bench_real(args)
+    else:
+        bench_hermetic(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+"""Microbenchmark of dockerutils.tar_pack against the former temp file implementation
+
+Usage: python benchmarks/bench_tar_pack.py [--number N] [--su-exec PATH]
+"""
+import os
+import sys
+import tarfile
+import tempfile
+import timeit
+import argparse
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.realpath(os.path.join(THIS_DIR, '..', 'src')))
+
+import dockerinside  # noqa: E402
+from dockerinside import dockerutils  # noqa: E402
+
+
+def legacy_tar_pack(data, write_mode='w', default_mode=0o640):
+    """tar_pack as of 0.3.18 (temporary files, no memoization)"""
+    def _add_file(archive, name, payload, mode):
+        ti = tarfile.TarInfo(name)
+        ti.uid = 0
+        ti.gid = 0
+        ti.mode = mode
+        ti.uname = "root"
+        ti.gname = "root"
+        with tempfile.TemporaryFile(prefix='docker-file') as f:
+            f.write(payload)
+            f.flush()
+            ti.size = f.tell()
+            f.seek(0)
+            archive.addfile(ti, f)
+
+    with tempfile.TemporaryFile(prefix='docker-archive') as archf:
+        arch = tarfile.open(fileobj=archf, mode=write_mode)
+        for k, v in data.items():
+            if 'mode' not in v:
+                v['mode'] = default_mode
+            if 'file' in v:
+                arch.add(v['file'], arcname=k)
+            else:
+                _add_file(arch, k, v.get('payload', b''), v['mode'])
+        arch.close()
+        archf.flush()
+        archf.seek(0)
+        return archf.read()
+
+
+def _pack_conf(su_exec):
+    conf = {
+        dockerinside.DockerInsideApp.SCRIPT_NAME: {
+            "payload": dockerinside.INSIDE_SCRIPT,
+            "mode": 0o755,
+        }
+    }
+    if su_exec is not None:
+        conf["/bin/su-exec"] = {"file": su_exec, "mode": 0o755}
+    return conf
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', type=int, default=1000,
+                        help="Number of archives to pack per implementation")
+    parser.add_argument('--su-exec',
+                        help="Binary to pack as su-exec (default: 64KiB of random data)")
+    args = parser.parse_args()
+    with tempfile.NamedTemporaryFile(prefix='bench-su-exec') as f:
+        su_exec = args.su_exec
+        if su_exec is None:
+            f.write(os.urandom(64 * 1024))
+            f.flush()
+            su_exec = f.name
+        conf = _pack_conf(su_exec)
+        assert len(dockerutils.tar_pack(conf)) > 0
+        results = [
+            ("legacy (temp files)", lambda: legacy_tar_pack(_pack_conf(su_exec))),
+            ("in-memory, cold", lambda: dockerutils._tar_pack(conf, 'w', 0o640)),
+            ("in-memory, memoized", lambda: dockerutils.tar_pack(conf)),
+        ]
+        print("{0:<24} {1:>12}".format("implementation", "us / pack"))
+        for name, fn in results:
+            t = timeit.timeit(fn, number=args.number)
+            print("{0:<24} {1:>12.1f}".format(name, t * 1e6 / args.number))
+
+
+if __name__ == '__main__':
+    main()
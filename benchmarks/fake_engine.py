@@ -0,0 +1,475 @@
+"""Minimal stand-in for the Docker Engine API on a unix socket
+
+Implements just enough of the API for docker-inside and docker-inside-setup:
+images exist as soon as they are inspected, containers exit immediately
+with status 0 and a configurable output. Session containers (keepalive
+command) keep running and accept exec instances. Every endpoint can be delayed to
+model the latency of a real daemon.
+
+Usage (standalone): python benchmarks/fake_engine.py SOCKET [--latency create=0.05]
+"""
+import io
+import os
+import re
+import sys
+import json
+import time
+import base64
+import tarfile
+import hashlib
+import argparse
+import itertools
+import threading
+import socketserver
+import urllib.parse
+from http.server import BaseHTTPRequestHandler
+
+API_VERSION = "1.41"
+
+# (method, path pattern, endpoint name)
+_ROUTES = [
+    ("GET", r"/_ping", "ping"),
+    ("GET", r"/version", "version"),
+    ("GET", r"/events", "events"),
+    ("GET", r"/images/json", "image_list"),
+    ("POST", r"/images/create", "image_pull"),
+    ("GET", r"/images/(?P<name>.+)/json", "image_inspect"),
+    ("DELETE", r"/images/(?P<name>.+)", "image_remove"),
+    ("POST", r"/commit", "commit"),
+    ("GET", r"/containers/json", "container_list"),
+    ("POST", r"/containers/create", "create"),
+    ("GET", r"/containers/(?P<id>[^/]+)/json", "inspect"),
+    ("PUT", r"/containers/(?P<id>[^/]+)/archive", "put_archive"),
+    ("GET", r"/containers/(?P<id>[^/]+)/archive", "get_archive"),
+    ("POST", r"/containers/(?P<id>[^/]+)/attach", "attach"),
+    ("POST", r"/containers/(?P<id>[^/]+)/start", "start"),
+    ("POST", r"/containers/(?P<id>[^/]+)/wait", "wait"),
+    ("GET", r"/containers/(?P<id>[^/]+)/logs", "logs"),
+    ("POST", r"/containers/(?P<id>[^/]+)/stop", "stop"),
+    ("POST", r"/containers/(?P<id>[^/]+)/kill", "kill"),
+    ("POST", r"/containers/(?P<id>[^/]+)/rename", "rename"),
+    ("POST", r"/containers/(?P<id>[^/]+)/resize", "resize"),
+    ("POST", r"/containers/(?P<id>[^/]+)/exec", "exec_create"),
+    ("POST", r"/exec/(?P<id>[^/]+)/start", "exec_start"),
+    ("GET", r"/exec/(?P<id>[^/]+)/json", "exec_inspect"),
+    ("POST", r"/exec/(?P<id>[^/]+)/resize", "resize"),
+    ("DELETE", r"/containers/(?P<id>[^/]+)", "remove"),
+]
+_COMPILED_ROUTES = [(m, re.compile("^" + p + "$"), n) for m, p, n in _ROUTES]
+_VERSION_PREFIX = re.compile(r"^/v[0-9.]+")
+
+# files a finished container provides via get_archive
+_CONTAINER_FILES = {
+    "/etc/passwd": b"root:x:0:0:root:/root:/bin/sh\n",
+    "/etc/group": b"root:x:0:\n",
+    "/.docker_inside_probe": b"method=su-exec\nbusyboxusr=0\n",
+    "/tmp/out/su-exec": b"\x7fELF fake su-exec\n",
+    "/tmp/out/source.sha256": hashlib.sha256(b"fake").hexdigest().encode('ascii') + b"\n",
+    "/tmp/out/commit": b"0" * 40 + b"\n",
+}
+
+
+def _image_id(name):
+    return "sha256:" + hashlib.sha256(name.encode('utf-8')).hexdigest()
+
+
+def _tar_file(name, payload):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode='w') as arch:
+        ti = tarfile.TarInfo(name)
+        ti.size = len(payload)
+        ti.mode = 0o644
+        arch.addfile(ti, io.BytesIO(payload))
+    return buf.getvalue()
+
+
+def _frame(stream, data):
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, fmt, *args):
+        pass
+
+    def _dispatch(self):
+        url = urllib.parse.urlsplit(self.path)
+        path = _VERSION_PREFIX.sub("", url.path)
+        query = dict(urllib.parse.parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        body = self.rfile.read(length) if length else b""
+        if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+            body = self._read_chunked()
+        for method, pattern, name in _COMPILED_ROUTES:
+            if method != self.command:
+                continue
+            m = pattern.match(path)
+            if m is None:
+                continue
+            engine = self.server.engine
+            engine.record(name)
+            delay = engine.latency.get(name, engine.default_latency)
+            if delay > 0:
+                time.sleep(delay)
+            params = {k: urllib.parse.unquote(v) for k, v in m.groupdict().items()}
+            return getattr(engine, "ep_" + name)(self, params, query, body)
+        self.send_json({"message": "not implemented: {0} {1}".format(self.command, path)}, 404)
+
+    def _read_chunked(self):
+        data = b""
+        while True:
+            size = int(self.rfile.readline().strip() or b"0", 16)
+            if size == 0:
+                self.rfile.readline()
+                return data
+            data += self.rfile.read(size)
+            self.rfile.readline()
+
+    do_GET = do_POST = do_PUT = do_DELETE = do_HEAD = _dispatch
+
+    def send_body(self, payload, status=200, content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Api-Version", API_VERSION)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def send_json(self, data, status=200):
+        self.send_body(json.dumps(data).encode('utf-8'), status)
+
+    def send_stream(self, lines):
+        """Send JSON lines using chunked transfer encoding"""
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i in lines:
+            data = json.dumps(i).encode('utf-8') + b"\n"
+            self.wfile.write("{0:x}\r\n".format(len(data)).encode('ascii') + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+
+class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            socketserver.UnixStreamServer.handle_error(self, request, client_address)
+
+
+class FakeEngine(object):
+    """Fake Docker Engine serving on a unix socket in a background thread
+
+    :param latency: Dictionary of endpoint name (f.e. 'create') to seconds
+    :param default_latency: Latency of all other endpoints
+    :param output: Output (stdout) of every container
+    """
+
+    def __init__(self, path, latency=None, default_latency=0.0, output=b"1000\n"):
+        self.path = path
+        self.latency = dict(latency or {})
+        self.default_latency = default_latency
+        self.output = output
+        self.requests = dict()
+        self._lock = threading.Lock()
+        self._ids = itertools.count()
+        self._containers = dict()
+        self._started = dict()
+        self._execs = dict()
+        self._server = None
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return "unix://" + self.path
+
+    def record(self, name):
+        with self._lock:
+            self.requests[name] = self.requests.get(name, 0) + 1
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._server = _Server(self.path, _Handler)
+        self._server.engine = self
+        self._thread = threading.Thread(target=self._server.serve_forever, name="FakeEngine")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        os.unlink(self.path)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def _find(self, cid):
+        if cid in self._containers:
+            return self._containers[cid]
+        for container in list(self._containers.values()):
+            if container["Name"] == "/" + cid:
+                return container
+        return None
+
+    def _container(self, handler, cid):
+        container = self._find(cid)
+        if container is None:
+            handler.send_json({"message": "No such container: " + cid}, 404)
+        return container
+
+    @staticmethod
+    def _keepalive(container):
+        return (container["Config"].get("Cmd") or [None, None])[1:2] == ["keepalive"]
+
+    def _hijack(self, handler):
+        handler.send_response(101)
+        handler.send_header("Content-Type", "application/vnd.docker.raw-stream")
+        handler.send_header("Connection", "Upgrade")
+        handler.send_header("Upgrade", "tcp")
+        handler.end_headers()
+
+    @staticmethod
+    def _image_attrs(name):
+        return {
+            "Id": _image_id(name),
+            "RepoTags": [name],
+            "Architecture": "amd64",
+            "Config": {
+                "Env": ["PATH=/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/bin"],
+                "Entrypoint": None,
+                "Cmd": ["/bin/sh"],
+                "Labels": {},
+            },
+        }
+
+    def ep_ping(self, handler, params, query, body):
+        handler.send_body(b"OK", content_type="text/plain")
+
+    def ep_version(self, handler, params, query, body):
+        handler.send_json({"ApiVersion": API_VERSION, "MinAPIVersion": "1.12",
+                           "Version": "fake", "Os": "linux", "Arch": "amd64"})
+
+    def ep_events(self, handler, params, query, body):
+        handler.send_stream([])
+
+    def ep_image_list(self, handler, params, query, body):
+        handler.send_json([])
+
+    def ep_image_pull(self, handler, params, query, body):
+        name = "{0}:{1}".format(query.get("fromImage", ""), query.get("tag", "latest"))
+        layer = hashlib.sha256(name.encode('utf-8')).hexdigest()[:12]
+        handler.send_stream([
+            {"status": "Pulling from " + query.get("fromImage", ""), "id": query.get("tag", "latest")},
+            {"status": "Downloading", "progressDetail": {"current": 1 << 20, "total": 1 << 20}, "id": layer},
+            {"status": "Pull complete", "progressDetail": {}, "id": layer},
+            {"status": "Status: Downloaded newer image for " + name},
+        ])
+
+    def ep_image_inspect(self, handler, params, query, body):
+        handler.send_json(self._image_attrs(params["name"]))
+
+    def ep_image_remove(self, handler, params, query, body):
+        handler.send_json([{"Deleted": params["name"]}])
+
+    def ep_commit(self, handler, params, query, body):
+        handler.send_json({"Id": _image_id(query.get("repo", "") + query.get("tag", ""))}, 201)
+
+    @staticmethod
+    def _matches(container, filters):
+        labels = container["Config"]["Labels"]
+        for spec in filters.get("label", []):
+            key, sep, value = spec.partition("=")
+            if key not in labels or (sep and labels[key] != value):
+                return False
+        states = filters.get("status")
+        return not states or container["State"]["Status"] in states
+
+    def ep_container_list(self, handler, params, query, body):
+        filters = json.loads(query.get("filters") or "{}")
+        all_ = query.get("all") in ("1", "true", "True")
+        handler.send_json([{
+            "Id": c["Id"],
+            "Names": [c["Name"]],
+            "Image": c["Image"],
+            "Created": 1577836800,
+            "State": c["State"]["Status"],
+            "Status": c["State"]["Status"],
+            "Labels": c["Config"]["Labels"],
+        } for c in list(self._containers.values())
+            if (all_ or c["State"]["Running"]) and self._matches(c, filters)])
+
+    def ep_create(self, handler, params, query, body):
+        config = json.loads(body.decode('utf-8') or "{}")
+        if "name" in query and self._find(query["name"]) is not None:
+            handler.send_json({"message": "Conflict: name in use"}, 409)
+            return
+        cid = hashlib.sha256("container-{0}".format(next(self._ids)).encode()).hexdigest()
+        self._containers[cid] = {
+            "Id": cid,
+            "Name": "/" + query.get("name", cid[:12]),
+            "Created": "2020-01-01T00:00:00Z",
+            "Image": _image_id(config.get("Image", "")),
+            "Config": dict(config, Tty=bool(config.get("Tty")), Labels=config.get("Labels") or {}),
+            "HostConfig": config.get("HostConfig") or {},
+            "State": {"Status": "created", "Running": False, "ExitCode": 0},
+        }
+        self._started[cid] = threading.Event()
+        handler.send_json({"Id": cid, "Warnings": []}, 201)
+
+    def ep_inspect(self, handler, params, query, body):
+        container = self._container(handler, params["id"])
+        if container is not None:
+            if query.get("size") in ("1", "true", "True"):
+                container = dict(container, SizeRw=4096, SizeRootFs=1 << 20)
+            handler.send_json(container)
+
+    def ep_put_archive(self, handler, params, query, body):
+        if self._container(handler, params["id"]) is not None:
+            handler.send_body(b"")
+
+    def ep_get_archive(self, handler, params, query, body):
+        if self._container(handler, params["id"]) is None:
+            return
+        path = query.get("path", "")
+        if path not in _CONTAINER_FILES:
+            handler.send_json({"message": "Could not find the file " + path}, 404)
+            return
+        payload = _CONTAINER_FILES[path]
+        name = path.rsplit("/", 1)[-1]
+        stat = json.dumps({"name": name, "size": len(payload), "mode": 0o644,
+                           "mtime": "2020-01-01T00:00:00Z", "linkTarget": ""})
+        handler.send_body(_tar_file(name, payload), content_type="application/x-tar", headers={
+            "X-Docker-Container-Path-Stat": base64.b64encode(stat.encode('utf-8')).decode('ascii'),
+        })
+
+    def _output(self, container, query):
+        if query.get("stdout", "1") not in ("1", "true"):
+            return b""
+        output = b"din-session-ready\n" if self._keepalive(container) else self.output
+        if container["Config"]["Tty"]:
+            return output
+        return _frame(1, output)
+
+    def ep_attach(self, handler, params, query, body):
+        container = self._container(handler, params["id"])
+        if container is None:
+            return
+        self._hijack(handler)
+        # the output is sent once the container has been started, stdin is ignored
+        self._started[container["Id"]].wait(10.0)
+        handler.wfile.write(self._output(container, query))
+        handler.close_connection = True
+
+    def ep_start(self, handler, params, query, body):
+        container = self._container(handler, params["id"])
+        if container is None:
+            return
+        if self._keepalive(container):
+            container["State"] = {"Status": "running", "Running": True, "ExitCode": 0}
+        else:
+            container["State"] = {"Status": "exited", "Running": False, "ExitCode": 0}
+        handler.send_body(b"", 204)
+        self._started[container["Id"]].set()
+        if not self._keepalive(container) and container["HostConfig"].get("AutoRemove"):
+            self._containers.pop(container["Id"], None)
+
+    def ep_wait(self, handler, params, query, body):
+        # auto removed containers are gone already: the result is still known
+        handler.send_json({"StatusCode": 0, "Error": None})
+
+    def ep_logs(self, handler, params, query, body):
+        container = self._container(handler, params["id"])
+        if container is None:
+            return
+        handler.send_body(self._output(container, query), content_type="application/vnd.docker.raw-stream")
+
+    def ep_stop(self, handler, params, query, body):
+        if self._container(handler, params["id"]) is not None:
+            handler.send_body(b"", 204)
+
+    ep_kill = ep_stop
+    ep_rename = ep_stop
+
+    def ep_resize(self, handler, params, query, body):
+        handler.send_body(b"")
+
+    def ep_remove(self, handler, params, query, body):
+        container = self._find(params["id"])
+        if container is None:
+            handler.send_json({"message": "No such container: " + params["id"]}, 404)
+        else:
+            self._containers.pop(container["Id"], None)
+            handler.send_body(b"", 204)
+
+    def ep_exec_create(self, handler, params, query, body):
+        container = self._container(handler, params["id"])
+        if container is None:
+            return
+        if not container["State"]["Running"]:
+            handler.send_json({"message": "Container {0} is not running".format(params["id"])}, 409)
+            return
+        config = json.loads(body.decode('utf-8') or "{}")
+        eid = hashlib.sha256("exec-{0}".format(next(self._ids)).encode()).hexdigest()
+        self._execs[eid] = {"ID": eid, "Running": False, "ExitCode": 0,
+                            "ContainerID": container["Id"], "ProcessConfig": config}
+        handler.send_json({"Id": eid}, 201)
+
+    def ep_exec_start(self, handler, params, query, body):
+        exec_info = self._execs.get(params["id"])
+        if exec_info is None:
+            handler.send_json({"message": "No such exec instance: " + params["id"]}, 404)
+            return
+        config = json.loads(body.decode('utf-8') or "{}")
+        self._hijack(handler)
+        # like dockerd, start the process after the upgrade response has been read
+        time.sleep(0.002)
+        handler.wfile.write(self.output if config.get("Tty") else _frame(1, self.output))
+        handler.close_connection = True
+
+    def ep_exec_inspect(self, handler, params, query, body):
+        exec_info = self._execs.get(params["id"])
+        if exec_info is None:
+            handler.send_json({"message": "No such exec instance: " + params["id"]}, 404)
+        else:
+            handler.send_json(exec_info)
+
+
+def parse_latency(specs):
+    """Parse ['create=0.05', ...] to a dictionary of endpoint name to seconds"""
+    latency = dict()
+    for spec in specs or []:
+        for item in spec.split(","):
+            name, _, value = item.partition("=")
+            latency[name.strip()] = float(value)
+    return latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a fake Docker Engine API")
+    parser.add_argument('socket', help="Path of the unix socket")
+    parser.add_argument('--latency', action='append',
+                        help="Per endpoint latency in seconds (f.e. create=0.05,start=0.1)")
+    parser.add_argument('--default-latency', type=float, default=0.0,
+                        help="Latency of all other endpoints in seconds")
+    args = parser.parse_args()
+    engine = FakeEngine(args.socket, parse_latency(args.latency), args.default_latency)
+    engine.start()
+    sys.stderr.write("Fake engine listening on {0}\n".format(engine.base_url))
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        engine.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -59,15 +59,17 @@ setup(
         '': 'src'
     },
     packages=find_packages(where='./src'),
+    scripts=['scripts/din-fast'],
     entry_points={
         'console_scripts': [
-            'din = dockerinside.__init__:main',
-            'docker-inside = dockerinside.__init__:main',
-            'docker_inside = dockerinside.__init__:main',
-            'dockerinside = dockerinside.__init__:main',
-            'din-setup = dockerinside.setup.__init__:setup_main',
-            'docker-inside-setup = dockerinside.setup.__init__:setup_main',
-            'docker_inside_setup = dockerinside.setup.__init__:setup_main',
+            'din = dockerinside:main',
+            'docker-inside = dockerinside:main',
+            'docker_inside = dockerinside:main',
+            'dockerinside = dockerinside:main',
+            'din-setup = dockerinside.setup:setup_main',
+            'docker-inside-setup = dockerinside.setup:setup_main',
+            'docker_inside_setup = dockerinside.setup:setup_main',
+            'din-daemon = dockerinside.daemon:daemon_main',
         ]
     },
     install_requires=[
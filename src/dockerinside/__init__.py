@@ -2,25 +2,37 @@ import os
 import sys
 import pwd
 import grp
+import hashlib
 import logging
 import argparse
 
-import docker
-import docker.errors
-import dockerpty
-
+from . import daemon
 from . import dockerutils
+from . import gui
+from . import pool
+from . import profiles
+from . import session
+from . import startup
+
+docker = dockerutils.LazyModule('docker')
 
 _DEFAULT_LOG_FORMAT = "%(name)s : %(threadName)s : %(levelname)s : %(message)s"
-logging.basicConfig(
-    stream=sys.stderr,
-    format=_DEFAULT_LOG_FORMAT,
-    level=logging.INFO,
-)
+
+
+def configure_logging():
+    logging.basicConfig(
+        stream=sys.stderr,
+        format=_DEFAULT_LOG_FORMAT,
+        level=logging.INFO,
+    )
+
 
 INSIDE_SCRIPT = b"""#!/bin/sh
 
 BUSYBOXUSR=0
+BUSYBOX_APPLETS=""
+PROVISIONED_MARKER="/.docker_inside_provisioned"
+PROBE_FILE="/.docker_inside_probe"
 
 _fail() {
     echo "ERROR: $@" >&2
@@ -48,7 +60,8 @@ _has_busybox_applet() {
 
     [ -n "$applet" ] || { _fail "Missing parameter 'applet'"; }
 
-    busybox --list | grep -F "${applet}" >/dev/null 2>/dev/null
+    [ -n "${BUSYBOX_APPLETS}" ] || BUSYBOX_APPLETS="$(busybox --list 2>/dev/null)"
+    echo "${BUSYBOX_APPLETS}" | grep -F "${applet}" >/dev/null 2>/dev/null
     if [ $? -eq 0 ]; then
         _debug "found applet '${applet}'"
         return 0
@@ -273,15 +286,33 @@ _wrap_debug() {
     return $ret
 }
 
-main() {
-
-    if [ "${DIN_VERBOSE}" = "1" ]; then
-        echo ""
-    fi
+switch_user() {
+    local method="$1"
+
+    case "${method}" in
+        su-exec)
+            exec su-exec "${DIN_USER}" "/docker_inside_inner.sh" ;;
+        su)
+            exec su -c "/docker_inside_inner.sh" "${DIN_USER}" ;;
+        runuser)
+            exec runuser -c "/docker_inside_inner.sh" "${DIN_USER}" ;;
+        busybox-su)
+            exec busybox su -c "/docker_inside_inner.sh" "${DIN_USER}" ;;
+        sudo)
+            exec sudo -u "${DIN_USER}" "/docker_inside_inner.sh" ;;
+    esac
+    _debug "Unknown switch method '${method}'"
+    return 1
+}
 
-    if _try_busybox_usr_applets ; then
+provision() {
+    if [ -n "${DIN_BUSYBOXUSR}" ]; then
+        _debug "Known busybox user applets: ${DIN_BUSYBOXUSR}"
+        BUSYBOXUSR="${DIN_BUSYBOXUSR}"
+    elif _try_busybox_usr_applets ; then
         BUSYBOXUSR=1
     fi
+    PROBED_BUSYBOXUSR="${BUSYBOXUSR}"
 
     _debug "BUSYBOXUSR is ${BUSYBOXUSR}"
     _debug "Current user: $(id -u)"
@@ -336,6 +367,26 @@ main() {
         fi
     done
 
+    touch "${PROVISIONED_MARKER}"
+}
+
+main() {
+
+    if [ "${DIN_VERBOSE}" = "1" ]; then
+        echo ""
+    fi
+
+    if [ -e "${PROVISIONED_MARKER}" ]; then
+        _debug "User ${DIN_USER} has already been provisioned"
+    else
+        provision
+    fi
+
+    if [ "${PROVISION_ONLY}" = "1" ]; then
+        _debug "Provisioning finished"
+        exit 0
+    fi
+
     _debug "Original entrypoint: ${DIN_ENTRYPOINT}"
     _debug "Inner command: $@"
     echo "#!/bin/sh" > /docker_inside_inner.sh
@@ -349,21 +400,38 @@ main() {
         chmod 0700 "/home/${DIN_USER}"
     fi
 
+    if [ -n "${DIN_SWITCH_METHOD}" ]; then
+        _debug "Known switch method: ${DIN_SWITCH_METHOD}"
+        switch_user "${DIN_SWITCH_METHOD}"
+    fi
+
+    local method=""
     if try_su_exec ; then
-        exec su-exec "${DIN_USER}" "/docker_inside_inner.sh"
+        method="su-exec"
     elif try_su ; then
-        exec su -c "/docker_inside_inner.sh" "${DIN_USER}"
+        method="su"
     elif try_runuser ; then
-        exec runuser -c "/docker_inside_inner.sh" "${DIN_USER}"
+        method="runuser"
     elif try_busybox_su ; then
-        exec busybox su -c "/docker_inside_inner.sh" "${DIN_USER}"
+        method="busybox-su"
     elif try_sudo ; then
-        exec sudo -u "${DIN_USER}" "/docker_inside_inner.sh"
+        method="sudo"
     else
         _fail "Couldn't switch user: su-exec, su, runuser and busybox su seem to be unavailable"
     fi
+
+    # report the result, so the host can skip probing next time
+    printf "method=%s\\nbusyboxusr=%s\\n" "${method}" "${PROBED_BUSYBOXUSR}" > "${PROBE_FILE}"
+    switch_user "${method}"
 }
 
+# passed as argument, so it isn't committed with the environment of a prepared image
+PROVISION_ONLY=0
+if [ "$1" = "--din-provision-only" ]; then
+    PROVISION_ONLY=1
+    shift
+fi
+
 main $@
 """
 
@@ -371,6 +439,17 @@ main $@
 class DockerInsideApp(dockerutils.BasicDockerApp):
     SCRIPT_NAME = "docker_inside.sh"
     X11_SOCKET = "/tmp/.X11-unix"
+    PREPARED_REPOSITORY = "docker-inside-prepared"
+    PREPARED_BASE_LABEL = dockerutils.LABEL_PREFIX + "prepared.base"
+    PREPARED_SOURCE_LABEL = dockerutils.LABEL_PREFIX + "prepared.source"
+    IDENTITY_ENV = ("DIN_UID", "DIN_USER", "DIN_GID", "DIN_GROUP", "DIN_GROUPS")
+    PROBE_FILE = "/.docker_inside_probe"
+    PROVISION_ONLY_ARG = "--din-provision-only"
+    # arguments which don't influence the launch plan
+    PLAN_IGNORED_ARGS = ('cmd', 'args', 'name', 'loglevel', 'refresh_groups', 'timings',
+                         'timings_format', 'request_budget', 'profile_startup')
+    # creation arguments set per invocation
+    PLAN_INVOCATION_KWARGS = ('command', 'name', 'tty', 'stdin_open', 'auto_remove')
 
     @staticmethod
     def _add_docker_run_options(parser):
@@ -429,6 +508,11 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
                             action='store_true',
                             default=False,
                             help="Prepare settings for GUI applications (DISPLAY, X11)")
+        parser.add_argument('--gui-shm',
+                            action='store_true',
+                            default=False,
+                            help="Share the IPC namespace of the host, so X11 clients can use MIT-SHM "
+                                 "if the X server supports it (implies --gui)")
         parser.add_argument('--name',
                             help="Name of the container")
         parser.add_argument('-v', '--volume',
@@ -463,6 +547,90 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
                             action="store_false",
                             default=True,
                             help="Disable usage of su-exec binary (if available)")
+        parser.add_argument('--no-image-cache',
+                            dest='image_cache',
+                            action="store_false",
+                            default=True,
+                            help="Don't use the on-disk image metadata cache")
+        parser.add_argument('--no-history',
+                            dest='history',
+                            action="store_false",
+                            default=True,
+                            help="Don't record the image in the usage history")
+        parser.add_argument('--history-refresh',
+                            dest='history_refresh',
+                            type=int,
+                            default=3600,
+                            metavar="SECONDS",
+                            help="With --auto-pull, pull the most used images in the background if "
+                                 "they haven't been refreshed for SECONDS (0: never, default: 3600)")
+        parser.add_argument('--no-switch-cache',
+                            dest='switch_cache',
+                            action="store_false",
+                            default=True,
+                            help="Always probe how to switch the user inside the container")
+        parser.add_argument('--merge-passwd',
+                            action="store_true",
+                            default=False,
+                            help="Add user and groups to /etc/passwd and /etc/group on the host side")
+        parser.add_argument('--groups-ttl',
+                            type=float,
+                            default=3600.0,
+                            metavar='SECONDS',
+                            help="Reuse the cached groups of the user for SECONDS, 0 disables the cache "
+                                 "(default: 3600)")
+        parser.add_argument('--refresh-groups',
+                            action="store_true",
+                            default=False,
+                            help="Resolve the groups of the user again")
+        parser.add_argument('--timings',
+                            metavar='FILE',
+                            help="Write timings of the launch phases to FILE ('-' for stderr)")
+        parser.add_argument('--timings-format',
+                            choices=dockerutils.Timings.FORMATS,
+                            default='jsonl',
+                            help="JSON lines (appended) or trace event file (default: jsonl)")
+        parser.add_argument('-i', '--interactive',
+                            action='store_true',
+                            default=False,
+                            help="Forward stdin into the container if it isn't a terminal")
+        parser.add_argument('--pty-engine',
+                            choices=('native', 'dockerpty'),
+                            default='native',
+                            help="Terminal forwarding of interactive sessions (default: native)")
+        parser.add_argument('--request-budget',
+                            type=int,
+                            metavar='N',
+                            help="Warn if a launch makes more than N Docker API requests")
+        parser.add_argument('--profile-startup',
+                            action="store_true",
+                            default=False,
+                            help="Report import and setup times to stderr (use din-fast to "
+                                 "include the import of docker-inside itself)")
+        parser.add_argument('--prepare-image',
+                            action="store_true",
+                            default=False,
+                            help="Commit the provisioned user setup as local image and reuse it")
+        parser.add_argument('--session',
+                            action="store_true",
+                            default=False,
+                            help="Run the command through exec in a persistent container of this "
+                                 "configuration")
+        parser.add_argument('--session-idle',
+                            type=float,
+                            default=900.0,
+                            metavar='SECONDS',
+                            help="Stop a session container after SECONDS without commands (default: 900)")
+        parser.add_argument('--pool',
+                            type=int,
+                            default=0,
+                            metavar='SIZE',
+                            help="Keep SIZE pre-created containers per configuration (default: 0)")
+        parser.add_argument('--pool-max-age',
+                            type=float,
+                            default=3600.0,
+                            metavar='SECONDS',
+                            help="Evict pooled containers older than SECONDS (default: 3600)")
         parser.add_argument('image',
                             help="The image to run")
         parser.add_argument('cmd',
@@ -474,13 +642,24 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
         cls._add_docker_run_options(parser)
         parser.set_defaults(loglevel=logging.INFO)
         args = parser.parse_args(args=argv)
+        args.gui = args.gui or args.gui_shm
         return args
 
-    def __init__(self, env=None):
+    def __init__(self, env=None, client=None):
         log = logging.getLogger("DockerInside")
-        dockerutils.BasicDockerApp.__init__(self, log, env)
+        dockerutils.BasicDockerApp.__init__(self, log, env, client)
         self._args = None
         self._cobj = None
+        self._returncode = None
+        self._tty = True
+        self._stdio = False
+        self._stdin = False
+        self._pool_refill = None
+        self._auto_remove = False
+        self._exited = False
+        self._switch_probe = None
+        self._output = None
+        self._profile_name = None
 
     def _adapt_log_level(self):
         if not self._args.debug:
@@ -492,7 +671,9 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
         gid = os.getgid()
         username = pwd.getpwuid(uid).pw_name
         groupname = grp.getgrgid(gid).gr_name
-        groups = dockerutils.get_user_groups(username)
+        with self.timings.span("groups"):
+            groups = dockerutils.cached_user_groups(username, gid, self._args.groups_ttl,
+                                                    refresh=self._args.refresh_groups)
         self._log.debug("User account {0} ({1})".format(username, uid))
         self._log.debug("Main group {0} ({1})".format(groupname, gid))
         groups_txt = ",".join([i.gr_name for i in groups])
@@ -541,35 +722,289 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
             self._log.debug("container command: {0}".format(" ".join(cmd)))
         return cmd
 
-    def _inside(self):
-        """Run container with user environment"""
-        self._assert_image_available(self._args.image, self._args.auto_pull)
-        image_info = self._dc.images.get(self._args.image).attrs
+    def _su_exec_path(self):
+        suexec = os.path.join(dockerutils.config_dir(), 'su-exec')
+        if not os.path.exists(suexec):
+            self._log.debug("su-exec binary not found")
+            return None
+        self._log.debug("su-exec binary was found")
+        if not self._args.su_exec:
+            self._log.debug("su-exec is disabled via cli switch")
+            return None
+        return suexec
+
+    def _pack_config(self, suexec):
         pack_conf = {
             self.SCRIPT_NAME: {
                 "payload": INSIDE_SCRIPT,
                 "mode": 0o755,
             }
         }
+        if suexec is not None:
+            pack_conf.update({
+                "/bin/su-exec": {
+                    "file": suexec,
+                    "mode": 0o755,
+                }
+            })
+        return pack_conf
+
+    def _fetch_file(self, cobj, path):
+        try:
+            chunks, _ = cobj.get_archive(path)
+        except docker.errors.NotFound:
+            self._log.debug("File {0} doesn't exist in the image".format(path))
+            return None, None
+        payload, info = dockerutils.tar_unpack_file(chunks)
+        if payload is None:
+            return None, None
+        return payload.decode('utf-8', 'surrogateescape'), info
+
+    def _merged_identity_files(self, cobj, env):
+        """Pack configuration of /etc/passwd and /etc/group including the user
+
+        Returns an empty configuration if the files couldn't be read, so the
+        entrypoint falls back to provisioning the user itself.
+        """
+        passwd, passwd_info = self._fetch_file(cobj, "/etc/passwd")
+        group, group_info = self._fetch_file(cobj, "/etc/group")
+        if passwd is None or group is None:
+            self._log.warning("Couldn't read /etc/passwd and /etc/group: fall back to entrypoint")
+            return {}
+        user = env["DIN_USER"]
+        groups = [i.rsplit(",", 1) for i in env["DIN_GROUPS"].split("\n") if i]
+        passwd, added = dockerutils.merge_passwd(passwd, user, env["DIN_UID"], env["DIN_GID"],
+                                                 dockerutils.linux_pjoin("/home", user))
+        group = dockerutils.merge_group(group, user, (env["DIN_GROUP"], env["DIN_GID"]), groups)
+        files = {
+            "etc/passwd": (passwd, passwd_info),
+            "etc/group": (group, group_info),
+        }
+        if added:
+            shadow, shadow_info = self._fetch_file(cobj, "/etc/shadow")
+            if shadow is not None:
+                files["etc/shadow"] = (dockerutils.merge_shadow(shadow, user), shadow_info)
+        pack_conf = {
+            ".docker_inside_provisioned": {
+                "payload": b"",
+                "mode": 0o644,
+            }
+        }
+        for name, (text, info) in files.items():
+            pack_conf[name] = {
+                "payload": text.encode('utf-8', 'surrogateescape'),
+                "mode": info.mode,
+                "gid": info.gid,
+            }
+        self._log.debug("Merged user {0} into {1}".format(user, ", ".join(sorted(files))))
+        return pack_conf
+
+    def _prepared_image_key(self, image_info, env, suexec):
+        identity = [env[i] for i in self.IDENTITY_ENV]
+        suexec_digest = '' if suexec is None else dockerutils.file_digest(suexec)
+        return dockerutils.hash_key(image_info["Id"], identity, suexec_digest)
+
+    def _evict_prepared_images(self, image_info):
+        source_filter = "{0}={1}".format(self.PREPARED_SOURCE_LABEL, self._args.image)
+        for img in self._dc.images.list(filters={'label': source_filter}):
+            base = img.labels.get(self.PREPARED_BASE_LABEL)
+            if base is None or base == image_info["Id"]:
+                continue
+            self._log.debug("Evict stale prepared image {0} (base {1})".format(img.id, base))
+            try:
+                self._dc.images.remove(img.id)
+            except docker.errors.APIError as e:
+                self._log.debug("Couldn't remove prepared image {0}: {1}".format(img.id, e))
+
+    @staticmethod
+    def _prepared_image_env(image_env, env):
+        """Environment of a prepared image
+
+        The daemon adds all variables of the container to the committed
+        environment unless they are given, so the variables of the
+        provisioning are committed empty.
+        """
+        image_env = list(image_env or [])
+        names = set(i.split("=", 1)[0] for i in image_env)
+        return image_env + ["{0}=".format(k) for k in sorted(env) if k not in names]
+
+    def _prepared_image(self, image_info, env, suexec):
+        """Return a derived image with the user environment already provisioned
+
+        The image gets committed on first usage and is reused as long as the
+        base image, the user identity and su-exec don't change.
+        """
+        key = self._prepared_image_key(image_info, env, suexec)
+        image_ref = "{0}:{1}".format(self.PREPARED_REPOSITORY, key[:32])
+        try:
+            self._dc.images.get(image_ref)
+            self._log.debug("Use prepared image {0}".format(image_ref))
+            return image_ref
+        except docker.errors.ImageNotFound:
+            self._log.info("Prepare image {0} for {1}".format(image_ref, self._args.image))
+        cobj = self._dc.containers.create(
+            self._args.image,
+            environment=env,
+            entrypoint=dockerutils.linux_pjoin('/', self.SCRIPT_NAME),
+            command=[self.PROVISION_ONLY_ARG],
+            user="0" if self._args.switch_root else None,
+            labels=dockerutils.ownership_labels(),
+        )
+        try:
+            cobj.put_archive('/', dockerutils.tar_pack(self._pack_config(suexec)))
+            cobj.start()
+            ret = cobj.wait()
+            if ret['StatusCode'] != 0:
+                self._log.error("Provisioning failed: {0}".format(cobj.logs().decode('utf-8', 'replace')))
+                raise dockerutils.ContainerError(cobj.id, "Provisioning failed")
+            config = image_info.get("Config") or {}
+            cobj.commit(
+                repository=self.PREPARED_REPOSITORY,
+                tag=key[:32],
+                message="docker-inside user provisioning",
+                conf={
+                    "Env": self._prepared_image_env(config.get("Env"), env),
+                    "User": config.get("User") or "",
+                    "Entrypoint": config.get("Entrypoint"),
+                    "Cmd": config.get("Cmd"),
+                    "Labels": {
+                        self.PREPARED_BASE_LABEL: image_info["Id"],
+                        self.PREPARED_SOURCE_LABEL: self._args.image,
+                    },
+                }
+            )
+        finally:
+            cobj.remove(force=True)
+        self._evict_prepared_images(image_info)
+        return image_ref
+
+    def _apply_switch_cache(self, image_info, env, suexec):
+        """Pass the known user switch method or arrange to record it"""
+        key = dockerutils.hash_key(image_info["Id"], suexec is not None, self._args.switch_root)
+        with self.timings.span("switch_cache"):
+            entry = dockerutils.SwitchCache(self._log).get(key)
+        if entry is None:
+            self._log.debug("User switch method of the image is unknown -> probe")
+            self._switch_probe = key
+            self._auto_remove = False  # the probe result is read after exit
+            return
+        self._log.debug("Known user switch method: {0}".format(entry["method"]))
+        env["DIN_SWITCH_METHOD"] = entry["method"]
+        if entry.get("busyboxusr") is not None:
+            env["DIN_BUSYBOXUSR"] = entry["busyboxusr"]
+
+    def _record_switch_probe(self, cobj):
+        key, self._switch_probe = self._switch_probe, None
+        try:
+            with self.timings.span("switch_probe"):
+                text, _ = self._fetch_file(cobj, self.PROBE_FILE)
+        except docker.errors.APIError as e:
+            self._log.debug("Couldn't read the probe result: {0}".format(e))
+            return
+        if text is None:
+            return
+        probe = dockerutils.SwitchCache.parse_probe(text)
+        if probe.get("method"):
+            self._log.debug("Detected user switch method: {0}".format(probe["method"]))
+            dockerutils.SwitchCache(self._log).put(key, probe["method"], probe.get("busyboxusr"))
+
+    def _inside(self):
+        """Run container with user environment"""
+        if self._args.session:
+            self._session()
+            return
+        self._create()
+        self._start()
+
+    def _record_usage(self, image_info):
+        """Add the image to the usage history and refresh the most used images if due"""
+        img, tag = self.normalize_image(self._args.image)
+        history = dockerutils.UsageHistory(self._log)
+        with self.timings.span("history"):
+            history.record(self.combine_image_spec(img, tag), image_info["Id"])
+            refresh = (self._args.auto_pull and self._args.history_refresh > 0 and
+                       history.claim_refresh(self._args.history_refresh))
+        if refresh:
+            from . import prefetch
+            env = None if self._env is None else {k: v for k, v in self._env.items()
+                                                  if k.startswith("DOCKER_")}
+            if prefetch.spawn_refresh(env=env):
+                self._log.debug("Refreshing the most used images in the background")
+
+    def _plan_key(self, suexec):
+        """Digest of everything a launch plan depends on besides the image id"""
+        args = {k: v for k, v in vars(self._args).items() if k not in self.PLAN_IGNORED_ARGS}
+        suexec_stat = None
+        if suexec is not None:
+            st = os.stat(suexec)
+            suexec_stat = (st.st_size, st.st_ino, st.st_mtime_ns)
+        host = (os.getuid(), os.getgid(), os.path.expanduser('~'), os.environ.get("DISPLAY"),
+                os.path.exists(self.X11_SOCKET))
+        env = list(dockerutils.env_list_to_dict(self._args.env, self._env))
+        return dockerutils.hash_key(self._profile_name, args, host, env, suexec_stat,
+                                    INSIDE_SCRIPT.decode('utf-8'))
+
+    def _apply_plan(self, plan, image_info, suexec):
+        creation_kwargs = dict(plan["creation_kwargs"])
+        creation_kwargs.update(
+            command=self._prepare_command(image_info),
+            name=self._args.name,
+            tty=self._tty,
+            stdin_open=self._tty or self._stdin,
+            auto_remove=self._auto_remove,
+        )
+        # the environment is adapted in place (f.e. for sessions), keep both in sync
+        env = creation_kwargs["environment"] = plan["env"]
+        pack_conf = self._pack_config(suexec)
+        dockerutils.remember_tar_pack(pack_conf, plan["archive"])
+        return plan["image"], creation_kwargs, pack_conf, env
+
+    def _launch_config(self):
+        """Prepare the creation of the container
+
+        Launches of a profile use the stored launch plan if it's valid for
+        the image and store a new one otherwise.
+
+        :returns: Tuple (image, creation_kwargs, pack_conf, env)
+        """
+        if self._args.image_cache:
+            self._image_cache = dockerutils.ImageCache(self._dc, self._log)
+        image_info = self._inspect_image(self._args.image, self._args.auto_pull)
+        if self._args.history:
+            self._record_usage(image_info)
+        suexec = self._su_exec_path()
+        plans = None
+        # prepared images may be evicted, so they are looked up every time
+        if self._profile_name is not None and not self._args.prepare_image:
+            plans = profiles.LaunchPlans(self._log)
+            with self.timings.span("plan"):
+                key = self._plan_key(suexec)
+                plan = None
+                if not self._args.refresh_groups:
+                    plan = plans.get(key, image_info["Id"], self._args.groups_ttl)
+            if plan is not None:
+                self._log.debug("Using launch plan {0} of profile {1}".format(key, self._profile_name))
+                return self._apply_plan(plan, image_info, suexec)
+        image, creation_kwargs, pack_conf, env = self._compile_launch_config(image_info, suexec)
+        # plans embed the user switch method, so wait until it's known
+        if plans is not None and self._switch_probe is None:
+            kwargs = {k: v for k, v in creation_kwargs.items() if k not in self.PLAN_INVOCATION_KWARGS}
+            plans.put(key, image_info["Id"], image, kwargs, env, dockerutils.tar_pack(pack_conf))
+        return image, creation_kwargs, pack_conf, env
+
+    def _compile_launch_config(self, image_info, suexec):
         home_dir = os.path.expanduser('~')
-        suexec = os.path.join(home_dir, '.config', 'docker_inside', 'su-exec')
-        if os.path.exists(suexec):
-            self._log.debug("su-exec binary was found")
-            if self._args.su_exec:
-                pack_conf.update({
-                    "/bin/su-exec": {
-                        "file": suexec,
-                        "mode": 0o755,
-                    }
-                })
-            else:
-                self._log.debug("su-exec is disabled via cli switch")
-        else:
-            self._log.debug("su-exec binary not found")
-        script_pack = dockerutils.tar_pack(pack_conf)
         ports = dict(dockerutils.port_list_to_dict(self._args.ports))
         env = self._prepare_environment(image_info)
         cmd = self._prepare_command(image_info)
+        if self._args.switch_cache:
+            self._apply_switch_cache(image_info, env, suexec)
+        image = self._args.image
+        if self._args.prepare_image:
+            with self.timings.span("prepare_image"):
+                image = self._prepared_image(image_info, env, suexec)
+            suexec = None  # already part of the prepared image
+        pack_conf = self._pack_config(suexec)
         volumes = self.volume_args_to_list(self._args.volumes)
         workdir = self._args.workdir
         if self._args.mount_workdir:
@@ -606,48 +1041,382 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
             ports=ports,
             working_dir=workdir,
             shm_size=self._args.shm_size,
-            tty=True,
-            stdin_open=True,
+            tty=self._tty,
+            stdin_open=self._tty or self._stdin,
             init=self._args.init,
+            auto_remove=self._auto_remove,
         )
         if self._args.switch_root:
             creation_kwargs['user'] = "0"
         if self._args.tmpfs:
             creation_kwargs['tmpfs'] = dockerutils.tmpfs_list_to_dict(self._args.tmpfs)
-        self._cobj = self._dc.containers.create(self._args.image, **creation_kwargs)
-        self._cobj.put_archive('/', script_pack)
-        self._start()
+        if self._args.gui:
+            creation_kwargs.update(self._gui_settings(env))
+        return image, creation_kwargs, pack_conf, env
+
+    def _gui_settings(self, env):
+        """Creation arguments for X11 clients with --gui-shm
+
+        The container shares the IPC namespace of the host unless the X
+        server is known not to support MIT-SHM. Otherwise MIT-SHM is disabled
+        and /dev/shm is enlarged (browsers and Electron apps use it for
+        rendering). Plain --gui keeps the defaults of docker.
+        """
+        if not self._args.gui_shm:
+            return {}
+        with self.timings.span("gui_probe"):
+            supported = gui.mit_shm_supported(env.get("DISPLAY", ''), self._log)
+        if supported is not False:
+            if self._args.shm_size:
+                self._log.warning("--shm-size doesn't apply, /dev/shm of the host is shared")
+            self._log.debug("Share the IPC namespace of the host for MIT-SHM")
+            return {'ipc_mode': 'host', 'shm_size': None}
+        self._log.warning("X server doesn't support MIT-SHM -> don't share IPC")
+        for key, value in gui.NO_MITSHM_ENV.items():
+            env.setdefault(key, value)
+        return {'shm_size': self._args.shm_size or gui.DEFAULT_SHM_SIZE}
+
+    def _create(self):
+        """Create the container with user environment"""
+        image, creation_kwargs, pack_conf, env = self._launch_config()
+        if self._args.pool > 0:
+            self._cobj = self._claim_pooled(image, creation_kwargs, pack_conf, env)
+        if self._cobj is None:
+            self._cobj = self._create_container(image, creation_kwargs, pack_conf, env)
+
+    def _create_container(self, image, creation_kwargs, pack_conf, env):
+        with self.timings.span("tar_pack"):
+            archive = dockerutils.tar_pack(pack_conf)
+        kwargs = {k: v for k, v in creation_kwargs.items()
+                  if k not in self.PLAN_INVOCATION_KWARGS and k != 'labels'}
+        plan = dockerutils.hash_key(image, kwargs, hashlib.sha256(archive).hexdigest())
+        kwargs = dict(creation_kwargs)
+        kwargs['labels'] = dict(dockerutils.ownership_labels(plan), **(creation_kwargs.get('labels') or {}))
+        with self.timings.span("create"):
+            cobj = self._dc.containers.create(image, **kwargs)
+        try:
+            if self._args.merge_passwd and not self._args.prepare_image:
+                pack_conf = dict(pack_conf)
+                with self.timings.span("merge_passwd"):
+                    pack_conf.update(self._merged_identity_files(cobj, env))
+                with self.timings.span("tar_pack"):
+                    archive = dockerutils.tar_pack(pack_conf)
+            with self.timings.span("put_archive"):
+                cobj.put_archive('/', archive)
+        except BaseException:
+            # the container isn't known to the caller yet
+            try:
+                cobj.remove(force=True)
+            except docker.errors.APIError as e:
+                self._log.debug("Couldn't remove container {0}: {1}".format(cobj.id, e))
+            raise
+        return cobj
+
+    def _claim_pooled(self, image, creation_kwargs, pack_conf, env):
+        """Claim a pre-created container and refill the pool in the background"""
+        container_pool = pool.ContainerPool(self._dc, self._log, self._args.pool,
+                                            self._args.pool_max_age)
+        key = container_pool.pool_key(image, creation_kwargs, dockerutils.tar_pack(pack_conf))
+        with self.timings.span("pool_claim"):
+            cobj = container_pool.claim(key, self._args.name)
+
+        def _factory(name, labels):
+            kwargs = dict(creation_kwargs, name=name)
+            kwargs['labels'] = dict(kwargs.get('labels') or {}, **labels)
+            return self._create_container(image, kwargs, pack_conf, env)
+
+        self._pool_refill = container_pool.refill_async(key, _factory)
+        return cobj
 
     @staticmethod
     def _isatty():
         return os.isatty(sys.stdin.fileno())
 
+    def _register_wait(self):
+        """Return a function waiting for the container to exit
+
+        Must be called before the container is started: with auto remove the
+        wait has to be registered before the container disappears.
+        """
+        if self._auto_remove:
+            return dockerutils.register_wait(self._dc.api, self._cobj.id, 'removed')
+        return self._cobj.wait
+
+    def _finish(self, wait):
+        with self.timings.span("wait"):
+            ret = wait()
+        self._exited = True
+        self._returncode = ret['StatusCode']
+        self._log.info("Container {0} stopped and returned {1}".format(self._cobj.id,
+                                                                       self._returncode))
+        if self._switch_probe is not None:
+            self._record_switch_probe(self._cobj)
+
+    def _pty_session(self):
+        """Forward the terminal to the container using the native pump
+
+        :returns: False if the connection to the daemon can't be used by the
+                  pump (f.e. TLS), the container isn't started in that case
+        """
+        from . import pump
+        sock = self._dc.api.attach_socket(self._cobj.id, params={
+            'stdin': 1,
+            'stdout': 1,
+            'stderr': 1,
+            'stream': 1,
+        })
+        try:
+            raw = pump.attach_socket(sock)
+            if raw is None:
+                self._log.debug("Attach socket can't be used by the native pump -> dockerpty")
+                return False
+            self._cobj.start()
+
+            def _resize(rows, columns):
+                try:
+                    self._dc.api.resize(self._cobj.id, height=rows, width=columns)
+                except docker.errors.APIError:
+                    pass  # container has already exited
+
+            pump.pty_session(raw, sys.stdin.fileno(), sys.stdout.fileno(), on_resize=_resize)
+        finally:
+            sock.close()
+        return True
+
+    @staticmethod
+    def _write_fd(fd, data):
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]
+
+    def _stdio_session(self):
+        """Stream the output of the container to stdout and stderr (and stdin into it with -i)"""
+        from . import pump
+        params = {
+            'stdin': 1 if self._stdin else 0,
+            'stdout': 1,
+            'stderr': 1,
+            'stream': 1,
+        }
+        with self.timings.span("attach"):
+            sock = self._dc.api.attach_socket(self._cobj.id, params=params)
+        try:
+            raw = pump.attach_socket(sock)
+            if raw is None and self._stdin:
+                # closing the socket ends the input of the container
+                self._log.warning("Input isn't forwarded over this connection to the daemon")
+                sock.close()
+                sock = self._dc.api.attach_socket(self._cobj.id, params=dict(params, stdin=0))
+            self._cobj.start()
+            if raw is None:
+                from docker.utils import socket as docker_socket
+                fds = {dockerutils.STDOUT: 1, dockerutils.STDERR: 2}
+                for stream, data in dockerutils.demux_stream(lambda n: docker_socket.read(sock, n)):
+                    self._write_fd(fds.get(stream, fds[dockerutils.STDOUT]), data)
+            elif not pump.stdio_session(raw, stdin_fd=0 if self._stdin else None):
+                self._log.debug("Output has been closed -> stop container")
+                try:
+                    self._cobj.kill(signal='SIGPIPE')
+                except docker.errors.APIError:
+                    pass  # container has already exited
+        finally:
+            sock.close()
+
     def _start(self):
+        wait = self._register_wait()
         self._log.info("Starting container: {0}".format(self._cobj.id))
         if self._isatty():
-            dockerpty.start(self._dc.api, self._cobj.id)
+            with self.timings.span("session"):
+                if self._args.pty_engine != 'native' or not self._pty_session():
+                    import dockerpty
+                    dockerpty.start(self._dc.api, self._cobj.id)
+        elif self._stdio:
+            with self.timings.span("session"):
+                self._stdio_session()
         else:
-            self._cobj.start()
-        ret = self._cobj.wait()
-        self._log.info("Container {0} stopped and returned {1}".format(self._cobj.id,
-                                                                       ret['StatusCode']))
+            with self.timings.span("start"):
+                self._cobj.start()
+        self._finish(wait)
+
+    def _exec_session(self, exec_id, tty):
+        """Forward stdio to a started exec instance"""
+        if self._args.pty_engine != 'native':
+            import dockerpty
+            dockerpty.start_exec(self._dc.api, exec_id)
+            return
+        from . import pump
+        sock = self._dc.api.exec_start(exec_id, tty=tty, socket=True)
+        try:
+            raw = pump.attach_socket(sock)
+            if raw is None:
+                raise RuntimeError("Connection to the daemon can't be used by the native pump: "
+                                   "use --pty-engine dockerpty")
+            if tty:
+                def _resize(rows, columns):
+                    try:
+                        self._dc.api.exec_resize(exec_id, height=rows, width=columns)
+                    except docker.errors.APIError:
+                        pass  # command has already exited
+
+                pump.pty_session(raw, sys.stdin.fileno(), sys.stdout.fileno(), on_resize=_resize)
+            elif not pump.stdio_session(raw, stdin_fd=0 if self._stdin else None):
+                self._log.debug("Output has been closed")
+        finally:
+            sock.close()
+
+    @staticmethod
+    def _session_config(image, creation_kwargs, pack_conf, env):
+        """Adapt the launch configuration to a session container
+
+        The keepalive runs without the entrypoint of the image, the commands
+        through it. env has to be the environment of creation_kwargs.
+
+        :returns: Tuple (command, pack_conf, session key)
+        """
+        entrypoint = env.pop("DIN_ENTRYPOINT", None)
+        if isinstance(entrypoint, str):
+            entrypoint = [entrypoint]
+        cmd = list(entrypoint or []) + list(creation_kwargs['command'] or [])
+        pack_conf = dict(pack_conf, **session.Session.pack_config())
+        key = session.Session.session_key(image, creation_kwargs, dockerutils.tar_pack(pack_conf))
+        return cmd, pack_conf, key
+
+    def _session(self):
+        """Run the command through exec in the session container of the configuration"""
+        image, creation_kwargs, pack_conf, env = self._launch_config()
+        cmd, pack_conf, key = self._session_config(image, creation_kwargs, pack_conf, env)
+        sess = session.Session(self._dc, self._log, key)
+        # --switch-root only concerns the entrypoint of the keepalive
+        user = env["DIN_USER"]
+
+        def _factory(name, labels):
+            kwargs = dict(creation_kwargs, name=name, tty=False, stdin_open=False, auto_remove=True,
+                          command=sess.keepalive_command(self._args.session_idle))
+            kwargs['labels'] = dict(kwargs.get('labels') or {}, **labels)
+            return self._create_container(image, kwargs, pack_conf, env)
+
+        tty = self._isatty()
+        capture = not tty and not self._stdio
+        for attempt in range(2):
+            try:
+                with self.timings.span("exec_create"):
+                    exec_id = sess.exec_create(cmd, user, tty=tty, stdin=tty or self._stdin,
+                                               stderr=not capture)
+                break
+            except docker.errors.APIError as e:
+                # no session (404) or it's just stopping (409)
+                if attempt > 0 or e.status_code not in (404, 409):
+                    raise
+            self._log.info("Starting session container {0}".format(sess.name))
+            with self.timings.span("session_start"):
+                cobj = sess.start(_factory)
+            if cobj is not None and self._switch_probe is not None:
+                self._record_switch_probe(cobj)
+        self._log.info("Running in session container {0}".format(sess.name))
+        with self.timings.span("session"):
+            if capture:
+                self._output = self._dc.api.exec_start(exec_id)
+            else:
+                self._exec_session(exec_id, tty)
+        with self.timings.span("wait"):
+            self._returncode = self._dc.api.exec_inspect(exec_id)['ExitCode']
+        self._log.info("Command in session {0} returned {1}".format(sess.name, self._returncode))
+
+    @property
+    def returncode(self):
+        """Exit code of the last container (None if it didn't run)"""
+        return self._returncode
 
     def cleanup(self):
+        if self._pool_refill is not None:
+            self._pool_refill.join()
+            self._pool_refill = None
         if self._cobj is None:
             self._log.debug("'Inside' containter has already been deleted")
             return
-        self._cobj.stop()
-        if self._args.remove:
-            self._cobj.remove()
+        if self._auto_remove and self._exited:
+            self._log.debug("Container {0} has been removed by the daemon".format(self._cobj.id))
+        else:
+            # named containers are removed synchronously, so the name can be reused right away
+            self._teardown(self._cobj, self._exited, self._args.remove,
+                           detach=self._args.name is None)
         self._cobj = None
 
-    def run(self, argv, capture_stdout=False):
+    def _begin(self, argv, keep_container=False):
+        self._returncode = None
+        self._output = None
+        self._exited = False
+        self._switch_probe = None
+        self._profile_name, argv = profiles.expand_argv(argv)
         self._args = self._parse_args(argv)
+        # the daemon removes the container if its logs aren't needed anymore
+        self._auto_remove = (self._args.remove and not keep_container and
+                             dockerutils.supports_wait_condition(self._dc.api))
         self._adapt_log_level()
+        self.timings.clear()
+        self.timings.update_context(app="inside", image=self._args.image)
+        self._count_requests()
+
+    def _end(self):
+        self.cleanup()
+        self._report_requests(self._args.request_budget)
+        self._write_timings(self._args.timings, self._args.timings_format)
+
+    def stream(self, argv, max_chunk=1 << 16):
+        """Run a container and yield its output while it's produced
+
+        The container runs without tty, so stdout and stderr are kept apart.
+        Output is read from the daemon only as fast as it's consumed and in
+        chunks of at most max_chunk bytes. Stopping the iteration early stops
+        and removes the container.
+
+        :param argv: Command line arguments (like for run())
+        :returns: Generator of tuples (stream, data) with stream being
+                  dockerutils.STDOUT or dockerutils.STDERR. The exit code is
+                  available as returncode after the generator finished.
+        """
+        from docker.utils import socket as docker_socket
+        self._begin(argv)
+        self._tty = False
+        sock = None
+        try:
+            self._create()
+            with self.timings.span("attach"):
+                sock = self._dc.api.attach_socket(self._cobj.id, params={
+                    'stdout': 1,
+                    'stderr': 1,
+                    'stream': 1,
+                })
+            wait = self._register_wait()
+            self._log.info("Starting container: {0}".format(self._cobj.id))
+            with self.timings.span("start"):
+                self._cobj.start()
+            for item in dockerutils.demux_stream(lambda n: docker_socket.read(sock, n), max_chunk):
+                yield item
+            self._finish(wait)
+        finally:
+            self._tty = True
+            if sock is not None:
+                sock.close()
+            self._end()
+
+    def run(self, argv, capture_stdout=False):
+        try:
+            self._begin(argv, keep_container=capture_stdout)
+        except profiles.ProfileError as e:
+            self._log.error("{0}".format(e))
+            return None
+        # without terminal the output is streamed, so din can be used in pipelines
+        self._stdio = not capture_stdout and not self._isatty()
+        # stdin is only consumed on request (like docker run -i), f.e. not in loops reading it
+        self._stdin = self._stdio and self._args.interactive
+        self._tty = not self._stdio
         # noinspection PyBroadException
         try:
             self._inside()
             if capture_stdout:
+                if self._args.session:
+                    return self._output
                 return self._cobj.logs(stderr=False)
         except dockerutils.InvalidPath as e:
             logging.exception("{0} '{1}' doesn't exist".format(e.type_, e.path))
@@ -659,13 +1428,46 @@ class DockerInsideApp(dockerutils.BasicDockerApp):
         except Exception:
             logging.exception("Failed to run inside()")
         finally:
-            self.cleanup()
+            self._end()
+            self._stdio = False
+            self._stdin = False
+            self._tty = True
         return None
 
 
-def main():
-    app = DockerInsideApp()
-    app.run(sys.argv[1:])
+def main(profiler=None):
+    """Entry point of docker-inside
+
+    :param profiler: StartupProfiler installed by the launcher (before this
+                     package has been imported)
+    """
+    configure_logging()
+    if sys.argv[1:2] == ['batch']:
+        from . import batch
+        sys.exit(batch.batch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['prefetch']:
+        from . import prefetch
+        sys.exit(prefetch.prefetch_main(sys.argv[2:]))
+    if sys.argv[1:2] == ['gc']:
+        from . import collect
+        sys.exit(collect.gc_main(sys.argv[2:]))
+    if profiler is None:
+        profiler = startup.StartupProfiler()
+        if startup.PROFILE_SWITCH in sys.argv[1:]:
+            profiler.install()
+    try:
+        if daemon.client_enabled():
+            with profiler.phase("daemon request"):
+                returncode = daemon.run_client(sys.argv[1:])
+            if returncode is not None:
+                sys.exit(returncode)
+        with profiler.phase("client setup"):
+            app = DockerInsideApp()
+        with profiler.phase("run"):
+            app.run(sys.argv[1:])
+        sys.exit(1 if app.returncode is None else app.returncode)
+    finally:
+        profiler.report()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+"""Run many docker-inside invocations concurrently from a job file
+
+A job file is JSON (or YAML if PyYAML is installed)::
+
+    {
+        "parallel": 4,
+        "common": ["--auto-pull"],
+        "jobs": [
+            {"name": "ubuntu", "args": ["ubuntu:22.04", "--", "id", "-u"]},
+            ["alpine:latest", "--", "id", "-u"]
+        ]
+    }
+
+Every job accepts the same options as din itself.
+"""
+import os
+import re
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import concurrent.futures
+
+from . import DockerInsideApp
+
+
+class JobFileError(RuntimeError):
+    def __init__(self, path, reason):
+        RuntimeError.__init__(self, "Invalid job file '{0}': {1}".format(path, reason))
+        self.path = path
+
+
+class BatchJob(object):
+    def __init__(self, index, name, argv):
+        self.index = index
+        self.name = name
+        self.slug = re.sub(r'[^a-zA-Z0-9_.-]+', '-', name).strip('-')
+        self.argv = argv
+        self.container_name = None
+        self.returncode = None
+        self.output = None
+        self.duration = None
+
+    @property
+    def succeeded(self):
+        return self.returncode == 0
+
+
+class _BatchInsideApp(DockerInsideApp):
+    """DockerInsideApp without terminal and with a fixed container name"""
+
+    def __init__(self, container_name, env=None):
+        DockerInsideApp.__init__(self, env)
+        self._container_name = container_name
+
+    def _parse_args(self, argv):
+        args = DockerInsideApp._parse_args(argv)
+        args.name = self._container_name
+        return args
+
+    def _adapt_log_level(self):
+        pass  # the log level is set once for all jobs
+
+    @staticmethod
+    def _isatty():
+        return False
+
+
+def load_jobs(path):
+    """Load a job file
+
+    :returns: Tuple (list of BatchJob, requested parallelism or None)
+    """
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            try:
+                import yaml
+            except ImportError:
+                raise JobFileError(path, "PyYAML is required for YAML job files")
+            spec = yaml.safe_load(f)
+        else:
+            try:
+                spec = json.load(f)
+            except ValueError as e:
+                raise JobFileError(path, e)
+    if isinstance(spec, list):
+        spec = {"jobs": spec}
+    if not isinstance(spec, dict) or not isinstance(spec.get("jobs"), list):
+        raise JobFileError(path, "expected a list of jobs")
+    common = [str(i) for i in spec.get("common", [])]
+    jobs = list()
+    for index, job in enumerate(spec["jobs"]):
+        if isinstance(job, list):
+            job = {"args": job}
+        if not isinstance(job, dict) or not isinstance(job.get("args"), list):
+            raise JobFileError(path, "job {0} has no argument list".format(index))
+        name = str(job.get("name", "job{0}".format(index)))
+        jobs.append(BatchJob(index, name, common + [str(i) for i in job["args"]]))
+    return jobs, spec.get("parallel")
+
+
+class BatchRunner(object):
+    NAME_PREFIX = "din-batch"
+
+    def __init__(self, jobs, workers, output_dir=None, env=None):
+        self._log = logging.getLogger("DockerInside.Batch")
+        self._jobs = jobs
+        self._workers = max(1, workers)
+        self._output_dir = output_dir
+        self._env = env
+
+    def _container_name(self, job):
+        return "{0}-{1}-{2}-{3}".format(self.NAME_PREFIX, os.getpid(), job.index, job.slug)
+
+    def _output_path(self, job):
+        # names of jobs aren't unique, the index is
+        return os.path.join(self._output_dir, "{0}-{1}.log".format(job.index, job.slug))
+
+    def _run_job(self, job):
+        threading.current_thread().name = job.name
+        job.container_name = self._container_name(job)
+        start = time.monotonic()
+        # noinspection PyBroadException
+        try:
+            app = _BatchInsideApp(job.container_name, env=self._env)
+            job.output = app.run(job.argv, capture_stdout=True)
+            job.returncode = app.returncode
+        except Exception:
+            self._log.exception("Job {0} failed".format(job.name))
+        job.duration = time.monotonic() - start
+        if self._output_dir is not None and job.output is not None:
+            with open(self._output_path(job), 'wb') as f:
+                f.write(job.output)
+        self._log.info("Job {0} finished with {1} after {2:.1f}s".format(
+            job.name, job.returncode, job.duration))
+        return job
+
+    def run(self):
+        """Run all jobs and return them in job file order"""
+        if self._output_dir is not None:
+            os.makedirs(self._output_dir, exist_ok=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            return list(executor.map(self._run_job, self._jobs))
+
+    @staticmethod
+    def summary(jobs, stream):
+        width = max([len(j.name) for j in jobs] + [3])
+        stream.write("{0:<{w}}  {1:>6}  {2:>9}\n".format("job", "status", "time [s]", w=width))
+        for job in jobs:
+            status = "error" if job.returncode is None else str(job.returncode)
+            duration = 0.0 if job.duration is None else job.duration
+            stream.write("{0:<{w}}  {1:>6}  {2:>9.1f}\n".format(job.name, status, duration, w=width))
+        failed = sum(1 for j in jobs if not j.succeeded)
+        stream.write("{0} jobs, {1} failed\n".format(len(jobs), failed))
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(prog="din batch",
+                                     description="Run docker-inside jobs from a job file")
+    loglevel_group = parser.add_mutually_exclusive_group()
+    loglevel_group.add_argument('--verbose',
+                                dest='loglevel',
+                                action='store_const',
+                                const=logging.DEBUG)
+    loglevel_group.add_argument('--quiet',
+                                dest='loglevel',
+                                action='store_const',
+                                const=logging.ERROR)
+    parser.add_argument('-j', '--jobs',
+                        dest='workers',
+                        type=int,
+                        help="Number of jobs to run concurrently (default: job file or CPU count)")
+    parser.add_argument('-o', '--output-dir',
+                        help="Write the output of every job to OUTPUT_DIR/<job index>-<job name>.log")
+    parser.add_argument('jobfile',
+                        help="JSON (or YAML) job file")
+    parser.set_defaults(loglevel=logging.WARNING)
+    return parser.parse_args(args=argv)
+
+
+def batch_main(argv):
+    """Entry point of 'din batch'
+
+    :returns: 0 if all jobs succeeded, 1 otherwise
+    """
+    args = _parse_args(argv)
+    try:
+        jobs, parallel = load_jobs(args.jobfile)
+    except (OSError, JobFileError) as e:
+        logging.error("{0}".format(e))
+        return 1
+    workers = args.workers or parallel or os.cpu_count() or 1
+    logging.getLogger().setLevel(args.loglevel)
+    runner = BatchRunner(jobs, workers, output_dir=args.output_dir)
+    jobs = runner.run()
+    BatchRunner.summary(jobs, sys.stdout)
+    return 0 if all(j.succeeded for j in jobs) else 1
@@ -0,0 +1,159 @@
+"""Removal of leftover containers created by docker-inside
+
+Every container created by docker-inside is labeled with its owner (uid),
+the digest of its launch configuration and its creation time. Containers
+kept with ``--no-remove`` or left behind by killed processes are found
+using label filters and removed concurrently.
+"""
+import os
+import sys
+import time
+import logging
+import argparse
+import concurrent.futures
+
+from . import dockerutils
+from .prefetch import format_bytes
+
+docker = dockerutils.LazyModule('docker')
+
+_DEFAULT_WORKERS = 8
+_DEFAULT_MAX_AGE = 24 * 3600
+# running containers are only removed on request
+_STOPPED_STATES = ('created', 'exited', 'dead')
+
+
+class GarbageCollector(object):
+    """Find and remove expired containers of docker-inside
+
+    :param owner: Only consider containers of this uid (None: all users)
+    """
+
+    def __init__(self, client, log, owner=None, workers=_DEFAULT_WORKERS):
+        self._dc = client
+        self._log = log
+        self._owner = owner
+        self._workers = max(1, workers)
+
+    @staticmethod
+    def _created(summary):
+        labels = summary.get("Labels") or {}
+        try:
+            return float(labels[dockerutils.CREATED_LABEL])
+        except (KeyError, ValueError):
+            return float(summary.get("Created", 0))
+
+    def find(self, max_age, running=False, now=None):
+        """Container summaries (as listed by the daemon) older than max_age seconds"""
+        now = time.time() if now is None else now
+        label = dockerutils.OWNER_LABEL
+        if self._owner is not None:
+            label = "{0}={1}".format(label, self._owner)
+        filters = {'label': [label]}
+        if not running:
+            filters['status'] = list(_STOPPED_STATES)
+        containers = self._dc.api.containers(all=True, filters=filters)
+        return [i for i in containers if now - self._created(i) > max_age]
+
+    def _size(self, cid):
+        """Size of the writable layer of a container"""
+        api = self._dc.api
+        res = api._get(api._url('/containers/{0}/json', cid), params={'size': 1})
+        return api._result(res, True).get("SizeRw") or 0
+
+    def _remove(self, summary):
+        cid = summary["Id"]
+        try:
+            size = self._size(cid)
+            self._dc.api.remove_container(cid, force=True)
+        except docker.errors.NotFound:
+            self._log.debug("Container {0} has already been removed".format(cid))
+            return 0
+        except docker.errors.APIError as e:
+            self._log.warning("Couldn't remove container {0}: {1}".format(cid, e))
+            return None
+        self._log.debug("Removed container {0} ({1})".format(cid, format_bytes(size)))
+        return size
+
+    def remove(self, containers):
+        """Remove containers concurrently
+
+        :returns: Tuple (number of removed containers, reclaimed bytes)
+        """
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            sizes = [i for i in executor.map(self._remove, containers) if i is not None]
+        return len(sizes), sum(sizes)
+
+
+class GcApp(dockerutils.BasicDockerApp):
+
+    def __init__(self, env=None, client=None):
+        log = logging.getLogger("DockerInside.Gc")
+        dockerutils.BasicDockerApp.__init__(self, log, env, client)
+        self._args = None
+
+    @staticmethod
+    def _parse_args(argv):
+        parser = argparse.ArgumentParser(prog="din gc",
+                                         description="Remove leftover containers of docker-inside")
+        loglevel_group = parser.add_mutually_exclusive_group()
+        loglevel_group.add_argument('--verbose',
+                                    dest='loglevel',
+                                    action='store_const',
+                                    const=logging.DEBUG)
+        loglevel_group.add_argument('--quiet',
+                                    dest='loglevel',
+                                    action='store_const',
+                                    const=logging.ERROR)
+        parser.add_argument('--older-than',
+                            dest='max_age',
+                            type=float,
+                            default=_DEFAULT_MAX_AGE,
+                            metavar='SECONDS',
+                            help="Remove containers created more than SECONDS ago "
+                                 "(default: {0})".format(_DEFAULT_MAX_AGE))
+        parser.add_argument('--running',
+                            action='store_true',
+                            default=False,
+                            help="Also remove running containers")
+        parser.add_argument('--all-users',
+                            action='store_true',
+                            default=False,
+                            help="Remove containers of all users (default: only the own ones)")
+        parser.add_argument('-j', '--jobs',
+                            dest='workers',
+                            type=int,
+                            default=_DEFAULT_WORKERS,
+                            help="Number of concurrent removals (default: {0})".format(_DEFAULT_WORKERS))
+        parser.add_argument('-n', '--dry-run',
+                            action='store_true',
+                            default=False,
+                            help="Only list the containers which would be removed")
+        parser.set_defaults(loglevel=logging.INFO)
+        return parser.parse_args(args=argv)
+
+    def run(self, argv):
+        """Remove the expired containers
+
+        :returns: 0 if all of them have been removed, 1 otherwise
+        """
+        self._args = self._parse_args(argv)
+        logging.getLogger().setLevel(self._args.loglevel)
+        owner = None if self._args.all_users else str(os.getuid())
+        collector = GarbageCollector(self._dc, self._log, owner, self._args.workers)
+        containers = collector.find(self._args.max_age, self._args.running)
+        if self._args.dry_run:
+            for summary in containers:
+                name = (summary.get("Names") or [summary["Id"][:12]])[0].lstrip("/")
+                sys.stdout.write("{0}  {1:<10}  {2}\n".format(
+                    summary["Id"][:12], summary.get("State", ""), name))
+            return 0
+        removed, reclaimed = collector.remove(containers)
+        self._log.info("Removed {0} of {1} containers, reclaimed {2}".format(
+            removed, len(containers), format_bytes(reclaimed)))
+        return 0 if removed == len(containers) else 1
+
+
+def gc_main(argv):
+    """Entry point of 'din gc'"""
+    return GcApp().run(argv)
@@ -0,0 +1,291 @@
+"""Optional per-user daemon keeping docker-inside warm
+
+The daemon holds the imported modules and the Docker client. The ``din``
+front end connects to its unix socket, passes its stdin, stdout and stderr
+file descriptors and the parsed command line. The daemon forks a child per
+request which runs on the passed descriptors, so pseudo terminal handling
+works exactly as if the client had run the container itself.
+"""
+import os
+import sys
+import json
+import array
+import errno
+import signal
+import socket
+import struct
+import logging
+import argparse
+import threading
+
+_HEADER = struct.Struct("!I")
+_MAX_FDS = 3
+_DEFAULT_IDLE_TIMEOUT = 1800.0
+
+
+def socket_path(env=None):
+    """Path of the daemon socket
+
+    :param env: Optional environment (default: os.environ)
+    """
+    if env is None:
+        env = os.environ
+    if env.get('DIN_DAEMON_SOCKET'):
+        return env['DIN_DAEMON_SOCKET']
+    runtime_dir = env.get('XDG_RUNTIME_DIR')
+    if runtime_dir:
+        return os.path.join(runtime_dir, 'docker_inside', 'din.sock')
+    return os.path.join(os.path.expanduser('~'), '.config', 'docker_inside', 'din.sock')
+
+
+def client_enabled(env=None):
+    """Check if the front end should try to use a running daemon"""
+    if env is None:
+        env = os.environ
+    if env.get('DIN_DAEMON', '') == '0':
+        return False
+    return os.path.exists(socket_path(env))
+
+
+def _send_msg(sock, msg, fds=None):
+    payload = json.dumps(msg).encode('utf-8')
+    data = _HEADER.pack(len(payload)) + payload
+    if fds:
+        ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))]
+        sent = sock.sendmsg([data], ancillary)
+        data = data[sent:]
+    sock.sendall(data)
+
+
+def _recv_exactly(sock, size):
+    buf = bytearray()
+    while len(buf) < size:
+        chunk = sock.recv(size - len(buf))
+        if not chunk:
+            raise EOFError("Connection closed")
+        buf.extend(chunk)
+    return bytes(buf)
+
+
+def _recv_msg(sock, with_fds=False):
+    fds = array.array('i')
+    if with_fds:
+        data, ancillary, _, _ = sock.recvmsg(_HEADER.size, socket.CMSG_SPACE(_MAX_FDS * fds.itemsize))
+        for level, type_, cdata in ancillary:
+            if level == socket.SOL_SOCKET and type_ == socket.SCM_RIGHTS:
+                fds.frombytes(cdata[:len(cdata) - (len(cdata) % fds.itemsize)])
+        if not data:
+            raise EOFError("Connection closed")
+        data += _recv_exactly(sock, _HEADER.size - len(data))
+    else:
+        data = _recv_exactly(sock, _HEADER.size)
+    size, = _HEADER.unpack(data)
+    msg = json.loads(_recv_exactly(sock, size).decode('utf-8'))
+    return msg, list(fds)
+
+
+def run_client(argv, env=None):
+    """Run argv in the daemon using the stdio of this process
+
+    :returns: Exit code of the container or None if the request couldn't be
+        passed to the daemon (the request hasn't been run)
+    """
+    if env is None:
+        env = os.environ
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_handler = None
+    try:
+        try:
+            sock.connect(socket_path(env))
+            _send_msg(sock, {
+                "argv": list(argv),
+                "env": dict(env),
+                "cwd": os.getcwd(),
+            }, fds=[0, 1, 2])
+        except OSError:
+            return None
+
+        def _forward_winch(signum, frame):
+            _send_msg(sock, {"signal": "winch"})
+
+        old_handler = signal.signal(signal.SIGWINCH, _forward_winch)
+        while True:
+            try:
+                msg, _ = _recv_msg(sock)
+                break
+            except InterruptedError:
+                continue
+        return msg.get("returncode", 1)
+    except (OSError, EOFError, ValueError):
+        # the daemon got the request, running it again could repeat its effects
+        return 1
+    finally:
+        if old_handler is not None:
+            signal.signal(signal.SIGWINCH, old_handler)
+        sock.close()
+
+
+class DinDaemon(object):
+    """Accept requests of the din front end and run them in forked children"""
+
+    DOCKER_ENV_PREFIX = "DOCKER_"
+
+    def __init__(self, path, idle_timeout=_DEFAULT_IDLE_TIMEOUT, client=None):
+        from . import DockerInsideApp
+        self._log = logging.getLogger("DockerInside.Daemon")
+        self._path = path
+        self._idle_timeout = idle_timeout
+        self._app_cls = DockerInsideApp
+        if client is None:
+            client = DockerInsideApp(env=dict(os.environ))._dc
+        self._client = client
+        self._docker_env = self._docker_vars(os.environ)
+        self._sock = None
+
+    @classmethod
+    def _docker_vars(cls, env):
+        return {k: v for k, v in env.items() if k.startswith(cls.DOCKER_ENV_PREFIX)}
+
+    def _bind(self):
+        os.makedirs(os.path.dirname(self._path), 0o700, exist_ok=True)
+        try:
+            os.unlink(self._path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o177)
+        try:
+            sock.bind(self._path)
+        finally:
+            os.umask(old_umask)
+        sock.listen(16)
+        sock.settimeout(self._idle_timeout)
+        self._sock = sock
+
+    @staticmethod
+    def _peer_uid(conn):
+        creds = conn.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        return struct.unpack('3i', creds)[1]
+
+    def serve(self):
+        self._bind()
+        # children are reaped automatically, results are sent over the connection
+        signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+        self._log.info("Listening on {0}".format(self._path))
+        try:
+            while True:
+                try:
+                    conn, _ = self._sock.accept()
+                except socket.timeout:
+                    self._log.info("Idle for {0} seconds -> exit".format(self._idle_timeout))
+                    break
+                try:
+                    self._accept(conn)
+                finally:
+                    conn.close()
+        finally:
+            self._sock.close()
+            os.unlink(self._path)
+
+    def _accept(self, conn):
+        conn.settimeout(None)
+        if self._peer_uid(conn) != os.getuid():
+            self._log.warning("Rejected connection of a different user")
+            return
+        try:
+            request, fds = _recv_msg(conn, with_fds=True)
+        except (OSError, EOFError, ValueError):
+            self._log.exception("Invalid request")
+            return
+        try:
+            if len(fds) != _MAX_FDS:
+                self._log.warning("Request without stdio file descriptors")
+                return
+            pid = os.fork()
+            if pid == 0:
+                self._sock.close()
+                code = 1
+                # noinspection PyBroadException
+                try:
+                    code = self._child(conn, request, fds)
+                except BaseException:
+                    self._log.exception("Request failed")
+                    try:
+                        _send_msg(conn, {"returncode": code})
+                    except OSError:
+                        pass
+                finally:
+                    os._exit(code)
+            self._log.debug("Forked {0} for {1}".format(pid, " ".join(request.get("argv", []))))
+        finally:
+            for fd in fds:
+                os.close(fd)
+
+    def _child(self, conn, request, fds):
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        for target, fd in enumerate(fds):
+            os.dup2(fd, target)
+        env = request.get("env", {})
+        os.environ.clear()
+        os.environ.update(env)
+        os.chdir(request.get("cwd", "/"))
+        client = self._client
+        if self._docker_vars(env) != self._docker_env:
+            client = None  # different daemon configuration: create an own client
+        else:
+            # don't share pooled connections with the daemon or other children
+            client.api.close()
+        watcher = threading.Thread(target=self._watch, args=(conn,), name="ClientWatch")
+        watcher.daemon = True
+        watcher.start()
+        app = self._app_cls(client=client)
+        app.run(request.get("argv", []))
+        code = app.returncode
+        # None would make the front end run the request again by itself
+        _send_msg(conn, {"returncode": 1 if code is None else code})
+        return 0
+
+    @staticmethod
+    def _watch(conn):
+        """Forward signals of the front end and interrupt if it disappears"""
+        import _thread
+        while True:
+            try:
+                msg, _ = _recv_msg(conn)
+            except (OSError, EOFError, ValueError):
+                _thread.interrupt_main()
+                return
+            if msg.get("signal") == "winch":
+                os.kill(os.getpid(), signal.SIGWINCH)
+
+
+def _parse_args(argv):
+    parser = argparse.ArgumentParser(description="Keep docker-inside warm for the din front end")
+    parser.add_argument('--verbose',
+                        dest='loglevel',
+                        action='store_const',
+                        const=logging.DEBUG,
+                        default=logging.INFO)
+    parser.add_argument('--socket',
+                        help="Path of the unix socket (default: {0})".format(socket_path()))
+    parser.add_argument('--idle-timeout',
+                        type=float,
+                        default=_DEFAULT_IDLE_TIMEOUT,
+                        metavar='SECONDS',
+                        help="Exit after SECONDS without requests (default: {0})".format(
+                            _DEFAULT_IDLE_TIMEOUT))
+    return parser.parse_args(args=argv)
+
+
+def daemon_main():
+    from . import configure_logging
+    configure_logging()
+    args = _parse_args(sys.argv[1:])
+    logging.getLogger().setLevel(args.loglevel)
+    path = args.socket or socket_path()
+    DinDaemon(path, idle_timeout=args.idle_timeout).serve()
+
+
+if __name__ == '__main__':
+    daemon_main()
@@ -1,7 +1,17 @@
+import io
 import os
+import re
+import sys
+import struct
+import threading
+import contextlib
+import collections
 import grp
+import json
+import hashlib
 import tarfile
 import tempfile
+import time
 
 try:
     # noinspection PyCompatibility
@@ -9,8 +19,56 @@ try:
 except ImportError:
     from collections import Sequence
 
-import docker
-import docker.errors
+
+class LazyModule(object):
+    """Proxy importing a module on first attribute access
+
+    Importing docker (and requests, urllib3, ...) takes a significant part of
+    the startup time, so it's deferred until the module is actually used.
+    """
+
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            __import__(self._name)
+            module = sys.modules[self._name]
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        module = self._load()
+        try:
+            return getattr(module, attr)
+        except AttributeError:
+            # submodule that isn't imported by the package itself
+            __import__("{0}.{1}".format(self._name, attr))
+            return getattr(module, attr)
+
+
+docker = LazyModule('docker')
+
+LABEL_PREFIX = "docker_inside."
+OWNER_LABEL = LABEL_PREFIX + "owner"
+PLAN_LABEL = LABEL_PREFIX + "plan"
+CREATED_LABEL = LABEL_PREFIX + "created"
+
+
+def ownership_labels(plan=None):
+    """Labels of every container created by docker-inside
+
+    :param plan: Optional digest of the launch configuration
+    """
+    labels = {
+        OWNER_LABEL: str(os.getuid()),
+        CREATED_LABEL: "{0:.3f}".format(time.time()),
+    }
+    if plan is not None:
+        labels[PLAN_LABEL] = plan
+    return labels
 
 
 class ContainerError(RuntimeError):
@@ -142,39 +200,295 @@ def tmpfs_list_to_dict(tmpfs_list):
     return d
 
 
-def tar_pack(data, write_mode='w', default_mode=0o640):
-    def _add_file(archive, name, payload, mode):
-        ti = tarfile.TarInfo(name)
-        ti.uid = 0
-        ti.gid = 0
-        ti.mode = mode
-        ti.uname = "root"
-        ti.gname = "root"
-        with tempfile.TemporaryFile(prefix='docker-file') as f:
-            f.write(payload)
-            f.flush()
-            ti.size = f.tell()
-            f.seek(0)
-            archive.addfile(ti, f)
-
-    with tempfile.TemporaryFile(prefix='docker-archive') as archf:
-        arch = tarfile.open(fileobj=archf, mode=write_mode)
+_TAR_PACK_CACHE = collections.OrderedDict()
+_TAR_PACK_CACHE_SIZE = 16
+
+
+def _tar_pack_key(data, write_mode, default_mode):
+    """Fingerprint of an archive configuration used to memoize tar_pack
+
+    Payloads are identified by their digest, files by path, size, inode and
+    modification time so unchanged files don't have to be read again.
+    """
+    entries = []
+    for k, v in sorted(data.items()):
+        mode = v.get('mode', default_mode)
+        gid = v.get('gid', 0)
+        if 'file' in v:
+            st = os.stat(v['file'])
+            entries.append((k, mode, gid, 'file', v['file'], st.st_size, st.st_ino, st.st_mtime_ns))
+        else:
+            digest = hashlib.sha256(v.get('payload', b'')).hexdigest()
+            entries.append((k, mode, gid, 'payload', digest))
+    return write_mode, tuple(entries)
+
+
+def _tar_pack(data, write_mode, default_mode):
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode=write_mode) as arch:
         for k, v in data.items():
-            if 'mode' not in v:
-                v['mode'] = default_mode
             if 'file' in v:
-                arch.add(v['file'], arcname=k)
+                with open(v['file'], 'rb') as f:
+                    payload = f.read()
             else:
-                _add_file(arch, k, v.get('payload', b''), v['mode'])
-        arch.close()
-        archf.flush()
-        archf.seek(0)
-        data = archf.read()
-        return data
+                payload = v.get('payload', b'')
+            gid = v.get('gid', 0)
+            ti = tarfile.TarInfo(k.lstrip('/'))
+            ti.uid = 0
+            ti.gid = gid
+            ti.mode = v.get('mode', default_mode)
+            ti.uname = "root"
+            ti.gname = "root" if gid == 0 else ""
+            ti.size = len(payload)
+            arch.addfile(ti, io.BytesIO(payload))
+    return buf.getvalue()
+
+
+def tar_pack(data, write_mode='w', default_mode=0o640):
+    """Pack files into a tar archive (f.e. for put_archive)
 
+    The archive is built in memory and memoized, so packing the same
+    configuration again returns the already packed bytes.
+
+    :param data: Dictionary of archive path to entry. An entry either has a
+                 'payload' (bytes) or a 'file' (host path) and optionally a
+                 'mode' and 'gid'. Files are owned by root.
+    :returns: The archive as bytes
+    """
+    key = _tar_pack_key(data, write_mode, default_mode)
+    try:
+        _TAR_PACK_CACHE.move_to_end(key)
+        return _TAR_PACK_CACHE[key]
+    except KeyError:
+        pass
+    archive = _tar_pack(data, write_mode, default_mode)
+    remember_tar_pack(data, archive, write_mode, default_mode, key=key)
+    return archive
+
+
+def remember_tar_pack(data, archive, write_mode='w', default_mode=0o640, key=None):
+    """Memoize an archive packed earlier (f.e. loaded from a launch plan)
+
+    Later calls of tar_pack with the same configuration return archive.
+    """
+    if key is None:
+        key = _tar_pack_key(data, write_mode, default_mode)
+    _TAR_PACK_CACHE[key] = archive
+    _TAR_PACK_CACHE.move_to_end(key)
+    while len(_TAR_PACK_CACHE) > _TAR_PACK_CACHE_SIZE:
+        _TAR_PACK_CACHE.popitem(last=False)
 
-def get_user_groups(username):
-    return list([g for g in grp.getgrall() if username in g.gr_mem])
+
+STDOUT = 1
+STDERR = 2
+_FRAME_HEADER = struct.Struct('>BxxxL')
+
+
+def _read_exactly(read, size):
+    data = b""
+    while len(data) < size:
+        chunk = read(size - len(data))
+        if not chunk:
+            break
+        data += chunk
+    return data
+
+
+def demux_stream(read, max_chunk=1 << 16):
+    """Generator demultiplexing an attach stream of a container without tty
+
+    Frames are yielded in chunks of at most max_chunk bytes, so large frames
+    don't have to be held in memory completely.
+
+    :param read: Callable reading up to n bytes (b'' at the end of the stream)
+    :returns: Generator of tuples (stream, data), stream is STDOUT or STDERR
+    """
+    while True:
+        header = _read_exactly(read, _FRAME_HEADER.size)
+        if len(header) < _FRAME_HEADER.size:
+            return
+        stream, size = _FRAME_HEADER.unpack(header)
+        while size > 0:
+            chunk = read(min(size, max_chunk))
+            if not chunk:
+                return
+            size -= len(chunk)
+            yield stream, chunk
+
+
+def config_dir(home=None):
+    """Return the per-user configuration directory of docker-inside
+
+    :param home: Optional home directory (default: home of the current user)
+    """
+    if home is None:
+        home = os.path.expanduser('~')
+    return os.path.join(home, '.config', 'docker_inside')
+
+
+def file_digest(path, chunk_size=1 << 16):
+    """Calculate the sha256 hex digest of a file"""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def hash_key(*parts):
+    """Calculate a stable sha256 hex digest of JSON serializable parts"""
+    data = json.dumps(parts, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(data.encode('utf-8')).hexdigest()
+
+
+def tar_unpack_file(chunks):
+    """Extract the first regular file of a tar stream (f.e. from get_archive)
+
+    :param chunks: Iterable of bytes forming a tar archive
+    :returns: Tuple (payload, tarinfo) or (None, None) if there is no file
+    """
+    archf = io.BytesIO(b"".join(chunks))
+    with tarfile.open(fileobj=archf, mode='r') as arch:
+        for ti in arch:
+            if ti.isfile():
+                return arch.extractfile(ti).read(), ti
+    return None, None
+
+
+def _split_db_lines(text):
+    lines = [i for i in text.split("\n") if i.strip() != '']
+    return lines, [i.split(":") for i in lines]
+
+
+def merge_passwd(passwd, user, uid, gid, home, shell='/bin/sh'):
+    """Add a user entry to the content of /etc/passwd
+
+    Like the entrypoint script, an existing user name or user id is left untouched.
+
+    :param passwd: Text content of /etc/passwd
+    :returns: Tuple (new content, True if the user has been added)
+    """
+    lines, entries = _split_db_lines(passwd)
+    for e in entries:
+        if e[0] == user or (len(e) > 2 and e[2] == str(uid)):
+            return passwd, False
+    lines.append(":".join([user, "x", str(uid), str(gid), "", home, shell]))
+    return "\n".join(lines) + "\n", True
+
+
+def merge_shadow(shadow, user):
+    """Add a locked password entry for user to the content of /etc/shadow"""
+    lines, entries = _split_db_lines(shadow)
+    if any(e[0] == user for e in entries):
+        return shadow
+    lines.append(":".join([user, "!", "", "0", "99999", "7", "", "", ""]))
+    return "\n".join(lines) + "\n"
+
+
+def merge_group(group, user, main_group, groups):
+    """Add the main group and supplementary groups to the content of /etc/group
+
+    Like the entrypoint script, a group is skipped if its id is used by a
+    group of another name. The user becomes a member of all supplementary
+    groups, including the ones that already exist.
+
+    :param group: Text content of /etc/group
+    :param main_group: Tuple (name, gid) of the main group
+    :param groups: List of tuples (name, gid) of supplementary groups
+    :returns: New content of /etc/group
+    """
+    lines, entries = _split_db_lines(group)
+    index = {e[0]: i for i, e in enumerate(entries)}
+    gids = set(e[2] for e in entries if len(e) > 2)
+
+    def _add(name, gid, member):
+        if name in index:
+            entry = entries[index[name]]
+            if member and len(entry) > 3:
+                members = [i for i in entry[3].split(",") if i]
+                if member not in members:
+                    entry[3] = ",".join(members + [member])
+                    lines[index[name]] = ":".join(entry)
+            return
+        if str(gid) in gids:
+            return
+        index[name] = len(entries)
+        entries.append([name, "x", str(gid), member])
+        gids.add(str(gid))
+        lines.append(":".join(entries[-1]))
+
+    _add(main_group[0], main_group[1], "")
+    for name, gid in groups:
+        _add(name, gid, user)
+    return "\n".join(lines) + "\n"
+
+
+GroupEntry = collections.namedtuple('GroupEntry', ('gr_name', 'gr_gid'))
+
+
+def get_user_groups(username, gid=None):
+    """Supplementary groups of a user
+
+    Uses getgrouplist() instead of enumerating all groups, which is slow for
+    directory services (LDAP, SSSD, ...).
+
+    :param gid: Primary group id (default: looked up via passwd)
+    :returns: List of GroupEntry (without the primary group)
+    """
+    if gid is None:
+        import pwd
+        gid = pwd.getpwnam(username).pw_gid
+    groups = list()
+    for i in sorted(set(os.getgrouplist(username, gid))):
+        if i == gid:
+            continue
+        try:
+            groups.append(GroupEntry(grp.getgrgid(i).gr_name, i))
+        except KeyError:
+            pass  # group without name
+    return groups
+
+
+def cached_user_groups(username, gid, ttl, refresh=False, path=None):
+    """Supplementary groups of a user cached on disk
+
+    The cache is used for ttl seconds unless refresh is set or the groups of
+    the current process contain a group id that isn't cached.
+
+    :param path: Cache file (default: groups.json in the config directory)
+    :returns: List of GroupEntry
+    """
+    if path is None:
+        path = os.path.join(config_dir(), 'groups.json')
+    if ttl <= 0:
+        return get_user_groups(username, gid)
+    cache = None if refresh else read_json(path)
+    if isinstance(cache, dict) and cache.get("user") == username and cache.get("gid") == gid \
+            and 0 <= time.time() - cache.get("time", 0) < ttl:
+        groups = [GroupEntry(name, gr_gid) for name, gr_gid in cache.get("groups", [])]
+        known = set(i.gr_gid for i in groups)
+        known.add(gid)
+        if not (username == _current_user() and set(os.getgroups()) - known):
+            return groups
+    groups = get_user_groups(username, gid)
+    try:
+        write_json_atomic(path, {
+            "user": username,
+            "gid": gid,
+            "time": time.time(),
+            "groups": [list(i) for i in groups],
+        })
+    except OSError:
+        pass  # caching is optional
+    return groups
+
+
+def _current_user():
+    import pwd
+    try:
+        return pwd.getpwuid(os.getuid()).pw_name
+    except KeyError:
+        return None
 
 
 def _split_and_filter(args):
@@ -198,6 +512,479 @@ def linux_pjoin(*args):
     return root + rpath
 
 
+def write_file_atomic(path, data, mode=None):
+    """Write text or bytes to path by replacing the file atomically
+
+    Every writer uses an own temporary file, so concurrent writers (threads
+    or processes) don't interfere and the last one wins.
+
+    :param mode: Permissions of the file (default: 0o600 of the temporary file)
+    """
+    directory = os.path.dirname(path)
+    os.makedirs(directory, 0o755, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(prefix=os.path.basename(path) + ".", suffix=".tmp", dir=directory)
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            if mode is not None:
+                os.fchmod(f.fileno(), mode)
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def write_json_atomic(path, data):
+    """Write data as JSON to path by replacing the file atomically"""
+    write_file_atomic(path, json.dumps(data))
+
+
+def read_json(path, default=None):
+    """Read JSON from path or return default if it doesn't exist or is invalid"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+class Timings(object):
+    """Timed spans of the launch phases
+
+    Library users can register listeners which are called with every
+    finished span (a dictionary with name, start (epoch), duration (seconds),
+    thread and the context set via update_context()).
+    """
+    FORMATS = ('jsonl', 'trace')
+    ENV_VARIABLE = "DIN_TIMINGS"
+
+    def __init__(self):
+        self._spans = list()
+        self._listeners = list()
+        self._context = dict()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        self._listeners.remove(callback)
+
+    def update_context(self, **kwargs):
+        """Set attributes added to all following spans (f.e. the image)"""
+        self._context.update(kwargs)
+
+    @property
+    def spans(self):
+        return list(self._spans)
+
+    def clear(self):
+        del self._spans[:]
+        self._context.clear()
+
+    @contextlib.contextmanager
+    def span(self, name, **attrs):
+        start = time.time()
+        start_counter = time.perf_counter()
+        try:
+            yield
+        finally:
+            record = dict(self._context)
+            record.update(attrs)
+            record.update({
+                "name": name,
+                "start": start,
+                "duration": time.perf_counter() - start_counter,
+                "thread": threading.current_thread().name,
+            })
+            self._spans.append(record)
+            for callback in self._listeners:
+                callback(record)
+
+    def trace_events(self):
+        """Spans in the trace event format (chrome://tracing, Perfetto)"""
+        pid = os.getpid()
+        return [{
+            "name": i["name"],
+            "ph": "X",
+            "ts": i["start"] * 1e6,
+            "dur": i["duration"] * 1e6,
+            "pid": pid,
+            "tid": i["thread"],
+            "args": {k: v for k, v in i.items() if k not in ("name", "start", "duration", "thread")},
+        } for i in self._spans]
+
+    def write(self, path, fmt='jsonl'):
+        """Write the spans to path ('-' for stderr)
+
+        JSON lines are appended to the file, so multiple launches can be
+        collected in the same file. A trace file is replaced.
+        """
+        if fmt == 'trace':
+            text = json.dumps({"traceEvents": self.trace_events()})
+        else:
+            text = "".join(json.dumps(i) + "\n" for i in self._spans)
+        if path == '-':
+            sys.stderr.write(text)
+            sys.stderr.flush()
+            return
+        with open(path, 'w' if fmt == 'trace' else 'a') as f:
+            f.write(text)
+
+
+class RequestStats(object):
+    """Count Docker API requests, bytes and latency per endpoint
+
+    Attaches a response hook to the session of the Docker client. Paths are
+    normalized (API version, container ids and image names are replaced), so
+    the same kind of request of different launches shares an endpoint.
+    Bytes received are only known for responses with a Content-Length
+    (streams count as 0). The latency is the time until the response headers
+    arrived.
+    """
+    _PATTERNS = [
+        (re.compile(r"^/v[0-9.]+/"), "/"),
+        (re.compile(r"^/(containers|exec|networks|volumes)/(?!json$|create$|prune$)[^/]+"), r"/\1/{id}"),
+        (re.compile(r"^/images/(?!json$|create$|load$|prune$|search$).+?(?=/json$|/history$|/push$|/tag$|$)"),
+         "/images/{name}"),
+    ]
+
+    @classmethod
+    def endpoint(cls, method, path):
+        """Normalize a request to an endpoint like 'POST /containers/{id}/start'"""
+        for pattern, repl in cls._PATTERNS:
+            path = pattern.sub(repl, path)
+        return "{0} {1}".format(method, path)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = None
+        self._endpoints = collections.OrderedDict()
+
+    def attach(self, client):
+        """Start counting the requests of a docker client"""
+        self.detach()
+        hooks = client.api.hooks.setdefault('response', [])
+        hooks.append(self._on_response)
+        self._hooks = hooks
+
+    def detach(self):
+        if self._hooks is not None:
+            try:
+                self._hooks.remove(self._on_response)
+            except ValueError:
+                pass
+            self._hooks = None
+
+    def clear(self):
+        with self._lock:
+            self._endpoints.clear()
+
+    def _on_response(self, response, *args, **kwargs):
+        request = response.request
+        path = request.path_url.split("?", 1)[0]
+        body = request.body
+        sent = len(body) if isinstance(body, (bytes, str)) else 0
+        try:
+            received = int(response.headers.get("Content-Length", 0))
+        except ValueError:
+            received = 0
+        elapsed = response.elapsed.total_seconds()
+        self.record(self.endpoint(request.method, path), sent, received, elapsed)
+
+    def record(self, endpoint, sent=0, received=0, elapsed=0.0):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {
+                "count": 0, "sent": 0, "received": 0, "elapsed": 0.0,
+            })
+            stats["count"] += 1
+            stats["sent"] += sent
+            stats["received"] += received
+            stats["elapsed"] += elapsed
+
+    @property
+    def endpoints(self):
+        """Dictionary of endpoint to count, sent, received (bytes) and elapsed (seconds)"""
+        with self._lock:
+            return {k: dict(v) for k, v in self._endpoints.items()}
+
+    @property
+    def total(self):
+        """Totals of all endpoints (same keys as for every endpoint)"""
+        total = {"count": 0, "sent": 0, "received": 0, "elapsed": 0.0}
+        for stats in self.endpoints.values():
+            for k in total:
+                total[k] += stats[k]
+        return total
+
+    def summary(self):
+        """Human readable summary (one line per endpoint)"""
+        total = self.total
+        lines = ["Docker API: {0} requests, {1} bytes sent, {2} bytes received, {3:.1f} ms".format(
+            total["count"], total["sent"], total["received"], total["elapsed"] * 1e3)]
+        for endpoint, stats in self.endpoints.items():
+            lines.append("  {0:>3} x {1:<40} {2:>9} B sent {3:>9} B received {4:>8.1f} ms".format(
+                stats["count"], endpoint, stats["sent"], stats["received"], stats["elapsed"] * 1e3))
+        return "\n".join(lines)
+
+
+class ImageCache(object):
+    """On-disk cache of image metadata (id and run configuration) per reference
+
+    Entries are validated using the image events of the daemon since the last
+    validation: any pull, tag, untag, delete, import or load of a reference or
+    image id drops the corresponding entries. This requires the daemon to
+    share the clock of this host (a local socket). For remote daemons, the
+    cache doesn't trust entries and every lookup is a miss.
+    """
+    FILE_NAME = "image-cache.json"
+    VOLATILE_ACTIONS = ("pull", "tag", "untag", "delete", "import", "load")
+    # base urls of the docker client for unix sockets and named pipes (ssh uses http+docker://ssh)
+    LOCAL_URLS = ("http+docker://localhost", "http+docker://localnpipe")
+
+    @staticmethod
+    def _reduce(attrs):
+        config = attrs.get("Config") or {}
+        return {
+            "Id": attrs["Id"],
+            "Architecture": attrs.get("Architecture"),
+            "Config": {k: config.get(k) for k in ("Env", "Entrypoint", "Cmd")},
+        }
+
+    def __init__(self, client, log, path=None):
+        if path is None:
+            path = os.path.join(config_dir(), self.FILE_NAME)
+        self._dc = client
+        self._log = log
+        self._path = path
+        self._data = None
+
+    @property
+    def trusted(self):
+        return str(self._dc.api.base_url).rstrip("/") in self.LOCAL_URLS
+
+    def _load(self):
+        if self._data is not None:
+            return
+        self._data = read_json(self._path, {})
+        images = self._data.setdefault("images", {})
+        since = self._data.get("since")
+        now = int(time.time())
+        self._data["since"] = now
+        if images and since is not None:
+            self._invalidate(since, now)
+            self._save()
+
+    def _save(self):
+        try:
+            write_json_atomic(self._path, self._data)
+        except OSError as e:
+            self._log.debug("Couldn't write image cache {0}: {1}".format(self._path, e))
+
+    def _invalidate(self, since, until):
+        images = self._data["images"]
+        events = self._dc.events(since=since, until=until, filters={'type': 'image'}, decode=True)
+        for event in events:
+            if event.get("Action", event.get("status")) not in self.VOLATILE_ACTIONS:
+                continue
+            actor = event.get("Actor") or {}
+            names = {actor.get("ID"), event.get("id"), (actor.get("Attributes") or {}).get("name")}
+            names.discard(None)
+            for ref, entry in list(images.items()):
+                if ref in names or entry["Id"] in names or ref.rsplit(":", 1)[0] in names:
+                    self._log.debug("Image event {0}: drop cached {1}".format(event.get("Action"), ref))
+                    del images[ref]
+
+    def get(self, ref):
+        """Return cached attributes of image ref or None"""
+        if not self.trusted:
+            return None
+        self._load()
+        return self._data["images"].get(ref)
+
+    def put(self, ref, attrs):
+        """Store attributes (as returned by inspect) of image ref"""
+        if not self.trusted:
+            return
+        self._load()
+        self._data["images"][ref] = self._reduce(attrs)
+        self._save()
+
+
+class SwitchCache(object):
+    """On-disk cache of the user switch method detected per image
+
+    The entrypoint reports the working method on the first launch of an image,
+    later launches pass it via DIN_SWITCH_METHOD. Image ids are content
+    addressed, so entries don't need to be invalidated.
+    """
+    FILE_NAME = "switch.json"
+    MAX_ENTRIES = 256
+
+    @staticmethod
+    def parse_probe(text):
+        """Parse the key=value lines reported by the entrypoint"""
+        probe = dict()
+        for line in text.splitlines():
+            key, sep, value = line.partition("=")
+            if sep:
+                probe[key.strip()] = value.strip()
+        return probe
+
+    def __init__(self, log, path=None):
+        if path is None:
+            path = os.path.join(config_dir(), self.FILE_NAME)
+        self._log = log
+        self._path = path
+
+    def get(self, key):
+        """Return the cached entry (dict with method and busyboxusr) or None"""
+        entry = read_json(self._path, {}).get(key)
+        if not isinstance(entry, dict) or not entry.get("method"):
+            return None
+        return entry
+
+    def put(self, key, method, busyboxusr=None):
+        data = read_json(self._path, {})
+        data[key] = {
+            "method": method,
+            "busyboxusr": busyboxusr or None,
+            "time": time.time(),
+        }
+        if len(data) > self.MAX_ENTRIES:
+            oldest = sorted(data, key=lambda k: data[k].get("time", 0))
+            for i in oldest[:len(data) - self.MAX_ENTRIES]:
+                del data[i]
+        try:
+            write_json_atomic(self._path, data)
+        except OSError as e:
+            self._log.debug("Couldn't write switch cache {0}: {1}".format(self._path, e))
+
+
+class UsageHistory(object):
+    """Record of the images used by launches
+
+    Every launch appends a line (reference, image id, time) to a JSON lines
+    file. Once the file exceeds MAX_SIZE it's compacted to the most recent
+    half of the records; appends racing with the compaction may get lost,
+    which doesn't matter for ranking images.
+    """
+    FILE_NAME = "history.jsonl"
+    REFRESH_FILE = "history-refresh"
+    MAX_SIZE = 1 << 20
+    # weight of a launch halves every week
+    HALF_LIFE = 7 * 24 * 3600
+
+    def __init__(self, log, path=None):
+        if path is None:
+            path = os.path.join(config_dir(), self.FILE_NAME)
+        self._log = log
+        self._path = path
+
+    def record(self, ref, image_id, now=None):
+        line = json.dumps({
+            "image": ref,
+            "id": image_id,
+            "time": int(time.time() if now is None else now),
+        }) + "\n"
+        try:
+            os.makedirs(os.path.dirname(self._path), 0o755, exist_ok=True)
+            # a single small write to a file opened for appending isn't interleaved
+            with open(self._path, 'a') as f:
+                f.write(line)
+                size = f.tell()
+            if size > self.MAX_SIZE:
+                self._compact()
+        except OSError as e:
+            self._log.debug("Couldn't write usage history {0}: {1}".format(self._path, e))
+
+    def _compact(self):
+        records = self.records()
+        write_file_atomic(self._path, "".join(json.dumps(record) + "\n"
+                                              for record in records[len(records) // 2:]))
+
+    def records(self):
+        """All valid records (dictionaries with image, id and time) from old to new"""
+        records = list()
+        try:
+            with open(self._path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if isinstance(record, dict) and record.get("image") and "time" in record:
+                        records.append(record)
+        except OSError:
+            pass
+        return records
+
+    def top(self, count, now=None):
+        """References of the count most used images
+
+        Each launch contributes a weight decaying with its age, so images
+        used often and recently come first.
+        """
+        now = time.time() if now is None else now
+        scores = collections.defaultdict(float)
+        for record in self.records():
+            age = max(now - record["time"], 0)
+            scores[record["image"]] += 0.5 ** (age / self.HALF_LIFE)
+        return sorted(scores, key=lambda ref: -scores[ref])[:count]
+
+    def claim_refresh(self, interval, now=None):
+        """Return True (once per interval) if the images should be refreshed"""
+        now = time.time() if now is None else now
+        path = os.path.join(os.path.dirname(self._path), self.REFRESH_FILE)
+        try:
+            if now - os.stat(path).st_mtime < interval:
+                return False
+        except OSError:
+            pass
+        try:
+            with open(path, 'w'):
+                pass
+            os.utime(path, (now, now))
+        except OSError as e:
+            self._log.debug("Couldn't write {0}: {1}".format(path, e))
+            return False
+        return True
+
+
+WAIT_CONDITION_API_VERSION = '1.30'
+
+
+def supports_wait_condition(api):
+    """Check if the daemon API supports waiting for the removal of a container"""
+    return not docker.utils.version_lt(api.api_version, WAIT_CONDITION_API_VERSION)
+
+
+def register_wait(api, container_id, condition='removed'):
+    """Register a wait for a container before it is started
+
+    The daemon sends the response header as soon as the wait is registered,
+    so the exit code isn't lost even if the container is removed (auto
+    remove) before the result is read. The SDK only offers a blocking wait,
+    so the request is sent through the low level client. Requires API
+    version 1.30 (see supports_wait_condition).
+
+    :returns: Function blocking until the condition is met and returning
+              the wait result (dict with 'StatusCode')
+    """
+    url = api._url('/containers/{0}/wait', container_id)
+    res = api._post(url, params={'condition': condition}, timeout=None, stream=True)
+    api._raise_for_status(res)
+
+    def _result():
+        try:
+            return res.json()
+        finally:
+            res.close()
+    return _result
+
+
 class BasicDockerApp(object):
 
     @classmethod
@@ -233,20 +1020,112 @@ class BasicDockerApp(object):
             volume_specs.append(volume_spec_to_string(normalize_volume_spec(i)))
         return volume_specs
 
-    def __init__(self, log, env=None):
+    def __init__(self, log, env=None, client=None):
         self._log = log
         self._env = env
-        self._dc = docker.from_env(environment=env)
+        if client is None:
+            client = docker.from_env(environment=env)
+        self._dc = client
+        self._image_cache = None
+        self.timings = Timings()
+        self.requests = RequestStats()
+
+    def _write_timings(self, path=None, fmt='jsonl'):
+        """Write the recorded spans if requested via argument or environment"""
+        env = os.environ if self._env is None else self._env
+        if path is None:
+            path = env.get(Timings.ENV_VARIABLE)
+        if not path:
+            return
+        try:
+            self.timings.write(path, fmt)
+        except OSError as e:
+            self._log.warning("Couldn't write timings to {0}: {1}".format(path, e))
+
+    def _count_requests(self):
+        """Start counting the Docker API requests of this launch"""
+        self.requests.clear()
+        self.requests.attach(self._dc)
+
+    def _report_requests(self, budget=None):
+        """Stop counting and log the requests (debug) and if the budget was exceeded
+
+        :returns: False if more requests than budget have been made
+        """
+        self.requests.detach()
+        self._log.debug(self.requests.summary())
+        count = self.requests.total["count"]
+        if budget is not None and count > budget:
+            self._log.warning("Docker API request budget exceeded: {0} > {1}".format(count, budget))
+            return False
+        return True
+
+    def _teardown(self, cobj, exited, remove, detach=False):
+        """Stop and remove a container as cheap as possible
+
+        Containers known to have exited aren't stopped, others are stopped
+        gracefully first. Removal is left to a detached reaper process if
+        detach is set, so the caller doesn't wait for the daemon (falls back
+        to removing synchronously).
+
+        :param exited: Container is known to have exited
+        :param remove: Remove the container
+        :param detach: Remove the container in the background
+        """
+        if not exited:
+            with self.timings.span("stop"):
+                cobj.stop()
+        if not remove:
+            return
+        if detach:
+            from . import reaper
+            env = None if self._env is None else {k: v for k, v in self._env.items()
+                                                  if k.startswith("DOCKER_")}
+            with self.timings.span("reaper"):
+                if reaper.spawn_reaper([cobj.id], env):
+                    self._log.debug("Container {0} is removed in the background".format(cobj.id))
+                    return
+        with self.timings.span("remove"):
+            cobj.remove()
+
+    def _inspect_image(self, image_spec, auto_pull=False):
+        """Return the attributes of an image (pulling it if requested)
+
+        Uses the image cache (if enabled), so the image is inspected at most once.
+        """
+        img, tag = self.normalize_image(image_spec)
+        image_spec = self.combine_image_spec(img, tag)  # ensure full image spec
+        if self._image_cache is not None:
+            with self.timings.span("image_cache"):
+                attrs = self._image_cache.get(image_spec)
+            if attrs is not None:
+                self._log.debug("Found image '{0}' in image cache".format(image_spec))
+                return attrs
+        try:
+            with self.timings.span("image_inspect"):
+                attrs = self._dc.images.get(image_spec).attrs
+            self._log.debug("Found image '{0}' locally".format(image_spec))
+        except docker.errors.ImageNotFound:
+            if not auto_pull:
+                raise
+            self._log.warning("Image '{0}' not found locally -> pull it".format(image_spec))
+            with self.timings.span("image_pull"):
+                attrs = self._dc.images.pull(img, tag).attrs
+        if self._image_cache is not None:
+            self._image_cache.put(image_spec, attrs)
+        return attrs
 
     def _assert_image_available(self, image_spec, auto_pull=False):
         img, tag = self.normalize_image(image_spec)
         image_spec = self.combine_image_spec(img, tag)  # ensure full image spec
         try:
-            self._dc.images.get(image_spec)
+            with self.timings.span("image_inspect"):
+                self._dc.images.get(image_spec)
             self._log.debug("Found image '{0}' locally".format(image_spec))
         except docker.errors.ImageNotFound:
             if auto_pull:
                 self._log.warning("Image '{0}' not found locally -> pull it".format(image_spec))
-                self._dc.images.pull(img, tag)
+                with self.timings.span("image_pull"):
+                    self._dc.images.pull(img, tag)
             else:
                 raise
@@ -0,0 +1,50 @@
+"""X11 settings of GUI containers
+
+Without MIT-SHM, X11 clients send every image through the socket. The
+extension requires the client and the X server to share the System V IPC
+namespace, so the container has to use the IPC namespace of the host.
+Containers with their own namespace get the variables disabling MIT-SHM in
+toolkits which would otherwise fail to attach the segments (f.e. Qt).
+"""
+import re
+import subprocess
+
+# toolkits trying MIT-SHM even if the X server can't attach the segments
+NO_MITSHM_ENV = {
+    "QT_X11_NO_MITSHM": "1",
+    "_X11_NO_MITSHM": "1",
+    "_MITSHM": "0",
+}
+# /dev/shm of containers with their own IPC namespace (default of docker: 64MB)
+DEFAULT_SHM_SIZE = "512m"
+
+_DISPLAY_RE = re.compile(r'^(?P<host>.*):(?P<display>\d+)(\.\d+)?$')
+
+
+def display_is_local(display):
+    """Return True if the display is served through a unix socket of this host"""
+    m = _DISPLAY_RE.match(display or '')
+    if m is None:
+        return False
+    host = m.group('host')
+    return host in ('', 'unix') or host.startswith('/')
+
+
+def mit_shm_supported(display, log, timeout=2.0):
+    """Check whether the X server of display supports MIT-SHM
+
+    :returns: True or False, None if it's unknown (xdpyinfo isn't available)
+    """
+    if not display_is_local(display):
+        log.debug("Display '{0}' isn't local -> no MIT-SHM".format(display))
+        return False
+    try:
+        proc = subprocess.run(['xdpyinfo', '-display', display], stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.debug("Couldn't query the X server using xdpyinfo: {0}".format(e))
+        return None
+    if proc.returncode != 0:
+        log.debug("xdpyinfo failed with {0}".format(proc.returncode))
+        return None
+    return b"MIT-SHM" in proc.stdout
@@ -0,0 +1,124 @@
+import os
+import time
+import hashlib
+import uuid
+import threading
+
+from . import dockerutils
+
+docker = dockerutils.LazyModule('docker')
+
+
+class ContainerPool(object):
+    """Pool of pre-created (stopped) containers per launch configuration
+
+    Pooled containers already got the entrypoint archive, so a claimed
+    container can be started right away. Containers are identified by labels,
+    so the pool is shared between all processes using the same daemon.
+    """
+    KEY_LABEL = dockerutils.LABEL_PREFIX + "pool.key"
+    CREATED_LABEL = dockerutils.LABEL_PREFIX + "pool.created"
+    NAME_PREFIX = "din-pool-"
+    CLAIMED_SUFFIX = "-claimed"
+
+    @staticmethod
+    def pool_key(image, creation_kwargs, archive):
+        """Key of a launch configuration (the container name is ignored)"""
+        kwargs = {k: v for k, v in creation_kwargs.items() if k != 'name'}
+        return dockerutils.hash_key(image, kwargs, hashlib.sha256(archive).hexdigest())
+
+    def __init__(self, client, log, size, max_age):
+        self._dc = client
+        self._log = log
+        self._size = size
+        self._max_age = max_age
+
+    def _list(self, key=None):
+        """Unclaimed pooled containers of the current user (oldest first)"""
+        label = self.KEY_LABEL if key is None else "{0}={1}".format(self.KEY_LABEL, key)
+        owner = "{0}={1}".format(dockerutils.OWNER_LABEL, os.getuid())
+        containers = self._dc.containers.list(all=True, filters={'label': [label, owner], 'status': 'created'})
+        # claimed containers keep their labels until they are started
+        containers = [i for i in containers if i.name.startswith(self.NAME_PREFIX) and
+                      not i.name.endswith(self.CLAIMED_SUFFIX)]
+        return sorted(containers, key=lambda c: float(c.labels.get(self.CREATED_LABEL, 0)))
+
+    def _expired(self, cobj, now):
+        return (now - float(cobj.labels.get(self.CREATED_LABEL, 0))) > self._max_age
+
+    def _remove(self, cobj):
+        try:
+            cobj.remove(force=True)
+        except docker.errors.APIError as e:
+            self._log.debug("Couldn't remove pooled container {0}: {1}".format(cobj.id, e))
+
+    def claim(self, key, name=None):
+        """Claim a pooled container for key
+
+        Claiming renames the container referenced by its pool name. Once a
+        claimer renamed it, the pool name doesn't resolve anymore (or the
+        claimed name is taken), so only one of several concurrent claimers
+        succeeds. The final name is set afterwards.
+
+        :param name: Optional final name of the container
+        :returns: Container object or None if the pool is empty
+        """
+        now = time.time()
+        for cobj in self._list(key):
+            if self._expired(cobj, now):
+                continue
+            try:
+                self._dc.api.rename(cobj.name, cobj.name + self.CLAIMED_SUFFIX)
+            except docker.errors.APIError as e:
+                self._log.debug("Pooled container {0} already claimed: {1}".format(cobj.id, e))
+                continue
+            self._log.debug("Claimed pooled container {0}".format(cobj.id))
+            if name is not None:
+                try:
+                    self._dc.api.rename(cobj.id, name)
+                except docker.errors.APIError as e:
+                    self._log.debug("Couldn't rename claimed container to {0}: {1}".format(name, e))
+                    self._remove(cobj)
+                    return None
+            return cobj
+        self._log.debug("No pooled container available for key {0}".format(key))
+        return None
+
+    def refill(self, key, factory):
+        """Evict expired containers and fill the pool of key up to its size
+
+        :param factory: Callable creating a container given name and labels
+        """
+        now = time.time()
+        for cobj in self._list():
+            if self._expired(cobj, now):
+                self._log.debug("Evict expired pooled container {0}".format(cobj.id))
+                self._remove(cobj)
+        available = self._list(key)
+        surplus = max(len(available) - self._size, 0)
+        for cobj in available[:surplus]:
+            self._log.debug("Evict surplus pooled container {0}".format(cobj.id))
+            self._remove(cobj)
+        for _ in range(self._size - len(available) + surplus):
+            labels = {
+                self.KEY_LABEL: key,
+                self.CREATED_LABEL: "{0:.3f}".format(time.time()),
+            }
+            name = "{0}{1}".format(self.NAME_PREFIX, uuid.uuid4().hex[:16])
+            cobj = factory(name, labels)
+            self._log.debug("Added container {0} to pool {1}".format(cobj.id, key))
+
+    def refill_async(self, key, factory):
+        """Refill the pool in a background thread
+
+        :returns: The started thread, join it before exiting
+        """
+        def _run():
+            # noinspection PyBroadException
+            try:
+                self.refill(key, factory)
+            except Exception:
+                self._log.exception("Failed to refill container pool")
+        thread = threading.Thread(target=_run, name="PoolRefill")
+        thread.start()
+        return thread
@@ -0,0 +1,333 @@
+"""Pull many images concurrently before they are needed
+
+Images are given on the command line or in a manifest file: JSON (a list
+or ``{"images": [...]}``) or plain text with one image per line::
+
+    # images of the nightly jobs
+    ubuntu:22.04
+    alpine:latest
+
+Layers shared between images are downloaded only once by the daemon, their
+progress is accounted once in the overall progress.
+
+With ``--history`` the most used images of the usage history are pulled, so
+their tags stay fresh. Launches using ``--auto-pull`` start this refresh in a
+detached process from time to time.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+import subprocess
+import concurrent.futures
+
+from . import dockerutils
+
+docker = dockerutils.LazyModule('docker')
+
+_DEFAULT_WORKERS = 4
+_DEFAULT_TOP = 10
+
+
+class ManifestError(RuntimeError):
+    def __init__(self, path, reason):
+        RuntimeError.__init__(self, "Invalid manifest '{0}': {1}".format(path, reason))
+        self.path = path
+
+
+def load_manifest(path):
+    """Load the image references of a manifest file"""
+    with open(path) as f:
+        text = f.read()
+    if text.lstrip().startswith(('[', '{')):
+        try:
+            spec = json.loads(text)
+        except ValueError as e:
+            raise ManifestError(path, e)
+        if isinstance(spec, dict):
+            spec = spec.get("images")
+        if not isinstance(spec, list):
+            raise ManifestError(path, "expected a list of images")
+        return [str(i) for i in spec]
+    images = list()
+    for line in text.splitlines():
+        line = line.split('#', 1)[0].strip()
+        if line:
+            images.append(line)
+    return images
+
+
+def format_bytes(size):
+    for unit in ("B", "kB", "MB", "GB"):
+        if size < 1000.0 or unit == "GB":
+            break
+        size /= 1000.0
+    return "{0:.1f} {1}".format(size, unit)
+
+
+class PullResult(object):
+    def __init__(self, image):
+        self.image = image
+        self.status = None
+        self.error = None
+        self.layers = set()
+        self.downloaded = set()
+        self.duration = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+
+class LayerProgress(object):
+    """Download progress of the layers of all concurrent pulls
+
+    Concurrent pulls of images sharing a layer report the same download,
+    progress is keyed by the layer id so it's counted once.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._layers = dict()
+        self.images_done = 0
+
+    def update(self, layer, current=None, total=None, done=False):
+        with self._lock:
+            entry = self._layers.setdefault(layer, [0, 0])
+            if total:
+                entry[1] = max(entry[1], total)
+            if done:
+                entry[0] = entry[1]
+            elif current is not None:
+                entry[0] = max(entry[0], current)
+
+    def total(self, layers=None):
+        """Tuple (current, total) of the downloads of layers (default: all)"""
+        with self._lock:
+            entries = [self._layers[i] for i in (layers if layers is not None else self._layers)
+                       if i in self._layers]
+        return sum(i[0] for i in entries), sum(i[1] for i in entries)
+
+
+class Prefetcher(object):
+    """Pull images with a bounded number of concurrent pulls
+
+    :param progress: Stream for a continuously updated progress line or None
+    """
+
+    def __init__(self, client, log, workers=_DEFAULT_WORKERS, progress=None):
+        self._dc = client
+        self._log = log
+        self._workers = max(1, workers)
+        self._stream = progress
+        self._layers = LayerProgress()
+        self._active = list()
+        self._count = 0
+        self._start = None
+        self._last_render = 0.0
+        self._lock = threading.Lock()
+
+    def _render(self, force=False):
+        if self._stream is None:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_render < 0.1:
+                return
+            self._last_render = now
+            active = " ".join(self._active)
+        current, total = self._layers.total()
+        rate = current / max(now - self._start, 1e-3)
+        line = "[{0}/{1}] {2} / {3}  {4}/s  {5}".format(
+            self._layers.images_done, self._count, format_bytes(current), format_bytes(total),
+            format_bytes(rate), active)
+        self._stream.write("\r\x1b[K" + line[:200])
+        self._stream.flush()
+
+    def _handle_event(self, result, event):
+        if 'error' in event:
+            result.error = event['error']
+            return
+        status = event.get('status', '')
+        layer = event.get('id')
+        if status.startswith("Status: "):
+            result.status = "up to date" if "up to date" in status else "pulled"
+        elif layer and status != layer and not status.startswith(("Pulling from", "Digest:")):
+            result.layers.add(layer)
+            detail = event.get('progressDetail') or {}
+            if status == "Downloading":
+                result.downloaded.add(layer)
+                self._layers.update(layer, detail.get('current'), detail.get('total'))
+            elif status in ("Download complete", "Pull complete") and layer in result.downloaded:
+                self._layers.update(layer, done=True)
+        self._render()
+
+    def _pull(self, image):
+        result = PullResult(image)
+        repository, tag = docker.utils.parse_repository_tag(image)
+        with self._lock:
+            self._active.append(image)
+        start = time.monotonic()
+        try:
+            for event in self._dc.api.pull(repository, tag=tag or 'latest', stream=True, decode=True):
+                self._handle_event(result, event)
+        except docker.errors.APIError as e:
+            result.error = "{0}".format(e)
+        if result.error is None and result.status is None:
+            result.status = "pulled"
+        result.duration = time.monotonic() - start
+        with self._lock:
+            self._active.remove(image)
+            self._layers.images_done += 1
+        if result.error is not None:
+            self._log.error("Couldn't pull {0}: {1}".format(image, result.error))
+        else:
+            self._log.debug("Pulled {0} in {1:.1f}s".format(image, result.duration))
+        self._render(force=True)
+        return result
+
+    def prefetch(self, images):
+        """Pull all images and return their results in the given order"""
+        self._count = len(images)
+        self._start = time.monotonic()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._workers) as executor:
+            results = list(executor.map(self._pull, images))
+        if self._stream is not None:
+            self._stream.write("\n")
+            self._stream.flush()
+        return results
+
+    def summary(self, results, stream):
+        width = max([len(r.image) for r in results] + [5])
+        stream.write("{0:<{w}}  {1:<10}  {2:>6}  {3:>10}  {4:>8}\n".format(
+            "image", "status", "layers", "downloaded", "time [s]", w=width))
+        for result in results:
+            status = "error" if result.error is not None else (result.status or "unknown")
+            downloaded, _ = self._layers.total(result.downloaded)
+            stream.write("{0:<{w}}  {1:<10}  {2:>6}  {3:>10}  {4:>8.1f}\n".format(
+                result.image, status, len(result.layers), format_bytes(downloaded),
+                result.duration or 0.0, w=width))
+        current, _ = self._layers.total()
+        failed = sum(1 for r in results if not r.succeeded)
+        stream.write("{0} images, {1} failed, {2} downloaded in {3:.1f}s\n".format(
+            len(results), failed, format_bytes(current), time.monotonic() - self._start))
+
+
+class PrefetchApp(dockerutils.BasicDockerApp):
+
+    def __init__(self, env=None, client=None):
+        log = logging.getLogger("DockerInside.Prefetch")
+        dockerutils.BasicDockerApp.__init__(self, log, env, client)
+        self._args = None
+
+    @staticmethod
+    def _parse_args(argv):
+        parser = argparse.ArgumentParser(prog="din prefetch",
+                                         description="Pull images concurrently before they are needed")
+        loglevel_group = parser.add_mutually_exclusive_group()
+        loglevel_group.add_argument('--verbose',
+                                    dest='loglevel',
+                                    action='store_const',
+                                    const=logging.DEBUG)
+        loglevel_group.add_argument('--quiet',
+                                    dest='loglevel',
+                                    action='store_const',
+                                    const=logging.ERROR)
+        parser.add_argument('-j', '--jobs',
+                            dest='workers',
+                            type=int,
+                            default=_DEFAULT_WORKERS,
+                            help="Number of concurrent pulls (default: {0})".format(_DEFAULT_WORKERS))
+        parser.add_argument('-f', '--file',
+                            dest='manifests',
+                            action='append',
+                            default=[],
+                            help="Manifest with images to pull (JSON or one image per line)")
+        parser.add_argument('--history',
+                            action='store_true',
+                            default=False,
+                            help="Pull the most used images of the usage history")
+        parser.add_argument('--top',
+                            type=int,
+                            default=_DEFAULT_TOP,
+                            help="Number of images used with --history (default: {0})".format(_DEFAULT_TOP))
+        parser.add_argument('--no-progress',
+                            dest='progress',
+                            action='store_false',
+                            default=True,
+                            help="Don't show a progress line (only shown on terminals)")
+        parser.add_argument('images',
+                            nargs='*',
+                            help="Images to pull")
+        parser.set_defaults(loglevel=logging.WARNING)
+        return parser.parse_args(args=argv)
+
+    def _images(self):
+        images = list()
+        for path in self._args.manifests:
+            images.extend(load_manifest(path))
+        images.extend(self._args.images)
+        if self._args.history:
+            images.extend(dockerutils.UsageHistory(self._log).top(self._args.top))
+        # keep the order, pull every image once
+        return list(dict.fromkeys(images))
+
+    def run(self, argv):
+        """Pull the requested images
+
+        :returns: 0 if all images have been pulled, 1 otherwise
+        """
+        self._args = self._parse_args(argv)
+        logging.getLogger().setLevel(self._args.loglevel)
+        try:
+            images = self._images()
+        except (OSError, ManifestError) as e:
+            self._log.error("{0}".format(e))
+            return 1
+        if not images:
+            self._log.error("No images to pull")
+            return 1
+        progress = sys.stderr if self._args.progress and sys.stderr.isatty() else None
+        prefetcher = Prefetcher(self._dc, self._log, self._args.workers, progress)
+        results = prefetcher.prefetch(images)
+        prefetcher.summary(results, sys.stdout)
+        return 0 if all(r.succeeded for r in results) else 1
+
+
+def spawn_refresh(top=_DEFAULT_TOP, env=None):
+    """Pull the most used images in a detached process
+
+    :param env: Optional environment used to connect to docker
+    :returns: True if the process has been started
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc_env = dict(os.environ)
+    proc_env.update(env or {})
+    proc_env['PYTHONPATH'] = os.pathsep.join(i for i in (package_root, proc_env.get('PYTHONPATH')) if i)
+    try:
+        subprocess.Popen(
+            [sys.executable, '-m', 'dockerinside.prefetch', '--history', '--top', str(top),
+             '--no-progress', '--quiet'],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=proc_env,
+            cwd='/',
+            start_new_session=True,
+        )
+    except OSError:
+        logging.getLogger("DockerInside.Prefetch").exception("Couldn't start image refresh")
+        return False
+    return True
+
+
+def prefetch_main(argv):
+    """Entry point of 'din prefetch'"""
+    return PrefetchApp().run(argv)
+
+
+if __name__ == '__main__':
+    sys.exit(prefetch_main(sys.argv[1:]))
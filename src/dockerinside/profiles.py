@@ -0,0 +1,119 @@
+"""Named launch profiles and cached launch plans
+
+A profile is a JSON file ``~/.config/docker_inside/profiles/<name>.json``
+holding the arguments of a launch without the command::
+
+    {"args": ["-H", "-v", "/src:/src", "ubuntu:22.04"]}
+
+``din @<name> -- make`` launches with these arguments. The container
+configuration computed for a profile launch is stored as launch plan, so
+later launches with the same inputs and image only have to create the
+container.
+"""
+import os
+import time
+import base64
+
+from . import dockerutils
+
+PROFILE_PREFIX = "@"
+
+
+class ProfileError(RuntimeError):
+    def __init__(self, name, reason):
+        RuntimeError.__init__(self, "Invalid profile '{0}': {1}".format(name, reason))
+        self.name = name
+
+
+def profile_path(name, home=None):
+    return os.path.join(dockerutils.config_dir(home), "profiles", name + ".json")
+
+
+def load_profile(name, home=None):
+    """Load the arguments of profile name"""
+    if not name or "/" in name or name.startswith("."):
+        raise ProfileError(name, "not a valid name")
+    path = profile_path(name, home)
+    spec = dockerutils.read_json(path)
+    if spec is None:
+        raise ProfileError(name, "{0} doesn't exist or isn't valid JSON".format(path))
+    if isinstance(spec, dict):
+        spec = spec.get("args")
+    if not isinstance(spec, list) or not all(isinstance(i, str) for i in spec):
+        raise ProfileError(name, "expected a list of arguments")
+    return spec
+
+
+def expand_argv(argv, home=None):
+    """Replace a leading @profile by the arguments of the profile
+
+    Arguments up to ``--`` are options added to the ones of the profile,
+    the rest is the command (``@profile [OPTIONS] -- CMD [ARGS]``). Without
+    ``--`` all arguments are the command.
+
+    :returns: Tuple (name of the profile or None, arguments)
+    """
+    if not argv or not argv[0].startswith(PROFILE_PREFIX):
+        return None, list(argv)
+    name = argv[0][len(PROFILE_PREFIX):]
+    rest = list(argv[1:])
+    options = list()
+    if "--" in rest:
+        split = rest.index("--")
+        options, rest = rest[:split], rest[split + 1:]
+    # options have to precede the image, which is part of the profile
+    return name, options + load_profile(name, home) + ["--"] + rest
+
+
+class LaunchPlans(object):
+    """On-disk store of launch plans
+
+    A plan holds what's needed to create the container of a launch: image,
+    creation arguments (without the ones set per invocation), environment
+    and the packed entrypoint archive. Plans are stored per digest of the
+    launch inputs and are only valid for the image id they were made for.
+    """
+    DIR_NAME = "plans"
+
+    def __init__(self, log, path=None):
+        if path is None:
+            path = os.path.join(dockerutils.config_dir(), self.DIR_NAME)
+        self._log = log
+        self._path = path
+
+    def _plan_path(self, key):
+        return os.path.join(self._path, key + ".json")
+
+    def get(self, key, image_id, max_age):
+        """Return the plan (dictionary) for key and image_id or None
+
+        :param max_age: Maximum age of the plan in seconds
+        """
+        plan = dockerutils.read_json(self._plan_path(key))
+        if not isinstance(plan, dict) or plan.get("image_id") != image_id:
+            return None
+        if time.time() - plan.get("created", 0) > max_age:
+            self._log.debug("Launch plan {0} expired".format(key))
+            return None
+        try:
+            plan["archive"] = base64.b64decode(plan["archive"])
+            kwargs = plan["creation_kwargs"]
+        except (KeyError, TypeError, ValueError):
+            return None
+        # JSON turned the (ip, port) bindings into lists
+        kwargs["ports"] = {k: tuple(v) if isinstance(v, list) else v
+                           for k, v in (kwargs.get("ports") or {}).items()}
+        return plan
+
+    def put(self, key, image_id, image, creation_kwargs, env, archive):
+        try:
+            dockerutils.write_json_atomic(self._plan_path(key), {
+                "image_id": image_id,
+                "created": time.time(),
+                "image": image,
+                "creation_kwargs": creation_kwargs,
+                "env": env,
+                "archive": base64.b64encode(archive).decode('ascii'),
+            })
+        except OSError as e:
+            self._log.debug("Couldn't write launch plan {0}: {1}".format(key, e))
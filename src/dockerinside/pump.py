@@ -0,0 +1,409 @@
+"""Forwarding between the terminal and the attach socket of a container
+
+The pump is driven by epoll (poll on other systems) and uses preallocated
+buffers: data is read into the buffer of a channel via readv() and written
+from a memoryview of it, so no bytes objects are created per chunk. A
+channel stops reading while its buffer hasn't been written completely, so
+memory is bounded by the buffer sizes.
+
+Without tty the output of a container is multiplexed into frames, the frame
+headers are parsed in place by DemuxChannel.
+"""
+import os
+import sys
+import errno
+import fcntl
+import select
+import signal
+import socket
+import struct
+import termios
+import contextlib
+
+from . import dockerutils
+
+SOCKET_BUFFER_SIZE = 1 << 20
+INPUT_BUFFER_SIZE = 1 << 16
+
+_IN = select.POLLIN
+_OUT = select.POLLOUT
+_ERR = select.POLLERR | select.POLLHUP
+_FRAME_HEADER = struct.Struct('>BxxxL')
+
+
+class _Poller(object):
+    """Level triggered epoll with fallback to poll
+
+    File descriptors epoll refuses (regular files, /dev/null) are reported
+    as always ready.
+    """
+
+    def __init__(self):
+        self._epoll = hasattr(select, 'epoll')
+        self._poller = select.epoll() if self._epoll else select.poll()
+        self._masks = dict()
+        self._always = set()
+
+    def set(self, fd, mask):
+        """Set the events of interest for fd (0 unregisters it)"""
+        old = self._masks.get(fd, 0)
+        if mask == old:
+            return
+        if not mask:
+            if fd in self._always:
+                self._always.discard(fd)
+            else:
+                self._poller.unregister(fd)
+            del self._masks[fd]
+            return
+        if not old:
+            try:
+                self._poller.register(fd, mask)
+            except PermissionError:
+                self._always.add(fd)
+        elif fd not in self._always:
+            self._poller.modify(fd, mask)
+        self._masks[fd] = mask
+
+    def poll(self, timeout=None):
+        if self._always:
+            timeout = 0
+        if self._epoll:
+            events = self._poller.poll(-1 if timeout is None else timeout)
+        else:
+            events = self._poller.poll(None if timeout is None else timeout * 1e3)
+        if self._always:
+            events = list(events) + [(fd, self._masks[fd]) for fd in self._always]
+        return events
+
+    def close(self):
+        if self._epoll:
+            self._poller.close()
+
+
+class Channel(object):
+    """Forward the data of one file descriptor to another one
+
+    :param on_eof: Called once when src reached the end and all data has
+                   been written to dst
+    """
+    __slots__ = ('src', 'dst', 'buf', 'view', 'start', 'end', 'eof', 'done', 'broken', 'on_eof')
+
+    def __init__(self, src, dst, size, on_eof=None):
+        self.src = src
+        self.dst = dst
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        self.eof = False
+        self.done = False
+        self.broken = False
+        self.on_eof = on_eof
+
+    @property
+    def pending(self):
+        return self.start < self.end
+
+    def _readinto(self, view):
+        """Read into view
+
+        :returns: Number of bytes read (0 at the end) or None if nothing was
+                  available
+        """
+        try:
+            n = os.readv(self.src, [view])
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return None
+            if e.errno not in (errno.EIO, errno.ECONNRESET):
+                raise
+            n = 0  # terminal hung up or connection reset: treat as end of input
+        if n == 0:
+            self.eof = True
+        return n
+
+    def _write(self, end):
+        """Write the buffer up to end
+
+        :returns: Number of bytes written
+        """
+        try:
+            n = os.write(self.dst, self.view[self.start:end])
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return 0
+            if e.errno not in (errno.EPIPE, errno.ECONNRESET, errno.EIO):
+                raise
+            # the reader went away: drop the data and don't forward more
+            self.start = self.end
+            self.eof = True
+            self.broken = True
+            return 0
+        self.start += n
+        return n
+
+    def read(self):
+        n = self._readinto(self.view)
+        if n is not None:
+            self.start = 0
+            self.end = n
+
+    def write(self):
+        self._write(self.end)
+
+    def check_done(self):
+        if self.eof and not self.pending and not self.done:
+            self.done = True
+            if self.on_eof is not None:
+                self.on_eof()
+        return self.done
+
+
+class DemuxChannel(Channel):
+    """Forward the attach stream of a container without tty
+
+    The payload of stdout frames is written to stdout_fd and the one of
+    stderr frames to stderr_fd.
+    """
+    __slots__ = ('targets', 'left')
+
+    def __init__(self, src, stdout_fd, stderr_fd, size, on_eof=None):
+        Channel.__init__(self, src, stdout_fd, size, on_eof)
+        self.targets = {dockerutils.STDOUT: stdout_fd, dockerutils.STDERR: stderr_fd}
+        self.left = 0  # payload of the current frame which hasn't been written
+
+    @property
+    def pending(self):
+        return self.left > 0 and self.start < self.end
+
+    def _parse(self):
+        while self.left == 0 and self.end - self.start >= _FRAME_HEADER.size:
+            stream, self.left = _FRAME_HEADER.unpack_from(self.buf, self.start)
+            self.start += _FRAME_HEADER.size
+            self.dst = self.targets.get(stream, self.targets[dockerutils.STDOUT])
+
+    def read(self):
+        # only an incomplete frame header can be left: move it to the front
+        rest = self.end - self.start
+        if rest:
+            self.buf[:rest] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = rest
+        n = self._readinto(self.view[rest:])
+        if n:
+            self.end += n
+            self._parse()
+
+    def write(self):
+        self.left -= self._write(min(self.end, self.start + self.left))
+        if self.broken:
+            self.left = 0
+        else:
+            self._parse()
+
+
+@contextlib.contextmanager
+def nonblocking(*fds):
+    """Set file descriptors non-blocking and restore the flags afterwards"""
+    flags = list()
+    try:
+        for fd in fds:
+            old = fcntl.fcntl(fd, fcntl.F_GETFL)
+            flags.append((fd, old))
+            fcntl.fcntl(fd, fcntl.F_SETFL, old | os.O_NONBLOCK)
+        yield
+    finally:
+        for fd, old in reversed(flags):
+            fcntl.fcntl(fd, fcntl.F_SETFL, old)
+
+
+@contextlib.contextmanager
+def raw_terminal(fd):
+    """Put the terminal fd into raw mode (does nothing if fd isn't a terminal)"""
+    if not os.isatty(fd):
+        yield
+        return
+    import tty
+    old = termios.tcgetattr(fd)
+    try:
+        tty.setraw(fd)
+        yield
+    finally:
+        termios.tcsetattr(fd, termios.TCSADRAIN, old)
+
+
+def terminal_size(fd):
+    """Return (rows, columns) of the terminal fd or None"""
+    try:
+        rows, columns, _, _ = struct.unpack('hhhh', fcntl.ioctl(fd, termios.TIOCGWINSZ, b'\0' * 8))
+    except OSError:
+        return None
+    if rows <= 0 or columns <= 0:
+        return None
+    return rows, columns
+
+
+class Pump(object):
+    """Forward channels until all output channels reached their end
+
+    :param channels: Channels to forward
+    :param output: Channels that have to be finished to stop the pump
+                   (default: all)
+    :param on_resize: Called without arguments on SIGWINCH (only works in the
+                      main thread)
+    """
+
+    def __init__(self, channels, output=None, on_resize=None):
+        self._channels = list(channels)
+        self._output = list(self._channels if output is None else output)
+        self._on_resize = on_resize
+
+    @contextlib.contextmanager
+    def _winch(self):
+        if self._on_resize is None:
+            yield None
+            return
+        wake_r, wake_w = os.pipe()
+        os.set_blocking(wake_r, False)
+        os.set_blocking(wake_w, False)
+
+        def _handler(signum, frame):
+            try:
+                os.write(wake_w, b"w")
+            except OSError:
+                pass  # a resize is already pending
+
+        try:
+            old_handler = signal.signal(signal.SIGWINCH, _handler)
+        except ValueError:  # not in the main thread
+            os.close(wake_r)
+            os.close(wake_w)
+            yield None
+            return
+        try:
+            yield wake_r
+        finally:
+            signal.signal(signal.SIGWINCH, old_handler)
+            os.close(wake_r)
+            os.close(wake_w)
+
+    def _interest(self):
+        masks = dict()
+        for ch in self._channels:
+            if ch.done:
+                continue
+            if ch.pending:
+                masks[ch.dst] = masks.get(ch.dst, 0) | _OUT
+            elif not ch.eof:
+                masks[ch.src] = masks.get(ch.src, 0) | _IN
+        return masks
+
+    def run(self):
+        poller = _Poller()
+        registered = set()
+        try:
+            with self._winch() as wake_fd:
+                if wake_fd is not None:
+                    poller.set(wake_fd, _IN)
+                while not all(ch.check_done() for ch in self._output):
+                    masks = self._interest()
+                    for fd in registered - set(masks):
+                        poller.set(fd, 0)
+                    for fd, mask in masks.items():
+                        poller.set(fd, mask)
+                    registered = set(masks)
+                    try:
+                        events = poller.poll()
+                    except InterruptedError:
+                        continue
+                    ready = dict(events)
+                    if wake_fd is not None and wake_fd in ready:
+                        try:
+                            os.read(wake_fd, 64)
+                        except BlockingIOError:
+                            pass
+                        self._on_resize()
+                    for ch in self._channels:
+                        if ch.done:
+                            continue
+                        if ch.pending:
+                            if ready.get(ch.dst, 0) & (_OUT | _ERR):
+                                ch.write()
+                        elif not ch.eof and ready.get(ch.src, 0) & (_IN | _ERR):
+                            ch.read()
+                            if ch.pending:
+                                ch.write()  # most of the time the target is writable
+                        ch.check_done()
+        finally:
+            poller.close()
+
+
+def attach_socket(sock):
+    """Return the plain socket of an attach socket returned by docker
+
+    :returns: socket.socket or None if the connection can't be used directly
+              (f.e. TLS or ssh connections)
+    """
+    raw = getattr(sock, '_sock', sock)
+    if not isinstance(raw, socket.socket):
+        return None
+    ssl = sys.modules.get('ssl')
+    if ssl is not None and isinstance(raw, ssl.SSLSocket):
+        return None
+    return raw
+
+
+def pty_session(sock, stdin_fd=0, stdout_fd=1, on_resize=None,
+                buffer_size=SOCKET_BUFFER_SIZE, input_size=INPUT_BUFFER_SIZE):
+    """Forward the terminal to the attach socket of a container with tty
+
+    Returns once the container closed the connection. The terminal is put
+    into raw mode for the duration of the session.
+
+    :param sock: Plain socket (see attach_socket())
+    :param on_resize: Called with (rows, columns) initially and on SIGWINCH
+    """
+    sock_fd = sock.fileno()
+
+    def _resize():
+        size = terminal_size(stdout_fd)
+        if size is not None and on_resize is not None:
+            on_resize(*size)
+
+    output = Channel(sock_fd, stdout_fd, buffer_size)
+    channels = [output, Channel(stdin_fd, sock_fd, input_size)]
+    with raw_terminal(stdin_fd):
+        _resize()
+        with nonblocking(*set(ch.src for ch in channels) | set(ch.dst for ch in channels)):
+            Pump(channels, output=[output], on_resize=_resize if on_resize else None).run()
+
+
+def stdio_session(sock, stdin_fd=0, stdout_fd=1, stderr_fd=2,
+                  buffer_size=SOCKET_BUFFER_SIZE, input_size=INPUT_BUFFER_SIZE):
+    """Forward stdio to the attach socket of a container without tty
+
+    The input is sent until its end, then the sending direction of the socket
+    is shut down, so the container sees the end of its stdin. Returns once the
+    container closed the connection.
+
+    :param sock: Plain socket (see attach_socket())
+    :param stdin_fd: Input file descriptor or None to only forward the output
+    :returns: False if the reader of stdout or stderr went away before all
+              output has been written
+    """
+    sock_fd = sock.fileno()
+
+    def _close_input():
+        try:
+            sock.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass  # container has already closed the connection
+
+    output = DemuxChannel(sock_fd, stdout_fd, stderr_fd, buffer_size)
+    channels = [output]
+    if stdin_fd is not None:
+        channels.append(Channel(stdin_fd, sock_fd, input_size, on_eof=_close_input))
+    with nonblocking(*set(i for i in (stdin_fd, stdout_fd, stderr_fd, sock_fd) if i is not None)):
+        Pump(channels, output=[output]).run()
+    return not output.broken
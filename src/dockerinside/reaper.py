@@ -0,0 +1,60 @@
+"""Detached removal of containers
+
+The reaper runs as a separate process in its own session, so the terminal is
+returned to the user while the daemon removes the container. The request
+(container ids and docker environment) is passed as JSON via stdin.
+"""
+import os
+import sys
+import json
+import logging
+import subprocess
+
+from . import dockerutils
+
+docker = dockerutils.LazyModule('docker')
+
+
+def spawn_reaper(container_ids, env=None):
+    """Remove containers in a detached process
+
+    :param env: Optional environment used to connect to docker
+    :returns: True if the reaper has been started
+    """
+    package_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    proc_env = dict(os.environ)
+    proc_env['PYTHONPATH'] = os.pathsep.join(i for i in (package_root, proc_env.get('PYTHONPATH')) if i)
+    try:
+        proc = subprocess.Popen(
+            [sys.executable, '-m', 'dockerinside.reaper'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            env=proc_env,
+            cwd='/',
+            start_new_session=True,
+        )
+        proc.stdin.write(json.dumps({"containers": list(container_ids), "env": env}).encode('utf-8'))
+        proc.stdin.close()
+    except OSError:
+        logging.getLogger("DockerInside.Reaper").exception("Couldn't start reaper")
+        return False
+    return True
+
+
+def reap(container_ids, env=None):
+    client = docker.from_env(environment=env)
+    for cid in container_ids:
+        try:
+            client.api.remove_container(cid, force=True)
+        except docker.errors.NotFound:
+            pass
+
+
+def reaper_main():
+    request = json.loads(sys.stdin.read())
+    reap(request["containers"], request.get("env"))
+
+
+if __name__ == '__main__':
+    reaper_main()
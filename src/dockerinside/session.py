@@ -0,0 +1,197 @@
+"""Persistent session containers
+
+A session container is provisioned once and kept running by a keepalive
+script. Later launches with the same configuration run their command in it
+through exec instead of creating, provisioning and removing a container. The
+keepalive exits once the session has been idle for a while and the daemon
+removes the container.
+"""
+import math
+import time
+
+from . import dockerutils
+
+docker = dockerutils.LazyModule('docker')
+
+SESSION_SCRIPT = b"""#!/bin/sh
+# keepalive SECONDS: Keep the container running until it's idle for SECONDS
+# exec COMMAND [ARGS...]: Run a command of the session
+
+STATE_DIR="/tmp/.docker_inside_session"
+
+keepalive() {
+    local idle="$1"
+    local busy=""
+
+    mkdir -p "${STATE_DIR}" || exit 1
+    touch "${STATE_DIR}/active"
+    echo "din-session-ready"
+    while true; do
+        touch "${STATE_DIR}/ref"
+        sleep "${idle}"
+        # a command finished in the meantime
+        if [ -n "$(find "${STATE_DIR}" -name active -newer "${STATE_DIR}/ref")" ]; then
+            continue
+        fi
+        # a command is still running (remove files of killed commands)
+        busy=""
+        for f in "${STATE_DIR}"/[0-9]*; do
+            if [ -d "/proc/${f##*/}" ]; then
+                busy=1
+            else
+                rm -f "${f}"
+            fi
+        done
+        [ -n "${busy}" ] || exit 0
+    done
+}
+
+run() {
+    local ret=0
+
+    touch "${STATE_DIR}/$$"
+    "$@"
+    ret=$?
+    rm -f "${STATE_DIR}/$$"
+    touch "${STATE_DIR}/active"
+    exit ${ret}
+}
+
+case "$1" in
+    keepalive)
+        keepalive "$2" ;;
+    exec)
+        shift
+        run "$@" ;;
+esac
+echo "ERROR: Unknown mode '$1'" >&2
+exit 1
+"""
+
+
+class Session(object):
+    """Session container of a launch configuration
+
+    The container name is derived from the configuration, so all processes
+    using the same daemon share the session.
+    """
+    KEY_LABEL = dockerutils.LABEL_PREFIX + "session.key"
+    NAME_PREFIX = "din-session-"
+    SCRIPT_NAME = "docker_inside_session.sh"
+    READY = b"din-session-ready"
+    # differences which don't matter for commands run through exec
+    IGNORED_KWARGS = ('name', 'command', 'tty', 'stdin_open', 'auto_remove')
+    # only known after the first session has probed the image
+    IGNORED_ENV = ('DIN_SWITCH_METHOD', 'DIN_BUSYBOXUSR')
+    # states of a container which is still going to become ready
+    STARTING_STATES = ('created', 'running')
+    POLL_INTERVAL = 0.1
+
+    @classmethod
+    def session_key(cls, image, creation_kwargs, archive):
+        """Key of a launch configuration"""
+        kwargs = {k: v for k, v in creation_kwargs.items() if k not in cls.IGNORED_KWARGS}
+        kwargs['environment'] = {k: v for k, v in (kwargs.get('environment') or {}).items()
+                                 if k not in cls.IGNORED_ENV}
+        return dockerutils.hash_key(image, kwargs, dockerutils.hash_key(archive.hex()))
+
+    @classmethod
+    def pack_config(cls):
+        """Entries of the entrypoint archive needed by session containers"""
+        return {
+            cls.SCRIPT_NAME: {
+                "payload": SESSION_SCRIPT,
+                "mode": 0o755,
+            }
+        }
+
+    def __init__(self, client, log, key):
+        self._dc = client
+        self._log = log
+        self.key = key
+        self.name = self.NAME_PREFIX + key[:16]
+
+    @property
+    def script(self):
+        return dockerutils.linux_pjoin('/', self.SCRIPT_NAME)
+
+    def keepalive_command(self, idle):
+        # the script counts whole seconds
+        return [self.script, "keepalive", "{0:d}".format(max(1, int(math.ceil(idle))))]
+
+    def labels(self):
+        return {self.KEY_LABEL: self.key}
+
+    def start(self, factory):
+        """Create and start the session container and wait until it's ready
+
+        If another process is creating the session at the same time, only
+        its readiness is awaited. A stopping session container still holds
+        the name, so its removal is awaited before the session is recreated.
+
+        :param factory: Callable creating the container given name and labels
+        :returns: The created container or None if it has been created by
+                  another process
+        """
+        for attempt in range(2):
+            try:
+                cobj = factory(self.name, self.labels())
+                break
+            except docker.errors.APIError as e:
+                if e.status_code != 409:
+                    raise
+                container_id = self._starting()
+                if container_id is not None:
+                    self._log.debug("Session {0} is created by another process".format(self.name))
+                    self._wait_ready(container_id)
+                    return None
+                if attempt > 0:
+                    raise
+        cobj.start()
+        self._wait_ready(cobj.id)
+        return cobj
+
+    def _starting(self):
+        """Return the id of the container holding the name if it's starting
+
+        Otherwise wait until the container is gone: its logs contain the
+        ready line of the old keepalive.
+        """
+        try:
+            info = self._dc.api.inspect_container(self.name)
+        except docker.errors.NotFound:
+            return None
+        if (info.get('State') or {}).get('Status') in self.STARTING_STATES:
+            return info['Id']
+        self._log.debug("Waiting for the removal of session container {0}".format(info['Id']))
+        try:
+            if dockerutils.supports_wait_condition(self._dc.api):
+                self._dc.api.wait(info['Id'], condition='removed')
+                return None
+            while True:
+                self._dc.api.inspect_container(info['Id'])
+                time.sleep(self.POLL_INTERVAL)
+        except docker.errors.NotFound:
+            return None
+
+    def _wait_ready(self, container_id):
+        stream = self._dc.api.logs(container_id, stdout=True, stderr=False, stream=True, follow=True)
+        tail = b""
+        try:
+            for chunk in stream:
+                tail += chunk
+                if self.READY in tail:
+                    self._log.debug("Session {0} is ready".format(self.name))
+                    return
+                tail = tail[-len(self.READY):]
+        finally:
+            stream.close()
+        raise dockerutils.ContainerError(self.name, "Session container exited during start-up")
+
+    def exec_create(self, cmd, user, tty=False, stdin=False, stderr=True):
+        """Create an exec instance running cmd in the session
+
+        :returns: Id of the exec instance
+        """
+        return self._dc.api.exec_create(self.name, [self.script, "exec"] + list(cmd),
+                                        stdin=stdin, tty=tty, stderr=stderr, user=user)['Id']
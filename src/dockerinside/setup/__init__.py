@@ -1,39 +1,45 @@
 import os
+import re
 import sys
 import errno
+import hashlib
 import argparse
 import logging
-
-import docker
-import docker.errors
+import subprocess
 
 from .. import dockerutils
 
+docker = dockerutils.LazyModule('docker')
+
 _DEFAULT_LOG_FORMAT = "%(name)s : %(threadName)s : %(levelname)s : %(message)s"
-logging.basicConfig(
-    stream=sys.stderr,
-    format=_DEFAULT_LOG_FORMAT,
-    level=logging.INFO,
-)
 
 SETUP_SCRPT = b"""#!/bin/sh
 
 set -e
-apk add --no-cache git musl-dev gcc
+if ! command -v gcc >/dev/null 2>&1 || [ ! -e /usr/lib/libc.a ]; then
+    apk add --no-cache musl-dev gcc
+fi
 
-cd /tmp
-git clone -b "${DIN_REFSPEC}" "${DIN_SU_EXEC_URL}" su-exec
-cd su-exec
+if [ ! -f /tmp/src/su-exec.c ]; then
+    command -v git >/dev/null 2>&1 || apk add --no-cache git
+    git clone -b "${DIN_REFSPEC}" "${DIN_SU_EXEC_URL}" /tmp/src
+fi
+cd /tmp/src
 
-gcc -static su-exec.c -o su-exec
-cp -v su-exec /din_config/
-chown "${DIN_UID}:${DIN_GID}" /din_config/su-exec
+mkdir -p /tmp/out
+gcc -static su-exec.c -o /tmp/out/su-exec
+sha256sum su-exec.c | cut -d " " -f 1 > /tmp/out/source.sha256
+if [ -d .git ]; then
+    git rev-parse HEAD > /tmp/out/commit
+fi
 """
 
 
 class SetupApp(dockerutils.BasicDockerApp):
     DEFAULT_SU_EXEC_URL = "https://github.com/ncopa/su-exec.git"
     DEFAULT_IMAGE = "alpine:3.6"
+    STORE_DIR = "store"
+    MANIFEST_NAME = "manifest.json"
     PASSED_HOST_ENV = (
         'https_proxy', 'http_proxy',
         'HTTPS_PROXY', 'HTTP_PROXY',
@@ -70,22 +76,197 @@ class SetupApp(dockerutils.BasicDockerApp):
                             action="store_true",
                             default=False,
                             help="Allow access to host network (f.e. if using a proxy on locahost)")
+        source_grp = parser.add_mutually_exclusive_group()
+        source_grp.add_argument('--source',
+                                metavar='DIR',
+                                help="Build su-exec from a local source directory instead of --url")
+        parser.add_argument('--check',
+                            action="store_true",
+                            default=False,
+                            help="Only verify the installed binary against the manifest (no docker)")
+        parser.add_argument('--force',
+                            action="store_true",
+                            default=False,
+                            help="Provide the binary again even if the manifest matches")
+        source_grp.add_argument('--binary',
+                                metavar='PATH',
+                                help="Install a prebuilt su-exec binary (no container is run)")
+        parser.add_argument('--builder-image',
+                            default=cls.DEFAULT_IMAGE,
+                            help="Alpine based image used to compile su-exec "
+                                 "(default: {0})".format(cls.DEFAULT_IMAGE))
+        parser.add_argument('--offline',
+                            action="store_true",
+                            default=False,
+                            help="Build without network access (requires --source and a builder "
+                                 "image with gcc and musl-dev)")
+        parser.add_argument('--timings',
+                            metavar='FILE',
+                            help="Write timings of the setup phases to FILE ('-' for stderr)")
+        parser.add_argument('--timings-format',
+                            choices=dockerutils.Timings.FORMATS,
+                            default='jsonl',
+                            help="JSON lines (appended) or trace event file (default: jsonl)")
         parser.set_defaults(loglevel=logging.INFO)
         args = parser.parse_args(args=argv)
+        if args.offline and args.source is None:
+            parser.error("--offline requires --source")
         return args
 
-    def __init__(self, env=None):
+    def __init__(self, env=None, client=None):
         log = logging.getLogger("DockerInside.Setup")
         self._args = None
-        dockerutils.BasicDockerApp.__init__(self, log, env)
+        dockerutils.BasicDockerApp.__init__(self, log, env, client)
+
+    def _store_path(self, cfg_path, store_key):
+        return os.path.join(cfg_path, self.STORE_DIR, store_key, 'su-exec')
+
+    def _store(self, cfg_path, store_key, payload, info):
+        """Store a built binary content addressed and return its path"""
+        path = self._store_path(cfg_path, store_key)
+        dockerutils.write_file_atomic(path, payload, 0o755)
+        dockerutils.write_json_atomic(os.path.join(os.path.dirname(path), 'info.json'), info)
+        return path
+
+    def _install(self, cfg_path, stored, request, commit=None):
+        """Copy a stored binary to the location used by docker-inside
+
+        Records the request together with the binary hash in the manifest.
+        """
+        target = os.path.join(cfg_path, 'su-exec')
+        with self.timings.span("install"):
+            with open(stored, 'rb') as f:
+                dockerutils.write_file_atomic(target, f.read(), 0o755)
+        manifest = dict(request)
+        manifest.update({
+            "commit": commit,
+            "binary": dockerutils.file_digest(target),
+            "store": os.path.basename(os.path.dirname(stored)),
+        })
+        dockerutils.write_json_atomic(os.path.join(cfg_path, self.MANIFEST_NAME), manifest)
+        self._log.info("Installed su-exec from {0}".format(os.path.dirname(stored)))
+
+    @classmethod
+    def check(cls, home=None):
+        """Verify the installed binary against the manifest
+
+        :returns: 0 if the binary is installed unmodified, 1 otherwise
+        """
+        log = logging.getLogger("DockerInside.Setup")
+        cfg_path = dockerutils.config_dir(home)
+        manifest = dockerutils.read_json(os.path.join(cfg_path, cls.MANIFEST_NAME))
+        if not isinstance(manifest, dict) or not manifest.get("binary"):
+            log.error("No setup manifest found in {0}".format(cfg_path))
+            return 1
+        target = os.path.join(cfg_path, 'su-exec')
+        if not os.access(target, os.X_OK):
+            log.error("su-exec binary {0} is missing or not executable".format(target))
+            return 1
+        if dockerutils.file_digest(target) != manifest["binary"]:
+            log.error("su-exec binary {0} doesn't match the manifest".format(target))
+            return 1
+        log.info("su-exec is installed ({0})".format(manifest.get("commit") or manifest.get("source")))
+        return 0
+
+    def _up_to_date(self, cfg_path, request):
+        """Check if the manifest matches the request and the binary is intact"""
+        manifest = dockerutils.read_json(os.path.join(cfg_path, self.MANIFEST_NAME))
+        if not isinstance(manifest, dict):
+            return False
+        if any(manifest.get(k) != v for k, v in request.items()):
+            self._log.debug("Setup manifest doesn't match the request")
+            return False
+        try:
+            return dockerutils.file_digest(os.path.join(cfg_path, 'su-exec')) == manifest.get("binary")
+        except OSError:
+            return False
+
+    @staticmethod
+    def _source_pack(source):
+        """Pack all files of a local su-exec source directory to /tmp/src"""
+        pack_conf = dict()
+        for root, dirs, files in os.walk(source):
+            dirs[:] = [i for i in dirs if i != '.git']
+            for i in files:
+                path = os.path.join(root, i)
+                if os.path.isfile(path):
+                    rel_path = os.path.relpath(path, source).replace(os.sep, '/')
+                    pack_conf["tmp/src/" + rel_path] = {"file": path, "mode": 0o644}
+        return pack_conf
+
+    def _resolve_commit(self, url, refspec, timeout=30.0):
+        """Resolve refspec of the repository at url to a commit using git ls-remote
 
-    def setup(self, url, home=None, auto_pull=False, name=None, refspec=None):
-        if home is None:
-            home = os.path.expanduser('~')
+        :returns: Commit id or None if it couldn't be resolved
+        """
+        if re.match(r'^[0-9a-f]{40}$', refspec):
+            return refspec
+        try:
+            proc = subprocess.run(['git', 'ls-remote', url, refspec, refspec + '^{}'], stdout=subprocess.PIPE,
+                                  stderr=subprocess.DEVNULL, timeout=timeout)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            self._log.debug("Couldn't run git ls-remote: {0}".format(e))
+            return None
+        if proc.returncode != 0:
+            self._log.debug("git ls-remote failed with {0}".format(proc.returncode))
+            return None
+        refs = dict()
+        for line in proc.stdout.decode('utf-8', 'replace').splitlines():
+            commit, _, ref = line.partition("\t")
+            refs[ref] = commit
+        # annotated tags are peeled to the commit checked out by the build
+        for ref in ("refs/heads/" + refspec, "refs/tags/" + refspec + "^{}", "refs/tags/" + refspec):
+            if ref in refs:
+                return refs[ref]
+        return None
+
+    @staticmethod
+    def _git_store_key(commit, image_id, architecture):
+        return dockerutils.hash_key("git", commit, image_id, architecture)
+
+    def _fetch(self, cobj, path):
+        chunks, _ = cobj.get_archive(path)
+        payload, _ = dockerutils.tar_unpack_file(chunks)
+        if payload is None:
+            raise dockerutils.ContainerError(cobj.id, "Missing build output {0}".format(path))
+        return payload
+
+    def setup(self, url, home=None, auto_pull=False, name=None, refspec=None,
+              source=None, binary=None, image=None, force=False):
+        """Provide the su-exec binary in the configuration directory
+
+        Nothing is done if the manifest of the last setup matches the request
+        (unless force is set). Binaries are stored content addressed by source
+        hash (commit for git sources), builder image id and architecture, so
+        known builds are installed without a container.
+
+        :param source: Local su-exec source directory (instead of url)
+        :param binary: Prebuilt su-exec binary (no container is run at all)
+        :param image: Builder image (default: DEFAULT_IMAGE)
+        :returns: 0 on success
+        """
         if refspec is None:
             refspec = 'master'
-        self._assert_image_available(self.DEFAULT_IMAGE, auto_pull)
-        cfg_path = os.path.join(home, '.config', 'docker_inside')
+        if image is None:
+            image = self.DEFAULT_IMAGE
+        cfg_path = self._config_path(home)
+        if binary is not None:
+            return self._setup_binary(cfg_path, binary, force)
+        image_info = self._inspect_image(image, auto_pull)
+        request = self._request(url, refspec, source, image_info)
+        if self._skip(cfg_path, request, force):
+            return 0
+        commit = None
+        if source is None:
+            with self.timings.span("resolve"):
+                commit = self._resolve_commit(url, refspec)
+        if self._install_stored(cfg_path, request, image_info, commit):
+            return 0
+        return self._build(cfg_path, request, image, image_info, url, refspec, source, name)
+
+    def _config_path(self, home):
+        """Create the configuration directory if needed and return its path"""
+        cfg_path = dockerutils.config_dir(home)
         self._log.debug("Configuration directory (host): {0}".format(cfg_path))
         try:
             os.makedirs(cfg_path, 0o755)
@@ -94,18 +275,82 @@ class SetupApp(dockerutils.BasicDockerApp):
                 logging.debug("Directory '{0}' already exists".format(cfg_path))
             else:
                 raise
-        script_pack = dockerutils.tar_pack({
+        return cfg_path
+
+    def _skip(self, cfg_path, request, force):
+        """Check if the manifest of the last setup matches the request"""
+        if force or not self._up_to_date(cfg_path, request):
+            return False
+        if request["mode"] == "git":
+            self._log.info("su-exec is up to date (use --force to update {0})".format(request["refspec"]))
+        else:
+            self._log.info("su-exec is up to date")
+        return True
+
+    def _setup_binary(self, cfg_path, binary, force):
+        """Install a prebuilt binary"""
+        dockerutils._assert_path_exists(binary, 'file')
+        with open(binary, 'rb') as f:
+            payload = f.read()
+        digest = hashlib.sha256(payload).hexdigest()
+        request = {"mode": "binary", "source": digest}
+        if self._skip(cfg_path, request, force):
+            return 0
+        stored = self._store(cfg_path, dockerutils.hash_key("binary", digest), payload, {
+            "binary": digest,
+        })
+        self._install(cfg_path, stored, request)
+        return 0
+
+    @staticmethod
+    def _request(url, refspec, source, image_info):
+        """Request of a build recorded in the manifest"""
+        if source is None:
+            return {"mode": "git", "url": url, "refspec": refspec, "image": image_info["Id"]}
+        dockerutils._assert_path_exists(os.path.join(source, 'su-exec.c'), 'file')
+        source_digest = dockerutils.file_digest(os.path.join(source, 'su-exec.c'))
+        return {"mode": "source", "source": source_digest, "image": image_info["Id"]}
+
+    def _install_stored(self, cfg_path, request, image_info, commit=None):
+        """Install the binary of a known build
+
+        :param commit: Resolved commit of a git build (None if unknown)
+        :returns: False if the build isn't stored
+        """
+        architecture = image_info.get("Architecture")
+        if request["mode"] == "source":
+            store_key = dockerutils.hash_key(request["source"], image_info["Id"], architecture)
+        elif commit is not None:
+            store_key = self._git_store_key(commit, image_info["Id"], architecture)
+        else:
+            return False
+        stored = self._store_path(cfg_path, store_key)
+        if not os.path.isfile(stored):
+            return False
+        if commit is None:
+            self._log.info("su-exec has already been built from these sources")
+        else:
+            self._log.info("su-exec has already been built from commit {0}".format(commit))
+        self._install(cfg_path, stored, request, commit)
+        return True
+
+    def _build(self, cfg_path, request, image, image_info, url, refspec, source=None, name=None):
+        """Build su-exec in a container, store and install it
+
+        :returns: Exit code of the build
+        """
+        architecture = image_info.get("Architecture")
+        pack_conf = {
             "entrypoint.sh": {
                 "payload": SETUP_SCRPT,
                 "mode": 0o755,
             }
-        })
-        volumes = self.volume_args_to_list([
-            "{0}:/din_config".format(cfg_path)
-        ])
+        }
+        if source is not None:
+            pack_conf.update(self._source_pack(source))
+        with self.timings.span("tar_pack"):
+            script_pack = dockerutils.tar_pack(pack_conf)
         env = {
-            "DIN_UID": os.getuid(),
-            "DIN_GID": os.getgid(),
             "DIN_SU_EXEC_URL": url,
             "DIN_REFSPEC": refspec,
         }
@@ -113,32 +358,62 @@ class SetupApp(dockerutils.BasicDockerApp):
         env.update(host_env)
         logging.debug("Prepared environment: %s", host_env)
         network_mode = 'host' if self._args.host_network else None
+        if self._args.offline:
+            network_mode = 'none'
         logging.debug("Network mode: %s", "default" if network_mode is None else network_mode)
-        cobj = self._dc.containers.create(
-            self.DEFAULT_IMAGE,
-            command="/entrypoint.sh",
-            volumes=volumes,
-            environment=env,
-            name=name,
-            network=network_mode
-        )
+        with self.timings.span("create"):
+            cobj = self._dc.containers.create(
+                image,
+                command="/entrypoint.sh",
+                environment=env,
+                name=name,
+                network=network_mode,
+                labels=dockerutils.ownership_labels(),
+            )
+        exited = False
         try:
-            cobj.put_archive('/', script_pack)
-            cobj.start()
-            for msg in cobj.logs(stdout=True, stderr=True, stream=True):
-                logging.debug("{0}".format(msg.decode('utf-8').rstrip('\n')))
-            ret = cobj.wait()
+            with self.timings.span("put_archive"):
+                cobj.put_archive('/', script_pack)
+            with self.timings.span("start"):
+                cobj.start()
+            with self.timings.span("build"):
+                for msg in cobj.logs(stdout=True, stderr=True, stream=True):
+                    logging.debug("{0}".format(msg.decode('utf-8').rstrip('\n')))
+            with self.timings.span("wait"):
+                ret = cobj.wait()
+            exited = True
             status_code = ret.get('StatusCode', None)
             logging.info("setup returned %s", status_code)
+            if status_code != 0:
+                return status_code
+            with self.timings.span("fetch"):
+                payload = self._fetch(cobj, "/tmp/out/su-exec")
+                source_digest = self._fetch(cobj, "/tmp/out/source.sha256").decode('ascii').strip()
+                commit = None
+                if source is None:
+                    commit = self._fetch(cobj, "/tmp/out/commit").decode('ascii').strip()
+            if source is None:
+                store_key = self._git_store_key(commit, image_info["Id"], architecture)
+            else:
+                store_key = dockerutils.hash_key(source_digest, image_info["Id"], architecture)
+            stored = self._store(cfg_path, store_key, payload, {
+                "source": source_digest,
+                "image": image_info["Id"],
+                "architecture": architecture,
+                "commit": commit,
+            })
+            self._install(cfg_path, stored, request, commit)
             return status_code
         finally:
-            cobj.stop()
-            cobj.remove()
+            self._teardown(cobj, exited, remove=True)
 
     def run(self, argv):
         ret = 1
         self._args = self._parse_args(argv)
         logging.getLogger().setLevel(self._args.loglevel)
+        self.timings.clear()
+        self.timings.update_context(app="setup", image=self._args.builder_image)
+        self._count_requests()
         # noinspection PyBroadException
         try:
             ret = self.setup(
@@ -146,18 +421,35 @@ class SetupApp(dockerutils.BasicDockerApp):
                 home=self._args.home,
                 auto_pull=self._args.auto_pull,
                 name=self._args.name,
-                refspec=self._args.refspec
+                refspec=self._args.refspec,
+                source=self._args.source,
+                binary=self._args.binary,
+                image=self._args.builder_image,
+                force=self._args.force,
             )
         except dockerutils.InvalidPath as e:
             logging.exception("{0} '{1}' doesn't exist".format(e.type_, e.path))
         except docker.errors.ImageNotFound:
-            logging.exception("Image '{0}' not found".format(self.DEFAULT_IMAGE))
+            logging.exception("Image '{0}' not found".format(self._args.builder_image))
         except Exception:
             logging.exception("Failed to run setup()")
         finally:
+            self._report_requests()
+            self._write_timings(self._args.timings, self._args.timings_format)
             return ret
 
 
 def setup_main():
+    logging.basicConfig(
+        stream=sys.stderr,
+        format=_DEFAULT_LOG_FORMAT,
+        level=logging.INFO,
+    )
+    argv = sys.argv[1:]
+    args = SetupApp._parse_args(argv)
+    if args.check:
+        # no docker client required
+        logging.getLogger().setLevel(args.loglevel)
+        sys.exit(SetupApp.check(args.home))
     app = SetupApp()
-    app.run(sys.argv[1:])
+    sys.exit(app.run(argv))
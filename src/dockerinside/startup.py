@@ -0,0 +1,73 @@
+import sys
+import time
+import builtins
+import contextlib
+
+PROFILE_SWITCH = "--profile-startup"
+
+
+class StartupProfiler(object):
+    """Measure import times per module and named setup phases
+
+    Only modules imported after install() are measured. Import times are
+    inclusive, i.e. they contain the imports done by the module itself.
+    din-fast loads this module from its file and installs the profiler
+    before importing docker-inside, so it must only use the standard library.
+    """
+
+    def __init__(self, stream=None):
+        self._stream = stream
+        self._installed = False
+        self._original_import = None
+        self._start = time.perf_counter()
+        self._imports = dict()
+        self._phases = list()
+
+    def _import(self, name, *args, **kwargs):
+        level = kwargs.get('level', args[3] if len(args) > 3 else 0)
+        if level or name in sys.modules or name in self._imports:
+            return self._original_import(name, *args, **kwargs)
+        self._imports[name] = None
+        start = time.perf_counter()
+        try:
+            return self._original_import(name, *args, **kwargs)
+        finally:
+            self._imports[name] = time.perf_counter() - start
+
+    def install(self):
+        if self._installed:
+            return
+        self._start = time.perf_counter()
+        self._original_import = builtins.__import__
+        builtins.__import__ = self._import
+        self._installed = True
+
+    def uninstall(self):
+        if not self._installed:
+            return
+        builtins.__import__ = self._original_import
+        self._installed = False
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            if self._installed:
+                self._phases.append((name, time.perf_counter() - start))
+
+    def report(self, limit=20):
+        """Write the measurements to stream (default: stderr) and uninstall"""
+        if not self._installed:
+            return
+        total = time.perf_counter() - self._start
+        self.uninstall()
+        stream = self._stream if self._stream is not None else sys.stderr
+        stream.write("startup profile (total {0:.1f} ms)\n".format(total * 1e3))
+        for name, duration in self._phases:
+            stream.write("  phase  {0:>9.1f} ms  {1}\n".format(duration * 1e3, name))
+        imports = sorted(((d, n) for n, d in self._imports.items() if d is not None), reverse=True)
+        for duration, name in imports[:limit]:
+            stream.write("  import {0:>9.1f} ms  {1}\n".format(duration * 1e3, name))
+        stream.flush()
@@ -0,0 +1,72 @@
+import os
+import sys
+import json
+import pytest
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def batch():
+    from dockerinside import batch
+    return batch
+
+
+def _write(tmp_path, spec):
+    path = tmp_path / "jobs.json"
+    path.write_text(json.dumps(spec))
+    return str(path)
+
+
+# noinspection PyShadowingNames
+def test_load_jobs(batch, tmp_path):
+    path = _write(tmp_path, {
+        "parallel": 3,
+        "common": ["--auto-pull"],
+        "jobs": [
+            {"name": "ubuntu id", "args": ["ubuntu:22.04", "--", "id", "-u"]},
+            ["alpine:latest", "true"],
+        ]
+    })
+    jobs, parallel = batch.load_jobs(path)
+    assert parallel == 3
+    assert [j.name for j in jobs] == ["ubuntu id", "job1"]
+    assert jobs[0].slug == "ubuntu-id"
+    assert jobs[0].argv == ["--auto-pull", "ubuntu:22.04", "--", "id", "-u"]
+    assert jobs[1].argv == ["--auto-pull", "alpine:latest", "true"]
+    jobs, parallel = batch.load_jobs(_write(tmp_path, [["busybox", "true"]]))
+    assert parallel is None
+    assert jobs[0].argv == ["busybox", "true"]
+
+
+# noinspection PyShadowingNames
+def test_load_invalid_jobs(batch, tmp_path):
+    with pytest.raises(batch.JobFileError):
+        batch.load_jobs(_write(tmp_path, {"jobs": {"a": 1}}))
+    with pytest.raises(batch.JobFileError):
+        batch.load_jobs(_write(tmp_path, [{"name": "no args"}]))
+
+
+# noinspection PyShadowingNames
+def test_output_per_job(batch, tmp_path, monkeypatch):
+    class _App(object):
+        def __init__(self, container_name, env=None):
+            self.returncode = None
+
+        def run(self, argv, capture_stdout=False):
+            self.returncode = 0
+            return " ".join(argv).encode()
+
+    monkeypatch.setattr(batch, "_BatchInsideApp", _App)
+    jobs, _ = batch.load_jobs(_write(tmp_path, [
+        {"name": "a b", "args": ["ubuntu", "first"]},
+        {"name": "a/b", "args": ["ubuntu", "second"]},
+        {"name": "a b", "args": ["ubuntu", "third"]},
+    ]))
+    output_dir = tmp_path / "logs"
+    batch.BatchRunner(jobs, 3, str(output_dir)).run()
+    assert sorted(os.listdir(str(output_dir))) == ["0-a-b.log", "1-a-b.log", "2-a-b.log"]
+    assert (output_dir / "2-a-b.log").read_bytes() == b"ubuntu third"
@@ -0,0 +1,76 @@
+import os
+import sys
+import logging
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def collect():
+    """collect module"""
+    from dockerinside import collect
+    return collect
+
+
+class _Api(object):
+    def __init__(self, containers):
+        self.containers_ = containers
+        self.filters = None
+        self.removed = list()
+
+    def containers(self, all=False, filters=None):
+        self.filters = filters
+        return list(self.containers_)
+
+    def _url(self, path, cid):
+        return path.format(cid)
+
+    def _get(self, url, params=None):
+        return url
+
+    def _result(self, url, json=False):
+        return {"SizeRw": 1000 if "gone" not in url else None}
+
+    def remove_container(self, cid, force=False):
+        import docker
+        if cid == "gone":
+            raise docker.errors.NotFound("No such container")
+        if cid == "busy":
+            raise docker.errors.APIError("removal in progress")
+        self.removed.append(cid)
+
+
+class _Client(object):
+    def __init__(self, api):
+        self.api = api
+
+
+def _summary(cid, created):
+    from dockerinside import dockerutils
+    return {"Id": cid, "Labels": {dockerutils.CREATED_LABEL: "{0:.3f}".format(created)}, "Created": 0}
+
+
+# noinspection PyShadowingNames
+def test_collect_find(collect):
+    from dockerinside import dockerutils
+    now = 1000000.0
+    api = _Api([_summary("old", now - 7200), _summary("new", now - 60), {"Id": "unlabeled", "Created": 0}])
+    collector = collect.GarbageCollector(_Client(api), logging.getLogger("test"), owner="1000")
+    assert [i["Id"] for i in collector.find(3600, now=now)] == ["old", "unlabeled"]
+    assert api.filters["label"] == [dockerutils.OWNER_LABEL + "=1000"]
+    assert "running" not in api.filters["status"]
+    collector = collect.GarbageCollector(_Client(api), logging.getLogger("test"))
+    collector.find(3600, running=True, now=now)
+    assert api.filters == {"label": [dockerutils.OWNER_LABEL]}
+
+
+# noinspection PyShadowingNames
+def test_collect_remove(collect):
+    api = _Api([])
+    collector = collect.GarbageCollector(_Client(api), logging.getLogger("test"), workers=2)
+    containers = [{"Id": i} for i in ("a", "b", "gone", "busy", "c")]
+    assert collector.remove(containers) == (4, 3000)
+    assert sorted(api.removed) == ["a", "b", "c"]
@@ -0,0 +1,75 @@
+import os
+import sys
+import socket
+import pytest
+
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def daemon():
+    from dockerinside import daemon
+    return daemon
+
+
+# noinspection PyShadowingNames
+def test_socket_path(daemon):
+    assert daemon.socket_path({"DIN_DAEMON_SOCKET": "/tmp/x.sock"}) == "/tmp/x.sock"
+    assert daemon.socket_path({"XDG_RUNTIME_DIR": "/run/user/1000"}) == \
+        "/run/user/1000/docker_inside/din.sock"
+    assert not daemon.client_enabled({"DIN_DAEMON": "0", "DIN_DAEMON_SOCKET": __file__})
+    assert daemon.client_enabled({"DIN_DAEMON_SOCKET": __file__})
+
+
+# noinspection PyShadowingNames
+def test_message_with_fds(daemon):
+    a, b = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+    r, w = os.pipe()
+    try:
+        daemon._send_msg(a, {"argv": ["ubuntu", "id"]}, fds=[r, w, w])
+        daemon._send_msg(a, {"signal": "winch"})
+        msg, fds = daemon._recv_msg(b, with_fds=True)
+        assert msg == {"argv": ["ubuntu", "id"]}
+        assert len(fds) == 3
+        os.write(fds[1], b"ping")
+        assert os.read(r, 4) == b"ping"
+        for fd in fds:
+            os.close(fd)
+        assert daemon._recv_msg(b) == ({"signal": "winch"}, [])
+        a.close()
+        with pytest.raises(EOFError):
+            daemon._recv_msg(b)
+    finally:
+        b.close()
+        os.close(r)
+        os.close(w)
+
+
+# noinspection PyShadowingNames
+def test_client_after_request(daemon, tmpdir):
+    import threading
+    path = str(tmpdir.join("din.sock"))
+    env = {"DIN_DAEMON_SOCKET": path}
+    assert daemon.run_client(["ubuntu", "id"], env) is None
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+
+    def _serve():
+        conn, _ = server.accept()
+        _, fds = daemon._recv_msg(conn, with_fds=True)
+        for fd in fds:
+            os.close(fd)
+        # the request got lost without a reply
+        conn.close()
+
+    thread = threading.Thread(target=_serve)
+    thread.start()
+    try:
+        assert daemon.run_client(["ubuntu", "id"], env) == 1
+    finally:
+        thread.join()
+        server.close()
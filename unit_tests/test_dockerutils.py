@@ -148,3 +148,316 @@ def test_basicdockerapp(du):
         "::rw",
         "::::::::"
     ]
+
+
+# noinspection PyShadowingNames
+def test_hash_key(du):
+    key = du.hash_key("sha256:abc", [1000, "user"], "")
+    assert key == du.hash_key("sha256:abc", [1000, "user"], "")
+    assert key != du.hash_key("sha256:abd", [1000, "user"], "")
+    assert key != du.hash_key("sha256:abc", [1001, "user"], "")
+    assert du.hash_key({"b": 1, "a": 2}) == du.hash_key({"a": 2, "b": 1})
+    assert du.config_dir("/home/test") == "/home/test/.config/docker_inside"
+
+
+# noinspection PyShadowingNames
+def test_merge_identity_files(du):
+    passwd = "root:x:0:0:root:/root:/bin/bash\nubuntu:x:1000:1000::/home/ubuntu:/bin/sh\n"
+    assert du.merge_passwd(passwd, "ubuntu", 1001, 1001, "/home/ubuntu") == (passwd, False)
+    assert du.merge_passwd(passwd, "other", 1000, 1000, "/home/other") == (passwd, False)
+    merged, added = du.merge_passwd(passwd, "user", 1234, 1235, "/home/user")
+    assert added
+    assert merged.split("\n")[-2] == "user:x:1234:1235::/home/user:/bin/sh"
+    shadow = du.merge_shadow("root:*:19000:0:99999:7:::\n", "user")
+    assert shadow.split("\n")[-2].startswith("user:!:")
+    assert du.merge_shadow(shadow, "user") == shadow
+    group = "root:x:0:\nsudo:x:27:\naudio:x:29:pulse\n"
+    merged = du.merge_group(group, "user", ("user", 1235),
+                            [("sudo", 1300), ("audio", 29), ("docker", 27), ("dev", 1400)])
+    assert merged == "root:x:0:\nsudo:x:27:user\naudio:x:29:pulse,user\nuser:x:1235:\ndev:x:1400:user\n"
+    assert du.merge_group(merged, "user", ("user", 1235), [("sudo", 27), ("dev", 1400)]) == merged
+
+
+# noinspection PyShadowingNames
+def test_tar_unpack_file(du):
+    archive = du.tar_pack({"etc/passwd": {"payload": b"root:x:0:0::/root:/bin/sh\n", "mode": 0o644}})
+    payload, info = du.tar_unpack_file([archive[:100], archive[100:]])
+    assert payload == b"root:x:0:0::/root:/bin/sh\n"
+    assert info.mode == 0o644
+
+
+# noinspection PyShadowingNames
+def test_tar_pack_memoized(du, tmp_path):
+    binary = tmp_path / "su-exec"
+    binary.write_bytes(b"\x7fELF-v1")
+    conf = {
+        "docker_inside.sh": {"payload": b"#!/bin/sh\n", "mode": 0o755},
+        "/bin/su-exec": {"file": str(binary), "mode": 0o755},
+    }
+    first = du.tar_pack(conf)
+    assert du.tar_pack(dict(conf)) is first
+    payload, info = du.tar_unpack_file([du.tar_pack({"bin/su-exec": conf["/bin/su-exec"]})])
+    assert payload == b"\x7fELF-v1"
+    assert (info.mode, info.uid, info.gid) == (0o755, 0, 0)
+    binary.write_bytes(b"\x7fELF-version2")
+    second = du.tar_pack(conf)
+    assert second is not first
+    assert second != first
+
+
+# noinspection PyShadowingNames
+def test_image_cache(du, tmp_path):
+    class _Api:
+        base_url = "http+docker://localhost"
+
+    class _Client:
+        api = _Api()
+        events_list = []
+
+        def events(self, **kwargs):
+            return iter(self.events_list)
+
+    client = _Client()
+    path = str(tmp_path / "image-cache.json")
+    log = logging.getLogger("test_image_cache")
+    attrs = {"Id": "sha256:1", "Config": {"Env": ["A=1"], "Entrypoint": None, "Cmd": ["sh"], "Labels": {}}}
+    cache = du.ImageCache(client, log, path)
+    assert cache.get("ubuntu:latest") is None
+    cache.put("ubuntu:latest", attrs)
+    cache.put("alpine:3.6", dict(attrs, Id="sha256:2"))
+    cache = du.ImageCache(client, log, path)
+    assert cache.get("ubuntu:latest")["Config"]["Cmd"] == ["sh"]
+    client.events_list = [
+        {"Action": "tag", "Actor": {"ID": "sha256:9", "Attributes": {"name": "ubuntu:latest"}}},
+    ]
+    cache = du.ImageCache(client, log, path)
+    assert cache.get("ubuntu:latest") is None
+    assert cache.get("alpine:3.6")["Id"] == "sha256:2"
+    client.events_list = [{"Action": "delete", "Actor": {"ID": "sha256:2", "Attributes": {}}}]
+    assert du.ImageCache(client, log, path).get("alpine:3.6") is None
+    client.events_list = []
+    du.ImageCache(client, log, path).put("alpine:3.6", dict(attrs, Id="sha256:3"))
+    assert du.ImageCache(client, log, path).get("alpine:3.6")["Id"] == "sha256:3"
+    _Api.base_url = "http+docker://localnpipe"
+    assert du.ImageCache(client, log, path).get("alpine:3.6")["Id"] == "sha256:3"
+    for url in ("https://remote:2376", "http+docker://ssh"):
+        _Api.base_url = url
+        assert du.ImageCache(client, log, path).get("alpine:3.6") is None
+
+
+# noinspection PyShadowingNames
+def test_demux_stream(du):
+    import io
+    import struct
+    payload = b"".join([
+        struct.pack('>BxxxL', 1, 5), b"hello",
+        struct.pack('>BxxxL', 2, 3), b"err",
+        struct.pack('>BxxxL', 1, 10), b"0123456789",
+    ])
+    f = io.BytesIO(payload)
+    # read at most 3 bytes at once to exercise partial reads
+    chunks = list(du.demux_stream(lambda n: f.read(min(n, 3)), max_chunk=4))
+    assert all(len(c) <= 4 for _, c in chunks)
+    assert b"".join(c for s, c in chunks if s == du.STDOUT) == b"hello0123456789"
+    assert b"".join(c for s, c in chunks if s == du.STDERR) == b"err"
+    truncated = io.BytesIO(payload[:12])
+    assert list(du.demux_stream(truncated.read)) == [(du.STDOUT, b"hell")]
+
+
+# noinspection PyShadowingNames
+def test_timings(du, tmp_path):
+    import json
+    timings = du.Timings()
+    seen = []
+    timings.add_listener(seen.append)
+    timings.update_context(image="ubuntu:22.04")
+    with timings.span("create"):
+        pass
+    with pytest.raises(KeyError):
+        with timings.span("put_archive", size=10):
+            raise KeyError()
+    assert [i["name"] for i in timings.spans] == ["create", "put_archive"]
+    assert seen == timings.spans
+    assert timings.spans[1]["size"] == 10
+    assert all(i["image"] == "ubuntu:22.04" and i["duration"] >= 0 for i in seen)
+    path = str(tmp_path / "timings.jsonl")
+    timings.write(path)
+    timings.write(path)
+    with open(path) as f:
+        assert len([json.loads(i) for i in f]) == 4
+    trace = str(tmp_path / "trace.json")
+    timings.write(trace, 'trace')
+    with open(trace) as f:
+        events = json.load(f)["traceEvents"]
+    assert [i["ph"] for i in events] == ["X", "X"]
+    timings.clear()
+    assert timings.spans == []
+
+
+# noinspection PyShadowingNames
+def test_teardown(du, monkeypatch):
+    from dockerinside import reaper
+    calls = []
+
+    class Container(object):
+        id = "c0"
+
+        def stop(self):
+            calls.append("stop")
+
+        def remove(self, force=False):
+            calls.append(("remove", force))
+
+    app = du.BasicDockerApp(logging.getLogger("test"), env={}, client=object())
+    app._teardown(Container(), exited=True, remove=False)
+    app._teardown(Container(), exited=True, remove=True)
+    app._teardown(Container(), exited=False, remove=True)
+    # running containers are stopped gracefully before removal
+    assert calls == [("remove", False), "stop", ("remove", False)]
+    del calls[:]
+    app._teardown(Container(), exited=False, remove=False)
+    assert calls == ["stop"]
+    monkeypatch.setattr(reaper, "spawn_reaper", lambda ids, env: not calls.append(("reaper", ids, env)))
+    del calls[:]
+    app._teardown(Container(), exited=True, remove=True, detach=True)
+    assert calls == [("reaper", ["c0"], {})]
+    del calls[:]
+    app._teardown(Container(), exited=False, remove=True, detach=True)
+    assert calls == ["stop", ("reaper", ["c0"], {})]
+
+
+# noinspection PyShadowingNames
+def test_supports_wait_condition(du):
+    class Api(object):
+        def __init__(self, version):
+            self.api_version = version
+
+    assert du.supports_wait_condition(Api("1.30"))
+    assert du.supports_wait_condition(Api("1.41"))
+    assert not du.supports_wait_condition(Api("1.26"))
+
+
+# noinspection PyShadowingNames
+def test_cached_user_groups(du, monkeypatch, tmp_path):
+    import grp
+    lookups = []
+
+    def _getgrouplist(user, gid):
+        lookups.append(user)
+        return [gid, 20, 1000, 20]
+
+    monkeypatch.setattr(os, "getgrouplist", _getgrouplist)
+    monkeypatch.setattr(os, "getgroups", lambda: [1000, 20])
+    monkeypatch.setattr(du, "_current_user", lambda: "user")
+    monkeypatch.setattr(grp, "getgrgid", lambda gid: grp.struct_group(("g{0}".format(gid), "x", gid, [])))
+    path = str(tmp_path / "groups.json")
+    expected = [du.GroupEntry("g20", 20), du.GroupEntry("g1000", 1000)]
+    assert du.cached_user_groups("user", 100, 60, path=path) == expected
+    assert du.cached_user_groups("user", 100, 60, path=path) == expected
+    assert len(lookups) == 1
+    du.cached_user_groups("user", 100, 60, refresh=True, path=path)
+    du.cached_user_groups("user", 100, 0, path=path)
+    assert len(lookups) == 3
+    # the process is in a group that isn't cached -> resolve again
+    monkeypatch.setattr(os, "getgroups", lambda: [1000, 20, 30])
+    du.cached_user_groups("user", 100, 60, path=path)
+    assert len(lookups) == 4
+
+
+# noinspection PyShadowingNames
+def test_switch_cache(du, tmp_path):
+    probe = du.SwitchCache.parse_probe("method=runuser\nbusyboxusr=\ngarbage\n")
+    assert probe == {"method": "runuser", "busyboxusr": ""}
+    cache = du.SwitchCache(logging.getLogger("test"), path=str(tmp_path / "switch.json"))
+    assert cache.get("a") is None
+    cache.put("a", probe["method"], probe["busyboxusr"])
+    cache.put("b", "su-exec", "1")
+    assert cache.get("a") == {"method": "runuser", "busyboxusr": None, "time": cache.get("a")["time"]}
+    assert cache.get("b")["busyboxusr"] == "1"
+
+
+# noinspection PyShadowingNames
+def test_usage_history(du, tmp_path):
+    history = du.UsageHistory(logging.getLogger("test"), path=str(tmp_path / "history.jsonl"))
+    assert history.top(3) == []
+    now = 1000000000
+    week = du.UsageHistory.HALF_LIFE
+    for i in range(3):
+        history.record("old:latest", "sha256:1", now - 4 * week + i)
+    history.record("recent:latest", "sha256:2", now - 60)
+    history.record("often:latest", "sha256:3", now - week)
+    history.record("often:latest", "sha256:3", now - week)
+    with open(str(tmp_path / "history.jsonl"), 'a') as f:
+        f.write("{truncated\n")
+    assert len(history.records()) == 6
+    assert history.top(2, now) == ["often:latest", "recent:latest"]
+    assert history.top(5, now) == ["often:latest", "recent:latest", "old:latest"]
+    assert history.claim_refresh(3600, now)
+    assert not history.claim_refresh(3600, now + 60)
+    assert history.claim_refresh(3600, now + 3601)
+
+
+# noinspection PyShadowingNames
+def test_request_stats(du):
+    import datetime
+
+    class Request(object):
+        def __init__(self, method, path_url, body=None):
+            self.method = method
+            self.path_url = path_url
+            self.body = body
+
+    class Response(object):
+        def __init__(self, request, length=None):
+            self.request = request
+            self.headers = {} if length is None else {"Content-Length": str(length)}
+            self.elapsed = datetime.timedelta(milliseconds=2)
+
+    class Api(object):
+        hooks = {'response': []}
+
+    class Client(object):
+        api = Api()
+
+    assert du.RequestStats.endpoint("GET", "/v1.41/containers/abc123/json") == "GET /containers/{id}/json"
+    assert du.RequestStats.endpoint("POST", "/v1.41/containers/create") == "POST /containers/create"
+    assert du.RequestStats.endpoint("GET", "/v1.41/containers/json") == "GET /containers/json"
+    assert du.RequestStats.endpoint("GET", "/images/library/ubuntu:22.04/json") == "GET /images/{name}/json"
+    assert du.RequestStats.endpoint("DELETE", "/images/sha256:abc") == "DELETE /images/{name}"
+    stats = du.RequestStats()
+    client = Client()
+    stats.attach(client)
+    for hook in list(client.api.hooks['response']):
+        hook(Response(Request("PUT", "/v1.41/containers/a/archive?path=%2F", b"x" * 10)))
+        hook(Response(Request("PUT", "/v1.41/containers/b/archive?path=%2F", b"x" * 5), 0))
+        hook(Response(Request("GET", "/v1.41/containers/a/logs"), 7))
+    stats.detach()
+    assert client.api.hooks['response'] == []
+    assert stats.endpoints["PUT /containers/{id}/archive"]["count"] == 2
+    assert stats.total == {"count": 3, "sent": 15, "received": 7, "elapsed": 0.006}
+    assert stats.summary().startswith("Docker API: 3 requests")
+
+
+# noinspection PyShadowingNames
+def test_write_json_atomic_threads(du, tmp_path):
+    import concurrent.futures
+    path = str(tmp_path / "cache" / "images.json")
+    payload = {"x" * 64: list(range(2000))}
+
+    def _write(i):
+        du.write_json_atomic(path, dict(payload, writer=i))
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(_write, range(64)))
+    assert du.read_json(path)["x" * 64] == payload["x" * 64]
+    assert os.listdir(str(tmp_path / "cache")) == ["images.json"]
+
+
+# noinspection PyShadowingNames
+def test_write_file_atomic_binary(du, tmp_path):
+    path = str(tmp_path / "store" / "su-exec")
+    du.write_file_atomic(path, b"\x7fELF", 0o755)
+    with open(path, 'rb') as f:
+        assert f.read() == b"\x7fELF"
+    assert os.stat(path).st_mode & 0o777 == 0o755
+    assert os.listdir(str(tmp_path / "store")) == ["su-exec"]
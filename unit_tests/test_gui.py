@@ -0,0 +1,59 @@
+import os
+import sys
+import logging
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def gui():
+    """gui module"""
+    from dockerinside import gui
+    return gui
+
+
+# noinspection PyShadowingNames
+def test_gui_display_is_local(gui):
+    assert gui.display_is_local(":0")
+    assert gui.display_is_local(":1.0")
+    assert gui.display_is_local("unix:0")
+    assert gui.display_is_local("/private/tmp/com.apple.launchd.xyz/org.xquartz:0")
+    assert not gui.display_is_local("localhost:10.0")
+    assert not gui.display_is_local("")
+    assert not gui.display_is_local("wayland-0")
+
+
+# noinspection PyShadowingNames
+def test_gui_mit_shm_supported(gui, tmpdir, monkeypatch):
+    log = logging.getLogger("test")
+    monkeypatch.setenv("PATH", str(tmpdir))
+    assert gui.mit_shm_supported(":0", log) is None
+    xdpyinfo = tmpdir.join("xdpyinfo")
+    xdpyinfo.write("#!/bin/sh\n"
+                   "[ \"$2\" = \":0\" ] || exit 1\n"
+                   "printf 'number of extensions:    2\\n    BIG-REQUESTS\\n    MIT-SHM\\n'\n")
+    xdpyinfo.chmod(0o755)
+    assert gui.mit_shm_supported(":0", log) is True
+    assert gui.mit_shm_supported(":1", log) is None
+    assert gui.mit_shm_supported("localhost:10.0", log) is False
+    xdpyinfo.write("#!/bin/sh\necho 'number of extensions:    1'\necho '    BIG-REQUESTS'\n")
+    assert gui.mit_shm_supported(":0", log) is False
+
+
+# noinspection PyShadowingNames
+def test_gui_settings(gui, tmpdir, monkeypatch):
+    import dockerinside
+    monkeypatch.setenv("PATH", str(tmpdir))
+    app = dockerinside.DockerInsideApp(env={}, client=object())
+    app._args = app._parse_args(["--gui", "ubuntu:22.04"])
+    env = {"DISPLAY": ":0"}
+    assert app._gui_settings(env) == {}
+    assert env == {"DISPLAY": ":0"}
+    app._args = app._parse_args(["--gui-shm", "ubuntu:22.04"])
+    assert app._gui_settings(env) == {'ipc_mode': 'host', 'shm_size': None}
+    env = {"DISPLAY": "localhost:10.0"}
+    assert app._gui_settings(env) == {'shm_size': gui.DEFAULT_SHM_SIZE}
+    assert env["QT_X11_NO_MITSHM"] == "1"
@@ -80,3 +80,63 @@ def test_user_id_docker(tapp, image):
         args.insert(0, '--verbose')
     txt = tapp.run(args, capture_stdout=True)
     assert "{0}".format(os.getuid()) == "\n".join(_filter_norm_text(txt))
+
+
+# noinspection PyShadowingNames
+def test_request_budget(tapp):
+    args = ['--auto-pull', '--name=di_simple_setup_test', 'alpine:latest', '--', 'id', '-u']
+    tapp.run(args, capture_stdout=True)  # warm up: pull and probe the image
+    txt = tapp.run(args, capture_stdout=True)
+    assert "{0}".format(os.getuid()) == "\n".join(_filter_norm_text(txt))
+    # image, create (and inspect), put_archive, wait, start, logs (and inspect), remove
+    assert tapp.requests.total["count"] <= 10, tapp.requests.summary()
+    tapp.run(args[:1] + args[2:])
+    # no logs and no remove with auto remove, but attach to stream stdio
+    assert tapp.requests.total["count"] <= 8, tapp.requests.summary()
+
+
+def test_prepared_image_env():
+    import dockerinside
+    env = dockerinside.DockerInsideApp._prepared_image_env(["PATH=/bin", "DIN_USER=base"], {"DIN_USER": "user", "DIN_UID": "1000"})
+    assert env == ["PATH=/bin", "DIN_USER=base", "DIN_UID="]
+
+
+# noinspection PyShadowingNames
+def test_prepared_image_docker(tapp):
+    args = ['--auto-pull', '--prepare-image', '--name=di_prepared_image_test',
+            'alpine:latest', '--', 'echo', 'prepared']
+    # the first launch commits the prepared image, the second one only uses it
+    for _ in range(2):
+        txt = tapp.run(args, capture_stdout=True)
+        assert "prepared" == "\n".join(_filter_norm_text(txt))
+
+
+def test_create_container_cleanup():
+    import docker
+    import dockerinside
+
+    class _Container(object):
+        id = "c1"
+        removed = False
+
+        def put_archive(self, path, data):
+            raise docker.errors.APIError("No space left on device")
+
+        def remove(self, force=False):
+            self.removed = force
+
+    class _Containers(object):
+        cobj = _Container()
+
+        def create(self, image, **kwargs):
+            return self.cobj
+
+    class _Client(object):
+        containers = _Containers()
+
+    app = dockerinside.DockerInsideApp(env={}, client=_Client())
+    app._args = app._parse_args(["ubuntu:22.04", "--", "make"])
+    with pytest.raises(docker.errors.APIError):
+        app._create_container("ubuntu:22.04", {"environment": {}}, app._pack_config(None), {})
+    # the container doesn't leak if it couldn't be provisioned
+    assert _Containers.cobj.removed
@@ -0,0 +1,111 @@
+import os
+import sys
+import logging
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def pool():
+    """pool module"""
+    from dockerinside import pool
+    return pool
+
+
+class _Container(object):
+    def __init__(self, cid, name, labels, daemon=None):
+        self.id = cid
+        self.name = name
+        self.labels = labels
+        self._daemon = daemon
+
+    def remove(self, force=False):
+        self._daemon.containers.pop(self.id)
+        self._daemon.removed.append(self.id)
+
+
+class _Daemon(object):
+    """Containers by id, renamed like the daemon does"""
+
+    def __init__(self):
+        self.containers = dict()
+        self.removed = list()
+
+    def _lookup(self, ref):
+        import docker
+        for cobj in self.containers.values():
+            if ref in (cobj.id, cobj.name):
+                return cobj
+        raise docker.errors.NotFound("No such container: {0}".format(ref))
+
+    def rename(self, ref, name):
+        import docker
+        cobj = self._lookup(ref)
+        if any(i.name == name for i in self.containers.values()):
+            raise docker.errors.APIError("Conflict: name {0} is in use".format(name))
+        cobj.name = name
+
+    def list(self, all=False, filters=None):
+        # the daemon returns snapshots of the containers
+        wanted = [i.partition('=')[::2] for i in filters['label']]
+        return [_Container(i.id, i.name, dict(i.labels), self) for i in self.containers.values()
+                if not [k for k, v in wanted if k not in i.labels or (v and i.labels[k] != v)]]
+
+
+class _Client(object):
+    def __init__(self, daemon):
+        self.api = daemon
+        self.containers = daemon
+
+
+def _pooled(daemon, cid, key, created, owner=None):
+    from dockerinside import pool
+    labels = {pool.ContainerPool.KEY_LABEL: key, pool.ContainerPool.CREATED_LABEL: "{0:.3f}".format(created),
+              pool.dockerutils.OWNER_LABEL: str(os.getuid() if owner is None else owner)}
+    daemon.containers[cid] = _Container(cid, pool.ContainerPool.NAME_PREFIX + cid, labels)
+
+
+# noinspection PyShadowingNames
+def test_pool_claim_once(pool):
+    import time
+    daemon = _Daemon()
+    _pooled(daemon, "a", "key", time.time())
+    container_pool = pool.ContainerPool(_Client(daemon), logging.getLogger("test"), 1, 3600)
+    # both claimers listed the pool before the first claim
+    stale = daemon.list(filters={'label': [pool.ContainerPool.KEY_LABEL]})
+    claimed = container_pool.claim("key", "foo")
+    assert claimed.id == "a" and daemon.containers["a"].name == "foo"
+    container_pool._list = lambda key=None: stale
+    assert container_pool.claim("key") is None
+    del container_pool._list
+    assert container_pool.claim("key") is None
+    assert daemon.containers["a"].name == "foo"
+
+
+# noinspection PyShadowingNames
+def test_pool_key(pool):
+    kwargs = dict(volumes=['/src:/src:rw'], name='foo')
+    key = pool.ContainerPool.pool_key('ubuntu:22.04', kwargs, b'archive')
+    assert pool.ContainerPool.pool_key('ubuntu:22.04', dict(kwargs, name=None), b'archive') == key
+    assert pool.ContainerPool.pool_key('ubuntu:22.04', kwargs, b'changed') != key
+
+
+# noinspection PyShadowingNames
+def test_pool_refill_own(pool):
+    import time
+    daemon = _Daemon()
+    # expired containers of other users are left alone
+    _pooled(daemon, "a", "key", time.time() - 7200, owner=os.getuid() + 1)
+    _pooled(daemon, "b", "key", time.time() - 7200)
+    container_pool = pool.ContainerPool(_Client(daemon), logging.getLogger("test"), 1, 3600)
+    created = list()
+
+    def _factory(name, labels):
+        created.append(name)
+        return _Container(name, name, labels)
+
+    container_pool.refill("key", _factory)
+    assert daemon.removed == ["b"] and len(created) == 1
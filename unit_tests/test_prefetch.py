@@ -0,0 +1,78 @@
+import os
+import sys
+import logging
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def prefetch():
+    """prefetch module"""
+    from dockerinside import prefetch
+    return prefetch
+
+
+def _events(image, layers, shared):
+    yield {"status": "Pulling from library/{0}".format(image), "id": "latest"}
+    for layer in shared:
+        yield {"status": "Downloading", "progressDetail": {"current": 50, "total": 100}, "id": layer}
+        yield {"status": "Pull complete", "progressDetail": {}, "id": layer}
+    for layer in layers:
+        yield {"status": "Already exists", "progressDetail": {}, "id": layer}
+    yield {"status": "Digest: sha256:0000"}
+    yield {"status": "Status: Downloaded newer image for {0}:latest".format(image)}
+
+
+class _Api(object):
+    def pull(self, repository, tag=None, stream=False, decode=False):
+        if repository == "missing":
+            return iter([{"error": "manifest unknown", "errorDetail": {"message": "manifest unknown"}}])
+        if repository == "alpine":
+            return iter([{"status": "Status: Image is up to date for alpine:latest"}])
+        return _events(repository, ["base"], ["shared", repository + "-own"])
+
+
+class _Client(object):
+    api = _Api()
+
+
+# noinspection PyShadowingNames
+def test_prefetch_load_manifest(prefetch, tmpdir):
+    text = tmpdir.join("images.txt")
+    text.write("# nightly\nubuntu:22.04\n\nalpine:latest  # small\n")
+    assert prefetch.load_manifest(str(text)) == ["ubuntu:22.04", "alpine:latest"]
+    js = tmpdir.join("images.json")
+    js.write('{"images": ["ubuntu:22.04", "busybox"]}')
+    assert prefetch.load_manifest(str(js)) == ["ubuntu:22.04", "busybox"]
+    js.write('{"images": 3}')
+    with pytest.raises(prefetch.ManifestError):
+        prefetch.load_manifest(str(js))
+
+
+# noinspection PyShadowingNames
+def test_prefetch_shared_layers(prefetch):
+    fetcher = prefetch.Prefetcher(_Client(), logging.getLogger("test"), workers=3)
+    results = fetcher.prefetch(["ubuntu", "debian", "alpine", "missing"])
+    assert [r.status for r in results] == ["pulled", "pulled", "up to date", None]
+    assert [r.succeeded for r in results] == [True, True, True, False]
+    assert results[0].layers == {"base", "shared", "ubuntu-own"}
+    assert results[0].downloaded == {"shared", "ubuntu-own"}
+    # the shared layer is counted once
+    assert fetcher._layers.total() == (300, 300)
+    assert results[3].error == "manifest unknown"
+
+
+# noinspection PyShadowingNames
+def test_prefetch_history(prefetch, tmpdir, monkeypatch):
+    from dockerinside import dockerutils
+    monkeypatch.setenv("HOME", str(tmpdir))
+    history = dockerutils.UsageHistory(logging.getLogger("test"))
+    history.record("ubuntu:22.04", "sha256:1")
+    history.record("alpine:latest", "sha256:2")
+    history.record("alpine:latest", "sha256:2")
+    app = prefetch.PrefetchApp(client=_Client())
+    app._args = app._parse_args(["--history", "--top", "1", "ubuntu:22.04"])
+    assert app._images() == ["ubuntu:22.04", "alpine:latest"]
@@ -0,0 +1,74 @@
+import os
+import sys
+import json
+import logging
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def profiles():
+    """profiles module"""
+    from dockerinside import profiles
+    return profiles
+
+
+# noinspection PyShadowingNames
+def test_profiles_expand_argv(profiles, tmpdir):
+    home = str(tmpdir)
+    os.makedirs(os.path.dirname(profiles.profile_path("dev", home)))
+    with open(profiles.profile_path("dev", home), 'w') as f:
+        json.dump({"args": ["-H", "ubuntu:22.04"]}, f)
+    with open(profiles.profile_path("plain", home), 'w') as f:
+        json.dump(["alpine"], f)
+    with open(profiles.profile_path("broken", home), 'w') as f:
+        json.dump({"args": "alpine"}, f)
+    assert profiles.expand_argv(["@dev", "--", "make"], home) == ("dev", ["-H", "ubuntu:22.04", "--", "make"])
+    assert profiles.expand_argv(["@dev", "--verbose", "-v", "/a:/a", "--", "make", "--", "x"], home) == \
+        ("dev", ["--verbose", "-v", "/a:/a", "-H", "ubuntu:22.04", "--", "make", "--", "x"])
+    assert profiles.expand_argv(["@plain", "id", "-u"], home) == ("plain", ["alpine", "--", "id", "-u"])
+    assert profiles.expand_argv(["@plain"], home) == ("plain", ["alpine", "--"])
+    assert profiles.expand_argv(["alpine", "id"], home) == (None, ["alpine", "id"])
+    for name in ("@broken", "@missing", "@../dev"):
+        with pytest.raises(profiles.ProfileError):
+            profiles.expand_argv([name], home)
+
+
+# noinspection PyShadowingNames
+def test_profiles_launch_plans(profiles, tmpdir):
+    plans = profiles.LaunchPlans(logging.getLogger("test"), path=str(tmpdir))
+    kwargs = {"ports": {"80/tcp": ("127.0.0.1", 8080), "22/tcp": 2222}, "volumes": ["/a:/a:rw"]}
+    plans.put("key", "sha256:1", "ubuntu:22.04", kwargs, {"DIN_UID": 1000}, b"\0archive")
+    plan = plans.get("key", "sha256:1", 60)
+    assert plan["creation_kwargs"] == kwargs
+    assert plan["archive"] == b"\0archive"
+    assert plan["env"] == {"DIN_UID": 1000}
+    assert plans.get("key", "sha256:2", 60) is None
+    assert plans.get("key", "sha256:1", -1) is None
+    assert plans.get("other", "sha256:1", 60) is None
+
+
+# noinspection PyShadowingNames
+def test_profiles_plan_session(profiles, tmpdir):
+    import dockerinside
+    app = dockerinside.DockerInsideApp(env={}, client=object())
+    app._args = app._parse_args(["--session", "ubuntu:22.04", "--", "make"])
+    app._tty = False
+    image_info = {"Id": "sha256:1", "Config": {"Cmd": ["bash"]}}
+    pack_conf = app._pack_config(None)
+    env = {"DIN_USER": "user", "DIN_ENTRYPOINT": "/entrypoint.sh"}
+    kwargs = {"command": ["make"], "name": None, "tty": False, "stdin_open": False, "auto_remove": False,
+              "environment": env, "volumes": [], "ports": {}}
+    plans = profiles.LaunchPlans(logging.getLogger("test"), path=str(tmpdir))
+    plans.put("key", "sha256:1", "ubuntu:22.04", {"environment": env, "volumes": [], "ports": {}}, env,
+              dockerinside.dockerutils.tar_pack(pack_conf))
+    planned = app._apply_plan(plans.get("key", "sha256:1", 60), image_info, None)
+    cmd, _, key = app._session_config("ubuntu:22.04", kwargs, pack_conf, env)
+    planned_cmd, _, planned_key = app._session_config(*planned)
+    # the keepalive of both runs without the entrypoint of the image
+    assert "DIN_ENTRYPOINT" not in planned[1]["environment"]
+    assert planned_cmd == cmd == ["/entrypoint.sh", "make"]
+    assert planned_key == key
@@ -0,0 +1,173 @@
+import os
+import sys
+import socket
+import tempfile
+import threading
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def pump():
+    """pump module"""
+    from dockerinside import pump
+    return pump
+
+
+def _drain(fd, chunks):
+    while True:
+        data = os.read(fd, 1 << 16)
+        if not data:
+            break
+        chunks.append(data)
+
+
+# noinspection PyShadowingNames
+def test_pump_session(pump):
+    container, host = socket.socketpair()
+    stdin_r, stdin_w = os.pipe()
+    stdout_r, stdout_w = os.pipe()
+    payload = os.urandom(3 << 20)
+    received = list()
+    forwarded = list()
+    reader = threading.Thread(target=_drain, args=(stdout_r, received))
+    reader.start()
+
+    def _container():
+        # echo what arrives from stdin, then send the payload and hang up
+        forwarded.append(container.recv(64))
+        container.sendall(payload)
+        container.close()
+
+    peer = threading.Thread(target=_container)
+    peer.start()
+    os.write(stdin_w, b"ls\r")
+    try:
+        pump.pty_session(host, stdin_r, stdout_w, buffer_size=4096, input_size=16)
+    finally:
+        os.close(stdout_w)
+        host.close()
+    peer.join()
+    reader.join()
+    assert forwarded == [b"ls\r"]
+    assert b"".join(received) == payload
+    for fd in (stdin_r, stdin_w, stdout_r):
+        os.close(fd)
+
+
+# noinspection PyShadowingNames
+def test_pump_channel_eof(pump):
+    src_r, src_w = os.pipe()
+    dst_r, dst_w = os.pipe()
+    eofs = list()
+    ch = pump.Channel(src_r, dst_w, 8, on_eof=lambda: eofs.append(True))
+    os.write(src_w, b"0123456789")
+    os.close(src_w)
+    with pump.nonblocking(src_r, dst_w):
+        pump.Pump([ch]).run()
+    assert ch.done
+    assert eofs == [True]
+    assert os.read(dst_r, 64) == b"0123456789"
+    for fd in (src_r, dst_r, dst_w):
+        os.close(fd)
+
+
+# noinspection PyShadowingNames
+def test_pump_closed_reader(pump):
+    src_r, src_w = os.pipe()
+    dst_r, dst_w = os.pipe()
+    os.close(dst_r)
+    ch = pump.Channel(src_r, dst_w, 8)
+    os.write(src_w, b"lost")
+    with pump.nonblocking(src_r, dst_w):
+        pump.Pump([ch]).run()
+    assert ch.done
+    for fd in (src_r, src_w, dst_w):
+        os.close(fd)
+
+
+# noinspection PyShadowingNames
+def test_pump_attach_socket(pump):
+    a, b = socket.socketpair()
+
+    class SocketIO(object):
+        _sock = a
+
+    assert pump.attach_socket(a) is a
+    assert pump.attach_socket(SocketIO()) is a
+    assert pump.attach_socket(object()) is None
+    a.close()
+    b.close()
+
+
+def _frame(stream, data):
+    return bytes([stream, 0, 0, 0]) + len(data).to_bytes(4, 'big') + data
+
+
+# noinspection PyShadowingNames
+def test_pump_stdio_session(pump):
+    container, host = socket.socketpair()
+    stdin_r, stdin_w = os.pipe()
+    stderr_r, stderr_w = os.pipe()
+    payload = os.urandom(1 << 20)
+    received = list()
+
+    def _container():
+        # cat: echo stdin on stdout until its end, then report on stderr
+        while True:
+            data = container.recv(1000)
+            if not data:
+                break
+            container.sendall(_frame(1, data))
+        container.sendall(_frame(2, b"done\n") + _frame(1, b""))
+        container.close()
+
+    peer = threading.Thread(target=_container)
+    peer.start()
+    feeder = threading.Thread(target=lambda: (os.write(stdin_w, payload), os.close(stdin_w)))
+    feeder.start()
+    reader = threading.Thread(target=_drain, args=(stderr_r, received))
+    reader.start()
+    # stdout is a regular file, which can't be used with epoll
+    with tempfile.TemporaryFile() as stdout:
+        try:
+            assert pump.stdio_session(host, stdin_r, stdout.fileno(), stderr_w, buffer_size=4099)
+        finally:
+            os.close(stderr_w)
+            host.close()
+        stdout.seek(0)
+        assert stdout.read() == payload
+    peer.join()
+    feeder.join()
+    reader.join()
+    assert b"".join(received) == b"done\n"
+    for fd in (stdin_r, stderr_r):
+        os.close(fd)
+
+
+# noinspection PyShadowingNames
+def test_pump_demux_closed_reader(pump):
+    container, host = socket.socketpair()
+    stdout_r, stdout_w = os.pipe()
+    os.close(stdout_r)
+    container.sendall(_frame(1, b"lost"))
+    container.close()
+    with open(os.devnull, 'rb') as stdin:
+        assert not pump.stdio_session(host, stdin.fileno(), stdout_w, stdout_w)
+    host.close()
+    os.close(stdout_w)
+
+
+# noinspection PyShadowingNames
+def test_pump_stdio_session_output_only(pump):
+    container, host = socket.socketpair()
+    container.sendall(_frame(1, b"output\n"))
+    container.close()
+    with tempfile.TemporaryFile() as stdout:
+        assert pump.stdio_session(host, None, stdout.fileno(), stdout.fileno())
+        stdout.seek(0)
+        assert stdout.read() == b"output\n"
+    host.close()
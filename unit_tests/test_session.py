@@ -0,0 +1,109 @@
+import os
+import sys
+import subprocess
+import pytest
+
+THIS_DIR = os.path.dirname(os.path.realpath(__file__))
+SRC_DIR = os.path.realpath(os.path.join(THIS_DIR, '..'))
+sys.path.insert(0, SRC_DIR)
+
+
+@pytest.fixture()
+def session():
+    """session module"""
+    from dockerinside import session
+    return session
+
+
+# noinspection PyShadowingNames
+def test_session_key(session):
+    kwargs = dict(command=['make'], name=None, tty=True, volumes=['/src:/src:rw'],
+                  environment={'DIN_USER': 'user'})
+    key = session.Session.session_key('ubuntu:22.04', kwargs, b'archive')
+    other = dict(kwargs, command=['pytest'], name='other', tty=False,
+                 environment={'DIN_USER': 'user', 'DIN_SWITCH_METHOD': 'su-exec'})
+    assert session.Session.session_key('ubuntu:22.04', other, b'archive') == key
+    assert session.Session.session_key('ubuntu:20.04', kwargs, b'archive') != key
+    assert session.Session.session_key('ubuntu:22.04', kwargs, b'changed') != key
+    assert session.Session.session_key('ubuntu:22.04', dict(kwargs, volumes=[]), b'archive') != key
+    assert session.Session(None, None, key).name == session.Session.NAME_PREFIX + key[:16]
+
+
+# noinspection PyShadowingNames
+def test_session_keepalive_command(session):
+    sess = session.Session(None, None, "0" * 64)
+    assert sess.keepalive_command(900.0)[1:] == ["keepalive", "900"]
+    assert sess.keepalive_command(0.5)[1:] == ["keepalive", "1"]
+    assert sess.keepalive_command(1.2)[1:] == ["keepalive", "2"]
+
+
+# noinspection PyShadowingNames
+def test_session_script(session, tmpdir):
+    script = tmpdir.join("session.sh")
+    script.write_binary(session.SESSION_SCRIPT.replace(b"/tmp/.docker_inside_session", str(tmpdir).encode()))
+    keepalive = subprocess.Popen(['sh', str(script), 'keepalive', '1'], stdout=subprocess.PIPE)
+    assert keepalive.stdout.readline() == session.Session.READY + b"\n"
+    # a running command keeps the session alive
+    assert subprocess.call(['sh', str(script), 'exec', 'sh', '-c', 'sleep 2; exit 3']) == 3
+    assert keepalive.poll() is None
+    assert keepalive.wait(timeout=10) == 0
+    assert subprocess.call(['sh', str(script), 'unknown']) == 1
+
+
+# noinspection PyShadowingNames
+def test_session_start_after_stop(session):
+    import logging
+    import docker
+
+    class _Response(object):
+        status_code = 409
+        reason = "Conflict"
+
+    class _Container(object):
+        id = "new"
+        started = False
+
+        def start(self):
+            self.started = True
+
+    class _Stream(list):
+        def close(self):
+            pass
+
+    class _Api(object):
+        api_version = '1.41'
+        # the old session is stopping and holds the name
+        containers = {"old": "exited"}
+        logs_of = list()
+
+        def inspect_container(self, ref):
+            for cid, status in self.containers.items():
+                if ref in (cid, sess.name):
+                    return {"Id": cid, "State": {"Status": status}}
+            raise docker.errors.NotFound("No such container: {0}".format(ref))
+
+        def wait(self, container_id, condition=None):
+            assert condition == 'removed'
+            del self.containers[container_id]
+            raise docker.errors.NotFound("No such container: {0}".format(container_id))
+
+        def logs(self, container_id, **kwargs):
+            self.logs_of.append(container_id)
+            return _Stream([b"din-session", b"-ready\n"])
+
+    class _Client(object):
+        api = _Api()
+
+    def _factory(name, labels):
+        if _Client.api.containers:
+            raise docker.errors.APIError("Conflict: name {0} is in use".format(name), _Response())
+        _Client.api.containers["new"] = "running"
+        return _Container()
+
+    sess = session.Session(_Client(), logging.getLogger("test"), "0" * 64)
+    cobj = sess.start(_factory)
+    assert cobj.id == "new" and cobj.started
+    assert _Client.api.logs_of == ["new"]
+    # another process is starting the session: only its readiness is awaited
+    assert sess.start(_factory) is None
+    assert _Client.api.logs_of == ["new", "new"]
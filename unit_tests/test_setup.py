@@ -60,6 +60,50 @@ def test_su_exec_setup(sapp, tmpdir, extra_args):
     _test_su_exec_inner(sapp, tmpdir, extra_args)
 
 
+def test_su_exec_setup_binary(sapp, tmpdir):
+    binary = os.path.join(tmpdir, "prebuilt-su-exec")
+    with open(binary, 'wb') as f:
+        f.write(b"not really a binary")
+    _test_su_exec_inner(sapp, tmpdir, ["--binary", binary])
+    store = os.path.join(tmpdir, ".config", "docker_inside", "store")
+    assert len(os.listdir(store)) == 1, "Binary has to be stored content addressed"
+
+
+def test_su_exec_setup_manifest(sapp, tmpdir):
+    import dockerinside.setup as din_setup
+    binary = os.path.join(tmpdir, "prebuilt-su-exec")
+    with open(binary, 'wb') as f:
+        f.write(b"not really a binary")
+    assert din_setup.SetupApp.check(tmpdir) == 1, "Check has to fail without manifest"
+    _test_su_exec_inner(sapp, tmpdir, ["--binary", binary])
+    assert din_setup.SetupApp.check(tmpdir) == 0
+    su_exec = os.path.join(tmpdir, ".config", "docker_inside", "su-exec")
+    mtime = os.stat(su_exec).st_mtime_ns
+    assert sapp.run(["--home", tmpdir, "--binary", binary]) == 0
+    assert os.stat(su_exec).st_mtime_ns == mtime, "Binary must not be installed again"
+    with open(su_exec, 'ab') as f:
+        f.write(b"modified")
+    assert din_setup.SetupApp.check(tmpdir) == 1, "Check has to detect modifications"
+
+
+def test_su_exec_resolve_commit(sapp, tmpdir):
+    import subprocess
+    repo = os.path.join(tmpdir, "su-exec")
+    git = ["git", "-C", repo, "-c", "user.name=test", "-c", "user.email=test@localhost"]
+    subprocess.check_call(["git", "init", "-q", "-b", "master", repo])
+    with open(os.path.join(repo, "su-exec.c"), 'w') as f:
+        f.write("int main() { return 0; }\n")
+    subprocess.check_call(git + ["add", "su-exec.c"])
+    subprocess.check_call(git + ["commit", "-q", "-m", "initial"])
+    subprocess.check_call(git + ["tag", "-a", "v1", "-m", "v1"])
+    commit = subprocess.check_output(git + ["rev-parse", "HEAD"]).decode('ascii').strip()
+    assert sapp._resolve_commit(repo, "master") == commit
+    assert sapp._resolve_commit(repo, "v1") == commit, "Annotated tags have to be peeled"
+    assert sapp._resolve_commit(repo, commit) == commit
+    assert sapp._resolve_commit(repo, "unknown") is None
+    assert sapp._resolve_commit(os.path.join(tmpdir, "missing"), "master") is None
+
+
 def test_su_exec_setup_with_proxy(sapp, tmpdir, with_proxy):
     with_proxy.set_env()
     _test_su_exec_inner(sapp, tmpdir, ["--host-network"])